@@ -0,0 +1,340 @@
+import os
+import cv2
+import json
+import time
+import random
+import argparse
+import multiprocessing as mp
+import torch
+import numpy as np
+from statistics import NormalDist
+from eval_metrics import load_frame, METRIC_FNS
+from eval_store import EvalStore, checkpoint_hash, parse_clips, METRICS
+from prediction_cache import PredictionCache
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+BASE_DIR = '/scratch/rrm9598/hpml/acv/SportsSloMo/SportsSloMo_frames/'
+CLIP_START = 7235
+CLIP_END = 7443
+
+
+def window_starts(frame_files, factor):
+    return range(0, len(frame_files) - factor, factor)
+
+def to_tensor(frame):
+    return torch.from_numpy(np.transpose(frame, (2, 0, 1)).astype("float32") / 255.).to(device).unsqueeze(0)
+
+def predict_window(model, frame0, frame1, factor, batch_size=4):
+    """Predict the factor - 1 intermediate frames of a window as RGB uint8 arrays."""
+    h, w, _ = frame0.shape
+    ph = ((h - 1) // 32 + 1) * 32
+    pw = ((w - 1) // 32 + 1) * 32
+    top, left = (ph - h) // 2, (pw - w) // 2
+    pader = torch.nn.ReplicationPad2d([left, pw - w - left, top, ph - h - top])
+    I0 = pader(to_tensor(frame0))
+    I1 = pader(to_tensor(frame1))
+    timesteps = torch.arange(1, factor, device=device, dtype=torch.float32) / factor
+    preds = []
+    with torch.no_grad():
+        for k in range(0, len(timesteps), batch_size):
+            t = timesteps[k:k + batch_size].view(-1, 1, 1, 1)
+            n = t.shape[0]
+            pred = model.inference(I0.expand(n, -1, -1, -1), I1.expand(n, -1, -1, -1), t)
+            pred = pred[:, :, top:top + h, left:left + w]
+            preds.extend((torch.round(pred.permute(0, 2, 3, 1) * 255)).byte().cpu().numpy())
+    return preds
+
+def load_model(model_dir):
+    from train_log.RIFE_HDv3 import Model
+    model = Model()
+    model.load_model(model_dir, -1)
+    model.eval()
+    model.device()
+    return model
+
+def predict(args):
+    """Stage one: run the network over every window and cache the predicted frames."""
+    model = load_model(args.modelDir)
+    ckpt = checkpoint_hash(args.modelDir)
+    cache = PredictionCache(args.cache_dir, ckpt, args.factor)
+
+    n_frames = 0
+    time_stamp = time.time()
+    for clip in args.clips:
+        clip_dir = os.path.join(args.data_root, f'clip_{clip}')
+        if cache.has_clip(clip):
+            continue
+        if not os.path.exists(clip_dir):
+            print(f"Skipping non-existent clip: {clip_dir}")
+            continue
+        clip_time = time.time()
+        frame_files = sorted(os.listdir(clip_dir))
+        with cache.writer(clip) as writer:
+            for i in window_starts(frame_files, args.factor):
+                try:
+                    frame0 = load_frame(os.path.join(clip_dir, frame_files[i]))
+                    frame1 = load_frame(os.path.join(clip_dir, frame_files[i + args.factor]))
+                except (ValueError, IndexError) as e:
+                    print(f"Error loading frames in clip {clip}, frames {i}-{i + args.factor}: {e}")
+                    continue
+                for j, pred in enumerate(predict_window(model, frame0, frame1, args.factor, args.batch_size), 1):
+                    writer.add(i, j, pred)
+            n_frames += writer.count
+        print(f"Predicted clip {clip}: {writer.count} frames in {time.time() - clip_time:.1f}s")
+    elapsed = time.time() - time_stamp
+    print(f"Prediction stage: {n_frames} frames in {elapsed:.1f}s ({n_frames / max(elapsed, 1e-9):.2f} frames/s)")
+    print(f"Predictions cached in {cache.root}")
+
+def score_clip(job):
+    """Score every cached prediction of one clip; runs in a worker process."""
+    cache_dir, ckpt, factor, data_root, clip, metrics, existing = job
+    torch.set_num_threads(1)
+    cache = PredictionCache(cache_dir, ckpt, factor)
+    clip_dir = os.path.join(data_root, f'clip_{clip}')
+    frame_files = sorted(os.listdir(clip_dir))
+    records = []
+    for window, timestep, pred in cache.read_clip(clip):
+        values = dict(existing.get((window, timestep), {}))
+        missing = [name for name in metrics if name not in values]
+        if missing:
+            gt = load_frame(os.path.join(clip_dir, frame_files[window + timestep]))
+            for name in missing:
+                values[name] = float(METRIC_FNS[name](pred, gt))
+        records.append(((window, timestep), values))
+    return clip, records
+
+def score(args):
+    """Stage two: stream cached predictions and ground truth through the metrics."""
+    ckpt = checkpoint_hash(args.modelDir)
+    cache = PredictionCache(args.cache_dir, ckpt, args.factor)
+    selected = set(args.clips)
+    clips = [clip for clip in cache.clips() if clip in selected]
+    store = EvalStore(args.store, 'direct') if args.store else None
+
+    jobs = []
+    for clip in clips:
+        existing = store.clip_metrics(ckpt, args.factor, clip) if store is not None else {}
+        jobs.append((args.cache_dir, ckpt, args.factor, args.data_root, clip, args.metrics, existing))
+
+    results = {name: [] for name in args.metrics}
+    n_frames = 0
+    time_stamp = time.time()
+    if args.workers > 0:
+        pool = mp.get_context('spawn').Pool(args.workers)
+        outputs = pool.imap_unordered(score_clip, jobs)
+    else:
+        pool = None
+        outputs = map(score_clip, jobs)
+    for clip, records in outputs:
+        if store is not None:
+            for (window, timestep), values in records:
+                store.put_metrics((ckpt, args.factor, clip, window, timestep), values)
+            store.commit()
+        n_frames += len(records)
+        if not records:
+            print(f"Clip {clip} had no valid results.")
+            continue
+        averages = {name: np.mean([values[name] for _, values in records]) for name in args.metrics}
+        for name, value in averages.items():
+            results[name].append(value)
+        print(f"Clip {clip} " + ", ".join(f"Average {name.upper()}: {value:.2f}" for name, value in averages.items()))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - time_stamp
+
+    for name, values in results.items():
+        if values:
+            print(f"\nOverall Average {name.upper()} across all clips: {np.mean(values):.2f}")
+    print(f"Number of clips processed: {len(results[args.metrics[0]])}")
+    print(f"Scoring stage: {n_frames} frames in {elapsed:.1f}s ({n_frames / max(elapsed, 1e-9):.2f} frames/s)")
+    if store is not None:
+        store.close()
+
+def motion_levels(args):
+    """Mean absolute difference between the two input frames of every window.
+
+    Computed on 4x-reduced grayscale frames and cached per factor, so every
+    checkpoint is stratified with the same motion levels.
+    """
+    path = os.path.join(args.cache_dir, 'motion_{}x.json'.format(args.factor))
+    motion = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            motion = json.load(f)
+    updated = False
+    for clip in args.clips:
+        clip_dir = os.path.join(args.data_root, f'clip_{clip}')
+        if str(clip) in motion or not os.path.exists(clip_dir):
+            continue
+        frame_files = sorted(os.listdir(clip_dir))
+        values = {}
+        for i in window_starts(frame_files, args.factor):
+            frame0 = cv2.imread(os.path.join(clip_dir, frame_files[i]), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+            frame1 = cv2.imread(os.path.join(clip_dir, frame_files[i + args.factor]), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+            if frame0 is None or frame1 is None:
+                continue
+            values[str(i)] = float(np.mean(np.abs(frame0.astype(np.float32) - frame1.astype(np.float32))))
+        motion[str(clip)] = values
+        updated = True
+    if updated:
+        os.makedirs(args.cache_dir, exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(motion, f)
+        os.replace(path + '.tmp', path)
+    return {(clip, int(i)): value for clip in args.clips if str(clip) in motion for i, value in motion[str(clip)].items()}
+
+def sampling_order(windows, seed):
+    """Deterministic order of windows that cycles through the clips of a stratum."""
+    rng = random.Random(seed)
+    by_clip = {}
+    for clip, i in sorted(windows):
+        by_clip.setdefault(clip, []).append((clip, i))
+    clips = sorted(by_clip)
+    rng.shuffle(clips)
+    for clip in clips:
+        rng.shuffle(by_clip[clip])
+    order = []
+    while any(by_clip[clip] for clip in clips):
+        for clip in clips:
+            if by_clip[clip]:
+                order.append(by_clip[clip].pop())
+    return order
+
+def stratified_estimate(samples, sizes, z):
+    """Stratified mean and confidence half-width with finite population correction."""
+    mean = 0.
+    var = 0.
+    total = sum(sizes)
+    for values, size in zip(samples, sizes):
+        weight = size / total
+        mean += weight * np.mean(values)
+        if len(values) > 1:
+            var += weight ** 2 * (1 - len(values) / size) * np.var(values, ddof=1) / len(values)
+    return mean, z * np.sqrt(var)
+
+def subset(args):
+    """Estimate mean PSNR (and optionally LPIPS) from a stratified sample of windows.
+
+    Windows are stratified by motion level and visited round-robin over
+    clips in a seeded order, so two checkpoints evaluated with the same seed
+    see the same windows. Sampling stops once every confidence interval is
+    narrower than the requested width.
+    """
+    motion = motion_levels(args)
+    keys = sorted(motion)
+    edges = np.quantile([motion[key] for key in keys], np.linspace(0, 1, args.motion_levels + 1)[1:-1])
+    strata = [[] for _ in range(args.motion_levels)]
+    for key in keys:
+        strata[int(np.searchsorted(edges, motion[key], side='right'))].append(key)
+    strata = [windows for windows in strata if windows]
+    orders = [sampling_order(windows, args.seed + h) for h, windows in enumerate(strata)]
+    sizes = [len(windows) for windows in strata]
+
+    model = load_model(args.modelDir)
+    ckpt = checkpoint_hash(args.modelDir)
+    store = EvalStore(args.store, 'direct') if args.store else None
+    metrics = ['psnr'] + (['lpips'] if args.lpips_width is not None else [])
+    widths = {'psnr': args.width, 'lpips': args.lpips_width}
+    z = NormalDist().inv_cdf(0.5 + args.confidence / 2)
+
+    samples = {name: [[] for _ in strata] for name in metrics}
+    taken = [0 for _ in strata]
+    n_frames = 0
+    estimates = {}
+    time_stamp = time.time()
+    while True:
+        open_strata = [h for h in range(len(strata)) if taken[h] < sizes[h]]
+        if not open_strata or sum(taken) >= args.max_fraction * sum(sizes):
+            break
+        # Proportional allocation: sample the stratum that is furthest behind its share
+        h = min(open_strata, key=lambda h: (taken[h] / sizes[h], h))
+        clip, i = orders[h][taken[h]]
+        taken[h] += 1
+
+        clip_dir = os.path.join(args.data_root, f'clip_{clip}')
+        frame_files = sorted(os.listdir(clip_dir))
+        stored = [store.get_metrics((ckpt, args.factor, clip, i, j)) for j in range(1, args.factor)] if store is not None else []
+        if stored and all(all(name in values for name in metrics) for values in stored):
+            values = stored
+        else:
+            try:
+                frame0 = load_frame(os.path.join(clip_dir, frame_files[i]))
+                frame1 = load_frame(os.path.join(clip_dir, frame_files[i + args.factor]))
+                gts = [load_frame(os.path.join(clip_dir, frame_files[i + j])) for j in range(1, args.factor)]
+            except (ValueError, IndexError) as e:
+                print(f"Error loading frames in clip {clip}, frames {i}-{i + args.factor}: {e}")
+                continue
+            preds = predict_window(model, frame0, frame1, args.factor, args.batch_size)
+            values = [{name: float(METRIC_FNS[name](pred, gt)) for name in metrics} for pred, gt in zip(preds, gts)]
+            if store is not None:
+                for j, record in enumerate(values, 1):
+                    store.put_metrics((ckpt, args.factor, clip, i, j), record)
+                store.commit()
+        n_frames += len(values)
+        for name in metrics:
+            samples[name][h].append(np.mean([record[name] for record in values]))
+
+        if min(len(s) for s in samples['psnr']) < args.min_per_stratum:
+            continue
+        estimates = {name: stratified_estimate(samples[name], sizes, z) for name in metrics}
+        if all(2 * half <= widths[name] for name, (_, half) in estimates.items()):
+            break
+    elapsed = time.time() - time_stamp
+
+    if not estimates:
+        estimates = {name: stratified_estimate([s for s in samples[name] if s], [n for s, n in zip(samples[name], sizes) if s], z)
+                     for name in metrics}
+    n_windows = sum(len(s) for s in samples['psnr'])
+    print(f"Sampled {n_windows}/{sum(sizes)} windows ({n_windows / sum(sizes):.1%} of the data, {n_frames} frames) "
+          f"from {len(strata)} motion strata in {elapsed:.1f}s")
+    for name, (mean, half) in estimates.items():
+        print(f"Estimated {name.upper()}: {mean:.3f} ({args.confidence:.0%} CI {mean - half:.3f} - {mean + half:.3f}, width {2 * half:.3f})")
+    if store is not None:
+        store.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Two-stage SportsSloMo evaluation')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--modelDir', type=str, default='train_log', help='directory containing model checkpoint')
+    common.add_argument('--factor', type=int, default=4, help='interpolation factor')
+    common.add_argument('--data_root', type=str, default=BASE_DIR)
+    common.add_argument('--clips', type=str, default=f'{CLIP_START}-{CLIP_END}', help="clip subset, e.g. '7235-7300,7400'")
+    common.add_argument('--cache_dir', type=str, default='eval_cache', help='root of the prediction cache')
+
+    parser_predict = subparsers.add_parser('predict', parents=[common], help='run the network and cache predictions')
+    parser_predict.add_argument('--batch_size', type=int, default=4, help='timesteps predicted per forward pass')
+
+    parser_score = subparsers.add_parser('score', parents=[common], help='score cached predictions')
+    parser_score.add_argument('--metrics', type=str, default=','.join(METRICS), help='comma-separated subset of psnr,lpips,ssim,ie')
+    parser_score.add_argument('--workers', type=int, default=8, help='scoring processes (0 scores in this process)')
+    parser_score.add_argument('--store', type=str, default=None, help='sqlite file to record per-frame results in')
+
+    parser_subset = subparsers.add_parser('subset', parents=[common], help='estimate PSNR from a stratified sample of windows')
+    parser_subset.add_argument('--width', type=float, default=0.1, help='target confidence interval width of PSNR (dB)')
+    parser_subset.add_argument('--lpips_width', type=float, default=None, help='also estimate LPIPS to this interval width')
+    parser_subset.add_argument('--confidence', type=float, default=0.95)
+    parser_subset.add_argument('--seed', type=int, default=1234, help='fixes the sampled windows across checkpoints')
+    parser_subset.add_argument('--motion_levels', type=int, default=3, help='number of motion strata')
+    parser_subset.add_argument('--min_per_stratum', type=int, default=5, help='windows per stratum before the interval is trusted')
+    parser_subset.add_argument('--max_fraction', type=float, default=1.0, help='stop after this fraction of windows regardless')
+    parser_subset.add_argument('--batch_size', type=int, default=4, help='timesteps predicted per forward pass')
+    parser_subset.add_argument('--store', type=str, default=None, help='sqlite file to reuse and record per-frame results')
+
+    args = parser.parse_args()
+    args.clips = parse_clips(args.clips)
+    if args.command == 'score':
+        args.metrics = args.metrics.split(',')
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == 'predict':
+        predict(args)
+    elif args.command == 'score':
+        score(args)
+    else:
+        subset(args)
@@ -12,11 +12,16 @@ import lpips
 from torchvision import transforms
 from PIL import Image
 from skimage.metrics import structural_similarity as ssim
+from eval_store import EvalStore, checkpoint_hash, METRICS
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--modelDir', type=str, default='train_log', 
                       help='directory containing model checkpoint')
+    parser.add_argument('--store', type=str, default=None,
+                      help='sqlite file for resumable per-frame results')
+    parser.add_argument('--metrics', type=str, default=','.join(METRICS),
+                      help='comma-separated subset of psnr,lpips,ssim,ie')
     return parser.parse_args()
 
 # Set device
@@ -38,6 +43,11 @@ FRAME_WIDTH = 1280
 # CLIP_END = 6285
 CLIP_START = 7235
 CLIP_END = 7443
+INTERP_FACTOR = 8
+
+METRIC_NAMES = args.metrics.split(',')
+store = EvalStore(args.store) if args.store else None
+ckpt = checkpoint_hash(args.modelDir) if store is not None else None
 
 loss_fn_alex = lpips.LPIPS(net='alex')
 
@@ -161,42 +171,67 @@ def benchmark_clip(clip_number):
     lpips_list = []
     ssim_list = []
     ie_list = []
+    metric_lists = {'psnr': psnr_list, 'lpips': lpips_list, 'ssim': ssim_list, 'ie': ie_list}
+    metric_fns = {'psnr': calculate_psnr, 'lpips': calculate_lpips, 'ssim': calculate_ssim, 'ie': calculate_ie}
     frame_files = sorted(os.listdir(clip_dir))
-    
-    # Process frames with stride 4
+
+    # Process frames with stride 8
     for i in range(0, len(frame_files)-8, 8):
+        keys = [(ckpt, INTERP_FACTOR, clip_number, i, j) for j in range(1, 4)]
+        if store is not None:
+            cached = [store.get_metrics(key) for key in keys]
+            if all(all(name in values for name in METRIC_NAMES) for values in cached):
+                for values in cached:
+                    for name in METRIC_NAMES:
+                        metric_lists[name].append(values[name])
+                continue
+
         # Load frames
         try:
-            frame1 = load_frame(os.path.join(clip_dir, frame_files[i]))
-            frame2 = load_frame(os.path.join(clip_dir, frame_files[i+8]))
             gt_frames = [load_frame(os.path.join(clip_dir, frame_files[i+j])) for j in range(1, 8)]
         except (ValueError, IndexError) as e:
             print(f"Error loading frames in clip {clip_number}, frames {i}-{i+8}: {e}")
             continue
 
-        # Prepare input tensors
-        I0 = torch.from_numpy(np.transpose(frame1, (2,0,1)).astype("float32") / 255.).cuda().unsqueeze(0)
-        I1 = torch.from_numpy(np.transpose(frame2, (2,0,1)).astype("float32") / 255.).cuda().unsqueeze(0)
-        
-        # Add padding
-        pad = 24  # For 720p resolution
-        pader = torch.nn.ReplicationPad2d([0, 0, pad, pad])
-        I0 = pader(I0)
-        I1 = pader(I1)
-        
-        # Run inference
-        with torch.no_grad():
-            pred_frames = inference(I0, I1, pad)
-        
-        # Calculate PSNR for each predicted frame
-        for pred, gt in zip(pred_frames, gt_frames):
-            pred_np = (np.round(pred.detach().cpu().numpy().transpose(1, 2, 0) * 255)).astype('uint8')
-            psnr = calculate_psnr(pred_np, gt)
-            psnr_list.append(psnr)
-            lpips_list.append(calculate_lpips(pred_np, gt))
-            ssim_list.append(calculate_ssim(pred_np, gt))
-            ie_list.append(calculate_ie(pred_np, gt))
-    
+        pred_nps = [store.get_prediction(key) for key in keys] if store is not None else [None]
+        if any(pred_np is None for pred_np in pred_nps):
+            try:
+                frame1 = load_frame(os.path.join(clip_dir, frame_files[i]))
+                frame2 = load_frame(os.path.join(clip_dir, frame_files[i+8]))
+            except (ValueError, IndexError) as e:
+                print(f"Error loading frames in clip {clip_number}, frames {i}-{i+8}: {e}")
+                continue
+
+            # Prepare input tensors
+            I0 = torch.from_numpy(np.transpose(frame1, (2,0,1)).astype("float32") / 255.).cuda().unsqueeze(0)
+            I1 = torch.from_numpy(np.transpose(frame2, (2,0,1)).astype("float32") / 255.).cuda().unsqueeze(0)
+
+            # Add padding
+            pad = 24  # For 720p resolution
+            pader = torch.nn.ReplicationPad2d([0, 0, pad, pad])
+            I0 = pader(I0)
+            I1 = pader(I1)
+
+            # Run inference
+            with torch.no_grad():
+                pred_frames = inference(I0, I1, pad)
+            pred_nps = [(np.round(pred.detach().cpu().numpy().transpose(1, 2, 0) * 255)).astype('uint8') for pred in pred_frames]
+            if store is not None:
+                for key, pred_np in zip(keys, pred_nps):
+                    store.put_prediction(key, pred_np)
+
+        # Calculate metrics for each predicted frame
+        for key, pred_np, gt in zip(keys, pred_nps, gt_frames):
+            values = store.get_metrics(key) if store is not None else {}
+            for name in METRIC_NAMES:
+                if name not in values:
+                    values[name] = metric_fns[name](pred_np, gt)
+                metric_lists[name].append(values[name])
+            if store is not None:
+                store.put_metrics(key, values)
+        if store is not None:
+            store.commit()
+
     return np.mean(psnr_list) if psnr_list else None, np.mean(lpips_list) if lpips_list else None, np.mean(ssim_list) if ssim_list else None, np.mean(ie_list) if ie_list else None
 
 def main():
@@ -208,7 +243,10 @@ def main():
     
     for clip_num in range(CLIP_START, CLIP_END + 1):
         print(f"Processing clip {clip_num}...")
-        avg_psnr, avg_lpips, avg_ssim, avg_ie = benchmark_clip(clip_num)
+        result = benchmark_clip(clip_num)
+        if result is None:
+            continue
+        avg_psnr, avg_lpips, avg_ssim, avg_ie = result
         if avg_psnr is not None:
             results_psnr.append(avg_psnr)
         if avg_lpips is not None:
@@ -217,23 +255,23 @@ def main():
             results_ssim.append(avg_ssim)
         if avg_ie is not None:
             results_ie.append(avg_ie)
-        if avg_psnr is not None and avg_lpips is not None and avg_ssim is not None and avg_ie is not None:
-            print(f"Clip {clip_num} Average PSNR: {avg_psnr:.2f}, Average LPIPS: {avg_lpips:.2f}, Average SSIM: {avg_ssim:.2f}, Average IE: {avg_ie:.2f}")
+        averages = {'PSNR': avg_psnr, 'LPIPS': avg_lpips, 'SSIM': avg_ssim, 'IE': avg_ie}
+        averages = {name: value for name, value in averages.items() if value is not None}
+        if averages:
+            print(f"Clip {clip_num} " + ", ".join(f"Average {name}: {value:.2f}" for name, value in averages.items()))
         else:
             print(f"Clip {clip_num} had no valid results.")
     
-    if results_psnr:
-        overall_psnr = np.mean(results_psnr)
-        overall_lpips = np.mean(results_lpips)
-        overall_ssim = np.mean(results_ssim)
-        overall_ie = np.mean(results_ie)
-        print(f"\nOverall Average PSNR across all clips: {overall_psnr:.2f}")
-        print(f"\nOverall Average LPIPS across all clips: {overall_lpips:.2f}")
-        print(f"\nOverall Average SSIM across all clips: {overall_ssim:.2f}")
-        print(f"\nOverall Average IE across all clips: {overall_ie:.2f}")
-        print(f"Number of clips processed: {len(results_psnr)}")
+    results = {'PSNR': results_psnr, 'LPIPS': results_lpips, 'SSIM': results_ssim, 'IE': results_ie}
+    if any(results.values()):
+        for name, values in results.items():
+            if values:
+                print(f"\nOverall Average {name} across all clips: {np.mean(values):.2f}")
+        print(f"Number of clips processed: {max(len(values) for values in results.values())}")
     else:
         print("No valid results obtained")
+    if store is not None:
+        store.close()
 
 if __name__ == "__main__":
     main()
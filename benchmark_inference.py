@@ -0,0 +1,215 @@
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import argparse
+import subprocess
+import torch
+import numpy as np
+from model.warplayer import warp
+from train_log.IFNet_HDv3 import IFNet, read_config
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+RESOLUTIONS = {
+    '720p': (720, 1280),
+    '1080p': (1080, 1920),
+    '4k': (2160, 3840),
+}
+COMPONENTS = ['head', 'block0', 'block1', 'block2', 'block3', 'warp', 'merge', 'total', 'end_to_end']
+
+
+def sync():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+class Timer:
+    """Accumulates synchronised wall time per named component."""
+    def __init__(self):
+        self.times = {}
+
+    def start(self):
+        sync()
+        self.stamp = time.perf_counter()
+
+    def stop(self, name):
+        sync()
+        now = time.perf_counter()
+        self.times[name] = self.times.get(name, 0.) + (now - self.stamp) * 1000.
+        self.stamp = now
+
+def timed_forward(net, x, timestep, scale_list, timer):
+    """IFNet.forward at inference time, with each stage timed separately."""
+    timer.start()
+    channel = x.shape[1] // 2
+    img0 = x[:, :channel]
+    img1 = x[:, channel:]
+    timestep = (x[:, :1].clone() * 0 + 1) * timestep
+    f0 = net.encode(img0[:, :3])
+    f1 = net.encode(img1[:, :3])
+    timer.stop('head')
+    warped_img0 = img0
+    warped_img1 = img1
+    flow = None
+    mask = None
+    block = [net.block0, net.block1, net.block2, net.block3]
+    for i in range(4):
+        if flow is None:
+            flow, mask, feat = block[i](torch.cat((img0[:, :3], img1[:, :3], f0, f1, timestep), 1), None, scale=scale_list[i])
+            timer.stop('block{}'.format(i))
+        else:
+            wf0 = warp(f0, flow[:, :2])
+            wf1 = warp(f1, flow[:, 2:4])
+            timer.stop('warp')
+            fd, mask, feat = block[i](torch.cat((warped_img0[:, :3], warped_img1[:, :3], wf0, wf1, timestep, mask, feat), 1), flow, scale=scale_list[i])
+            flow = flow + fd
+            timer.stop('block{}'.format(i))
+        warped_img0 = warp(img0, flow[:, :2])
+        warped_img1 = warp(img1, flow[:, 2:4])
+        timer.stop('warp')
+    mask = torch.sigmoid(mask)
+    merged = warped_img0 * mask + warped_img1 * (1 - mask)
+    timer.stop('merge')
+    return merged
+
+def environment():
+    env = {
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'hostname': socket.gethostname(),
+        'num_threads': torch.get_num_threads(),
+        'device': device.type,
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    if device.type == 'cuda':
+        env['cuda'] = torch.version.cuda
+        env['cudnn'] = torch.backends.cudnn.version()
+        env['gpu'] = torch.cuda.get_device_name()
+    try:
+        env['git_commit'] = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                                    stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        pass
+    return env
+
+def bench_config(net, resolution, batch_size, scale, warmup, repeats):
+    h, w = RESOLUTIONS[resolution]
+    # Every block downsamples by 8 / scale and then by 4 inside conv0
+    align = int(32 / min(scale, 1.0))
+    ph = ((h - 1) // align + 1) * align
+    pw = ((w - 1) // align + 1) * align
+    scale_list = [8/scale, 4/scale, 2/scale, 1/scale]
+    x = torch.rand(batch_size, 6, ph, pw, device=device)
+
+    per_run = []
+    with torch.no_grad():
+        for k in range(warmup + repeats):
+            timer = Timer()
+            timed_forward(net, x, 0.5, scale_list, timer)
+            timer.times['total'] = sum(timer.times.values())
+            sync()
+            time_stamp = time.perf_counter()
+            net(x, 0.5, scale_list)
+            sync()
+            timer.times['end_to_end'] = (time.perf_counter() - time_stamp) * 1000.
+            if k >= warmup:
+                per_run.append(timer.times)
+    return {name: {
+        'median_ms': float(np.median([t[name] for t in per_run])),
+        'mean_ms': float(np.mean([t[name] for t in per_run])),
+        'std_ms': float(np.std([t[name] for t in per_run])),
+    } for name in COMPONENTS}
+
+def run(args):
+    torch.manual_seed(args.seed)
+    if device.type == 'cuda':
+        torch.backends.cudnn.benchmark = True
+    net = IFNet(**read_config(args.modelDir)) if args.modelDir is not None else IFNet()
+    if args.modelDir is not None:
+        state = torch.load('{}/flownet.pkl'.format(args.modelDir), map_location='cpu')
+        net.load_state_dict({k.replace("module.", ""): v for k, v in state.items()}, False)
+    net.eval().to(device)
+
+    results = []
+    for resolution in args.resolutions.split(','):
+        for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+            for scale in [float(s) for s in args.scales.split(',')]:
+                config = {'resolution': resolution, 'batch_size': batch_size, 'scale': scale}
+                try:
+                    config['timings'] = bench_config(net, resolution, batch_size, scale, args.warmup, args.repeats)
+                except RuntimeError as e:
+                    if 'out of memory' not in str(e):
+                        raise
+                    torch.cuda.empty_cache()
+                    config['error'] = 'out of memory'
+                    print('{:>6} batch {} scale {}: out of memory'.format(resolution, batch_size, scale))
+                    results.append(config)
+                    continue
+                timings = config['timings']
+                print('{:>6} batch {} scale {}: '.format(resolution, batch_size, scale) + ' '.join(
+                    '{}={:.2f}'.format(name, timings[name]['median_ms']) for name in COMPONENTS))
+                results.append(config)
+
+    with open(args.output, 'w') as f:
+        json.dump({'env': environment(), 'warmup': args.warmup, 'repeats': args.repeats, 'results': results}, f, indent=2)
+    print('Results written to {}'.format(args.output))
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    for key in ['device', 'gpu', 'processor', 'torch']:
+        if baseline['env'].get(key) != current['env'].get(key):
+            print('warning: {} differs ({} vs {})'.format(key, baseline['env'].get(key), current['env'].get(key)))
+
+    def key(config):
+        return config['resolution'], config['batch_size'], config['scale']
+    base = {key(c): c for c in baseline['results'] if 'timings' in c}
+    regressions = 0
+    for config in current['results']:
+        if 'timings' not in config or key(config) not in base:
+            continue
+        for name in COMPONENTS:
+            old = base[key(config)]['timings'][name]['median_ms']
+            new = config['timings'][name]['median_ms']
+            change = new / old - 1 if old > 0 else 0.
+            flag = ''
+            if change > args.threshold:
+                flag = '  REGRESSION'
+                regressions += 1
+            if flag or args.verbose:
+                print('{:>6} batch {} scale {} {:>10}: {:8.2f} -> {:8.2f} ms ({:+.1%}){}'.format(
+                    *key(config), name, old, new, change, flag))
+    print('{} regression(s) beyond {:.0%}'.format(regressions, args.threshold))
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='IFNet inference speed benchmark')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_run = subparsers.add_parser('run', help='time IFNet on random inputs')
+    parser_run.add_argument('--resolutions', type=str, default='720p,1080p,4k')
+    parser_run.add_argument('--batch_sizes', type=str, default='1,2,4')
+    parser_run.add_argument('--scales', type=str, default='1.0,0.5')
+    parser_run.add_argument('--warmup', type=int, default=3)
+    parser_run.add_argument('--repeats', type=int, default=10)
+    parser_run.add_argument('--seed', type=int, default=1234)
+    parser_run.add_argument('--modelDir', type=str, default=None, help='optionally time trained weights')
+    parser_run.add_argument('--output', type=str, default='bench_inference.json')
+
+    parser_compare = subparsers.add_parser('compare', help='flag regressions against a stored baseline')
+    parser_compare.add_argument('baseline', type=str)
+    parser_compare.add_argument('current', type=str)
+    parser_compare.add_argument('--threshold', type=float, default=0.1, help='relative slowdown counted as a regression')
+    parser_compare.add_argument('--verbose', action='store_true', help='print every component, not just regressions')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    else:
+        sys.exit(compare(args))
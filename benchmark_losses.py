@@ -0,0 +1,343 @@
+import copy
+import json
+import time
+import argparse
+import torch
+import numpy as np
+import torch.nn as nn
+import torch.nn.functional as F
+from collections import OrderedDict
+from train_log.RIFE_HDv3 import JointsMSELoss
+from model.loss import VGGPerceptualLoss, Ternary
+from model.laplacian import LapLoss
+from model.pytorch_msssim import ssim, ssim_matlab, msssim, create_window, create_window_3d
+from benchmark_inference import RESOLUTIONS
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def sync():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+def time_fn(fn, warmup, repeats):
+    """Median synchronised wall time of fn() in milliseconds."""
+    times = []
+    for k in range(warmup + repeats):
+        sync()
+        time_stamp = time.perf_counter()
+        fn()
+        sync()
+        if k >= warmup:
+            times.append((time.perf_counter() - time_stamp) * 1000.)
+    return float(np.median(times))
+
+def max_diff(a, b):
+    return float((a.detach().float() - b.detach().float()).abs().max())
+
+class ReferenceJointsMSELoss(nn.Module):
+    """The per-joint loop JointsMSELoss replaced, kept for parity checks."""
+    def __init__(self):
+        super().__init__()
+        self.criterion = nn.MSELoss(reduction='none')
+
+    def forward(self, output, target):
+        batch_size = output.size(0)
+        num_joints = output.size(1)
+        heatmaps_pred = output.reshape((batch_size, num_joints, -1)).split(1, 1)
+        heatmaps_gt = target.reshape((batch_size, num_joints, -1)).split(1, 1)
+        loss = 0.
+        for idx in range(num_joints):
+            loss += self.criterion(heatmaps_pred[idx].squeeze(1), heatmaps_gt[idx].squeeze(1))
+        return loss / num_joints
+
+def bench_joints_mse(args):
+    output = torch.randn(args.batch_size, 17, 64, 48, device=device, requires_grad=True)
+    target = torch.randn(args.batch_size, 17, 64, 48, device=device)
+    impls = OrderedDict([('loop', ReferenceJointsMSELoss()), ('vectorized', JointsMSELoss())])
+    results = OrderedDict()
+    for name, loss_fn in impls.items():
+        def step():
+            output.grad = None
+            loss_fn(output, target).mean().backward()
+        step()
+        results[name] = {'ms': time_fn(step, args.warmup, args.repeats),
+                         'value': loss_fn(output, target).mean().detach(), 'grad': output.grad.clone()}
+    ref = results['loop']
+    return [{'impl': name, 'ms': r['ms'], 'max_diff': max(max_diff(r['value'], ref['value']), max_diff(r['grad'], ref['grad']))}
+            for name, r in results.items()]
+
+def bench_vitpose(args):
+    """ViTPose on prediction and ground truth: two tracked passes, a no-grad ground-truth pass, one batched pass."""
+    from model.heatmap_loss import HeatmapInfer
+    infer = HeatmapInfer().eval()
+    unbatched = HeatmapInfer(batched=False).eval()
+    unbatched.vit_pose = infer.vit_pose
+    loss_fn = JointsMSELoss()
+    pred = torch.rand(args.batch_size, 3, args.crop, args.crop, device=device, requires_grad=True)
+    gt = torch.rand(args.batch_size, 3, args.crop, args.crop, device=device)
+
+    def sequential():
+        cur, target = infer.heatmaps(pred), infer.heatmaps(gt)
+        return loss_fn(cur, target).mean()
+
+    def gt_no_grad():
+        cur, target = unbatched(pred, gt)
+        return loss_fn(cur, target).mean()
+
+    def batched():
+        cur, target = infer(pred, gt)
+        return loss_fn(cur, target).mean()
+
+    results = OrderedDict()
+    for name, fn in [('sequential', sequential), ('gt_no_grad', gt_no_grad), ('batched', batched)]:
+        def step():
+            pred.grad = None
+            fn().backward()
+        step()
+        results[name] = {'ms': time_fn(step, args.warmup, args.repeats), 'value': fn().detach(), 'grad': pred.grad.clone()}
+    ref = results['sequential']
+    return [{'impl': name, 'ms': r['ms'], 'max_diff': max(max_diff(r['value'], ref['value']), max_diff(r['grad'], ref['grad']))}
+            for name, r in results.items()]
+
+class ReferenceVGGPerceptualLoss(nn.Module):
+    """The layer-by-layer perceptual loss VGGPerceptualLoss replaced, sharing the unfolded layers of vgg."""
+    def __init__(self, vgg):
+        super().__init__()
+        self.normalize = vgg.normalize
+        self.layers = [layer for stage in vgg.stages for layer in stage]
+
+    def forward(self, X, Y):
+        X = self.normalize(X)
+        Y = self.normalize(Y)
+        indices = [2, 7, 12, 21, 30]
+        weights = [1.0/2.6, 1.0/4.8, 1.0/3.7, 1.0/5.6, 10/1.5]
+        k = 0
+        loss = 0
+        for i in range(indices[-1]):
+            X = self.layers[i](X)
+            Y = self.layers[i](Y)
+            if (i+1) in indices:
+                loss += weights[k] * (X - Y.detach()).abs().mean() * 0.1
+                k += 1
+        return loss
+
+def bench_vgg(args):
+    unfolded = VGGPerceptualLoss(fold_normalize=False).to(device)
+    folded = copy.deepcopy(unfolded)
+    folded.fold_normalize()
+    reference = ReferenceVGGPerceptualLoss(unfolded)
+    pred = torch.rand(args.batch_size, 3, args.crop, args.crop, device=device, requires_grad=True)
+    gt = torch.rand(args.batch_size, 3, args.crop, args.crop, device=device)
+    impls = [('layerwise', lambda: reference(pred, gt)), ('no_grad_target', lambda: unfolded(pred, gt)),
+             ('folded', lambda: folded(pred, gt))]
+    results = OrderedDict()
+    for name, fn in impls:
+        def step():
+            pred.grad = None
+            fn().backward()
+        step()
+        results[name] = {'ms': time_fn(step, args.warmup, args.repeats), 'value': fn().detach(), 'grad': pred.grad.clone()}
+    ref = results['layerwise']
+    return [{'impl': name, 'ms': r['ms'], 'max_diff': max(max_diff(r['value'], ref['value']), max_diff(r['grad'], ref['grad']))}
+            for name, r in results.items()]
+
+class ReferenceTernary(nn.Module):
+    """The identity-kernel convolution census loss Ternary replaced, kept for parity checks."""
+    def __init__(self):
+        super().__init__()
+        patch_size = 7
+        out_channels = patch_size * patch_size
+        w = np.eye(out_channels).reshape((patch_size, patch_size, 1, out_channels))
+        self.register_buffer('w', torch.tensor(np.transpose(w, (3, 2, 0, 1))).float())
+        self.loss = Ternary()
+
+    def transform(self, img):
+        transf = F.conv2d(img, self.w, padding=3, bias=None) - img
+        return transf / torch.sqrt(0.81 + transf**2)
+
+    def forward(self, img0, img1):
+        t0 = self.transform(self.loss.rgb2gray(img0))
+        t1 = self.transform(self.loss.rgb2gray(img1))
+        dist = (t0 - t1) ** 2
+        return torch.mean(dist / (0.1 + dist), 1, True) * self.loss.valid_mask(t0, 1)
+
+def bench_ternary(args):
+    """'shift_<n>' slices n neighbour offsets at a time and recomputes them in the backward pass."""
+    pred = torch.rand(args.batch_size, 3, args.crop, args.crop, device=device, requires_grad=True)
+    gt = torch.rand(args.batch_size, 3, args.crop, args.crop, device=device)
+    impls = [('conv', ReferenceTernary().to(device))] + [('shift_{}'.format(n), Ternary(chunk_size=n)) for n in (49, 7, 1)]
+    results = OrderedDict()
+    for name, loss_fn in impls:
+        def step():
+            pred.grad = None
+            loss_fn(pred, gt).mean().backward()
+        step()
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats()
+        ms = time_fn(step, args.warmup, args.repeats)
+        results[name] = {'ms': ms, 'value': loss_fn(pred, gt).detach(), 'grad': pred.grad.clone()}
+        if device.type == 'cuda':
+            results[name]['peak_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+    ref = results['conv']
+    return [dict({k: v for k, v in r.items() if k not in ('value', 'grad')}, impl=name,
+                 max_diff=max(max_diff(r['value'], ref['value']), max_diff(r['grad'], ref['grad'])))
+            for name, r in results.items()]
+
+class ReferenceLapLoss(nn.Module):
+    """The Laplacian loss LapLoss replaced, rebuilding its kernels and zero tensors on every upsample."""
+    def __init__(self, max_levels=5):
+        super().__init__()
+        self.max_levels = max_levels
+
+    @staticmethod
+    def gauss_kernel(channels, like):
+        kernel = torch.tensor([[1., 4., 6., 4., 1],
+                               [4., 16., 24., 16., 4.],
+                               [6., 24., 36., 24., 6.],
+                               [4., 16., 24., 16., 4.],
+                               [1., 4., 6., 4., 1.]]) / 256.
+        return kernel.repeat(channels, 1, 1, 1).to(like)
+
+    def conv_gauss(self, img, kernel):
+        return F.conv2d(F.pad(img, (2, 2, 2, 2), mode='reflect'), kernel, groups=img.shape[1])
+
+    def upsample(self, x):
+        cc = torch.cat([x, torch.zeros(x.shape[0], x.shape[1], x.shape[2], x.shape[3]).to(x)], dim=3)
+        cc = cc.view(x.shape[0], x.shape[1], x.shape[2]*2, x.shape[3])
+        cc = cc.permute(0, 1, 3, 2)
+        cc = torch.cat([cc, torch.zeros(x.shape[0], x.shape[1], x.shape[3], x.shape[2]*2).to(x)], dim=3)
+        cc = cc.view(x.shape[0], x.shape[1], x.shape[3]*2, x.shape[2]*2)
+        return self.conv_gauss(cc.permute(0, 1, 3, 2), 4*self.gauss_kernel(x.shape[1], x))
+
+    def pyramid(self, img):
+        current = img
+        pyr = []
+        for level in range(self.max_levels):
+            down = self.conv_gauss(current, self.gauss_kernel(img.shape[1], img))[:, :, ::2, ::2]
+            pyr.append(current - self.upsample(down))
+            current = down
+        return pyr
+
+    def forward(self, input, target):
+        return sum(F.l1_loss(a, b) for a, b in zip(self.pyramid(input), self.pyramid(target)))
+
+def bench_laplacian(args):
+    """Each implementation at batch 1, 4 and --batch_size; speedups are against 'zeros' at the same batch."""
+    impls = [('zeros', ReferenceLapLoss()), ('conv_transpose', LapLoss(batched=False).to(device)), ('batched', LapLoss(batched=True).to(device))]
+    rows = []
+    for batch_size in sorted({1, 4, args.batch_size}):
+        pred = torch.rand(batch_size, 3, args.crop, args.crop, device=device, requires_grad=True)
+        gt = torch.rand(batch_size, 3, args.crop, args.crop, device=device)
+        results = OrderedDict()
+        for name, loss_fn in impls:
+            def step():
+                pred.grad = None
+                loss_fn(pred, gt).backward()
+            step()
+            results[name] = {'ms': time_fn(step, args.warmup, args.repeats), 'value': loss_fn(pred, gt).detach(), 'grad': pred.grad.clone()}
+        ref = results['zeros']
+        rows += [{'impl': '{}_bs{}'.format(name, batch_size), 'group': batch_size, 'ms': r['ms'],
+                  'max_diff': max(max_diff(r['value'], ref['value']), max_diff(r['grad'], ref['grad']))}
+                 for name, r in results.items()]
+    return rows
+
+def reference_ssim(img1, img2, volume=False, full=False):
+    """The dense-window SSIM (conv2d) and ssim_matlab (conv3d) the separable versions replaced, over [0, 1] images."""
+    if volume:
+        window = create_window_3d(11).to(img1)
+        img1, img2 = img1.unsqueeze(1), img2.unsqueeze(1)
+        conv = lambda x: F.conv3d(F.pad(x, (5, 5, 5, 5, 5, 5), mode='replicate'), window)
+    else:
+        window = create_window(11, img1.shape[1]).to(img1)
+        conv = lambda x: F.conv2d(F.pad(x, (5, 5, 5, 5), mode='replicate'), window, groups=img1.shape[1])
+    mu1, mu2 = conv(img1), conv(img2)
+    sigma1_sq = conv(img1 * img1) - mu1.pow(2)
+    sigma2_sq = conv(img2 * img2) - mu2.pow(2)
+    sigma12 = conv(img1 * img2) - mu1 * mu2
+    C1, C2 = 0.01 ** 2, 0.03 ** 2
+    v1 = 2.0 * sigma12 + C2
+    v2 = sigma1_sq + sigma2_sq + C2
+    ssim_map = ((2 * mu1 * mu2 + C1) * v1) / ((mu1.pow(2) + mu2.pow(2) + C1) * v2)
+    if full:
+        return ssim_map.mean(), torch.mean(v1 / v2)
+    return ssim_map.mean()
+
+def reference_msssim(img1, img2):
+    weights = torch.tensor([0.0448, 0.2856, 0.3001, 0.2363, 0.1333], device=img1.device)
+    mssim, mcs = [], []
+    for _ in range(len(weights)):
+        sim, cs = reference_ssim(img1, img2, full=True)
+        mssim.append(sim)
+        mcs.append(cs)
+        img1, img2 = F.avg_pool2d(img1, (2, 2)), F.avg_pool2d(img2, (2, 2))
+    return torch.prod((torch.stack(mcs) ** weights)[:-1] * (torch.stack(mssim) ** weights)[-1])
+
+def bench_ssim(args):
+    """Evaluation metrics, so forward only: dense windows against separable passes at 720p and 1080p.
+
+    Per-image results of the separable versions are also checked against the
+    reference applied to each image of the batch.
+    """
+    impls = [('ssim', lambda a, b: reference_ssim(a, b), ssim),
+             ('ssim_matlab', lambda a, b: reference_ssim(a, b, volume=True), ssim_matlab),
+             ('msssim', reference_msssim, msssim)]
+    rows = []
+    for resolution in ['720p', '1080p']:
+        h, w = RESOLUTIONS[resolution]
+        gt = torch.rand(args.ssim_batch_size, 3, h, w, device=device)
+        pred = (gt + 0.1 * torch.randn_like(gt)).clamp(0, 1)
+        for name, reference, separable in impls:
+            with torch.no_grad():
+                ref = torch.stack([reference(pred[i:i+1], gt[i:i+1]) for i in range(len(gt))])
+                per_image = separable(pred, gt, size_average=False)
+                ref_ms = time_fn(lambda: reference(pred, gt), args.warmup, args.repeats)
+                ms = time_fn(lambda: separable(pred, gt), args.warmup, args.repeats)
+                batch_diff = max_diff(separable(pred, gt), reference(pred, gt))
+            group = '{}/{}'.format(resolution, name)
+            rows.append({'impl': '{}_dense_{}'.format(name, resolution), 'group': group, 'ms': ref_ms, 'max_diff': 0.})
+            rows.append({'impl': '{}_sep_{}'.format(name, resolution), 'group': group, 'ms': ms,
+                         'max_diff': max(batch_diff, max_diff(per_image, ref))})
+    return rows
+
+# Each case times its reference implementation first, then the replacements
+CASES = OrderedDict([
+    ('joints_mse', bench_joints_mse),
+    ('vitpose', bench_vitpose),
+    ('vgg', bench_vgg),
+    ('ternary', bench_ternary),
+    ('laplacian', bench_laplacian),
+    ('ssim', bench_ssim),
+])
+
+def main():
+    parser = argparse.ArgumentParser(description='Parity and forward+backward timing of loss implementations')
+    parser.add_argument('--cases', type=str, default=','.join(CASES), help='comma-separated: ' + ', '.join(CASES))
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--crop', type=int, default=256, help='image size for image-space losses')
+    parser.add_argument('--ssim_batch_size', type=int, default=2, help='frames per SSIM call at 720p and 1080p')
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--output', type=str, default=None, help='optionally write the results as JSON')
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    rows = []
+    print('{:<14} {:<24} {:>10} {:>9} {:>12}'.format('case', 'impl', 'ms', 'speedup', 'max diff'))
+    for case in args.cases.split(','):
+        results = CASES[case](args)
+        for r in results:
+            r['case'] = case
+            # Cases with several groups (batch sizes, resolutions) compare against the reference in the same group
+            ref = next(x for x in results if x.get('group') == r.get('group'))
+            r['speedup'] = ref['ms'] / r['ms']
+            print('{:<14} {:<24} {:>10.3f} {:>8.2f}x {:>12.2e}'.format(case, r['impl'], r['ms'], r['speedup'], r['max_diff'])
+                  + ('   peak {:.0f} MB'.format(r['peak_mb']) if 'peak_mb' in r else ''))
+        rows += results
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+if __name__ == "__main__":
+    main()
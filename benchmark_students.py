@@ -0,0 +1,80 @@
+import json
+import argparse
+import torch
+import numpy as np
+from collections import OrderedDict
+from benchmark_inference import bench_config
+from dataset import load_val_subset
+from train_log.IFNet_HDv3 import WIDTHS, DEPTHS
+from train_log.RIFE_HDv3 import Model
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+# Student sizes to try with train.py --widths/--depths, the full model first
+PRESETS = OrderedDict([
+    ('full', (WIDTHS, DEPTHS)),
+    ('m', ((192, 128, 64, 32), (6, 6, 6, 6))),
+    ('s', ((128, 96, 48, 32), (4, 4, 4, 4))),
+    ('xs', ((96, 64, 32, 24), (2, 2, 2, 2))),
+])
+
+
+def psnr(model, frames, timesteps, batch_size):
+    values = []
+    with torch.no_grad():
+        for b in range(0, frames.shape[0], batch_size):
+            data = frames[b:b + batch_size].float() / 255.
+            pred = model.inference(data[:, :3], data[:, 3:6], timesteps[b:b + batch_size])
+            mse = ((pred - data[:, 6:9]) ** 2).mean((1, 2, 3))
+            values.append(-10 * torch.log10(mse))
+    return torch.cat(values).mean().item()
+
+def main():
+    parser = argparse.ArgumentParser(description='Speed versus PSNR of the full IFNet and distilled students')
+    parser.add_argument('--modelDirs', type=str, nargs='*', default=[], help='trained checkpoints, e.g. the teacher and its students')
+    parser.add_argument('--presets', type=str, default='', help='also time untrained sizes: ' + ', '.join(PRESETS))
+    parser.add_argument('--data_root', type=str, default='/scratch/rrm9598/hpml/acv/SportsSloMo/SportsSloMo_frames/')
+    parser.add_argument('--val_windows', type=int, default=64)
+    parser.add_argument('--val_batch_size', type=int, default=8)
+    parser.add_argument('--resolution', type=str, default='720p')
+    parser.add_argument('--threads', type=int, default=None, help='torch CPU threads, as on the deployment nodes')
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--output', type=str, default=None, help='optionally write the table as JSON')
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    models = []
+    for model_dir in args.modelDirs:
+        model = Model()
+        model.load_model(model_dir, -1)
+        models.append((model_dir, model))
+    for name in [p for p in args.presets.split(',') if p]:
+        model = Model(config={'widths': list(PRESETS[name][0]), 'depths': list(PRESETS[name][1])})
+        models.append(('preset:' + name, model))
+    val = load_val_subset(args.data_root, args.val_windows, args.seed, device) if args.modelDirs and args.val_windows else None
+
+    rows = []
+    print('{:<28} {:<20} {:<10} {:>9} {:>10} {:>8} {:>8}'.format('model', 'widths', 'depths', 'params M', '{} ms'.format(args.resolution), 'fps', 'psnr'))
+    for name, model in models:
+        model.eval()
+        net = model.flownet
+        config = net.config()
+        timings = bench_config(net, args.resolution, 1, 1.0, args.warmup, args.repeats)
+        ms = timings['end_to_end']['median_ms']
+        # Only the blocks and the encoder run at inference
+        params = sum(p.numel() for n, p in net.named_parameters() if not n.startswith(('teacher.', 'caltime.')))
+        row = {'model': name, 'widths': config['widths'], 'depths': config['depths'], 'params': params, 'ms': ms,
+               'psnr': psnr(model, *val, args.val_batch_size) if val is not None and not name.startswith('preset:') else None}
+        rows.append(row)
+        print('{:<28} {:<20} {:<10} {:>9.2f} {:>10.1f} {:>8.2f} {:>8}'.format(
+            name, ','.join(map(str, config['widths'])), ','.join(map(str, config['depths'])), params / 1e6, ms, 1000. / ms,
+            '{:.3f}'.format(row['psnr']) if row['psnr'] is not None else '-'))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+if __name__ == "__main__":
+    main()
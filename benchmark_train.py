@@ -0,0 +1,236 @@
+import os
+import sys
+import json
+import time
+import random
+import resource
+import argparse
+import subprocess
+import torch
+import numpy as np
+import torch.nn.functional as F
+from train_log.RIFE_HDv3 import Model
+from train import freeze_layers
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+# Model options compared by this benchmark
+VARIANTS = {
+    'baseline': {},
+    'amp': {'amp': True},
+    'amp_bf16': {'amp': True, 'amp_dtype': torch.bfloat16},
+    'ckpt_blocks01': {'checkpointing': '0,1'},
+    'ckpt_all': {'checkpointing': 'all'},
+    'ckpt_all_conv0': {'checkpointing': 'all:conv0'},
+    'sched_every2': {'loss_schedule': 'vgg=every:2,kpt=every:2'},
+    'sched_every4': {'loss_schedule': 'vgg=every:4,kpt=every:4'},
+    'sched_subset_half': {'loss_schedule': 'vgg=subset:0.5,kpt=subset:0.5'},
+    # block0 and block1 are frozen by --freeze
+    'frozen_prefix': {'frozen_prefix': 2},
+    'frozen_prefix_half': {'frozen_prefix': 2, 'prefix_dtype': torch.float16 if device.type == 'cuda' else torch.bfloat16},
+}
+# Exit status of a variant process that ran out of memory
+OOM_EXIT = 3
+
+
+def sync():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+def synthetic_batches(n, batch_size, crop, seed, max_shift=16):
+    """Fixed batches of smooth random textures under a known translation.
+
+    Frame 0, the middle frame and frame 1 are crops of the same texture
+    offset by 0, d/2 and d, so the task is learnable without a dataset.
+    """
+    g = torch.Generator().manual_seed(seed)
+    size = crop + 2 * max_shift
+    batches = []
+    for _ in range(n):
+        texture = F.interpolate(torch.rand(batch_size, 3, size // 8, size // 8, generator=g), size=(size, size),
+                                mode='bilinear', align_corners=False)
+        shift = torch.randint(-max_shift // 2, max_shift // 2 + 1, (batch_size, 2), generator=g) * 2
+        frames = []
+        for t in (0., 1., 0.5):
+            frames.append(torch.stack([
+                texture[b, :, max_shift + int(shift[b, 0] * t):max_shift + int(shift[b, 0] * t) + crop,
+                        max_shift + int(shift[b, 1] * t):max_shift + int(shift[b, 1] * t) + crop]
+                for b in range(batch_size)]))
+        batches.append(torch.cat(frames, 1))
+    return batches
+
+def dataset_batches(data_root, n, batch_size, crop, seed):
+    """Fixed batches drawn from the SportsSloMo training split."""
+    from dataset import SportsSloMoDataset
+    dataset = SportsSloMoDataset('train', data_root=data_root)
+    dataset.crop_h = dataset.crop_w = crop
+    indices = np.random.RandomState(seed).permutation(len(dataset))[:n * batch_size]
+    batches = []
+    for k in range(n):
+        samples = [dataset[int(i)][0] for i in indices[k * batch_size:(k + 1) * batch_size]]
+        batches.append(torch.stack(samples).float() / 255.)
+    return batches
+
+def peak_memory_mb():
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated() / 2 ** 20
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def build_model(args, options):
+    model = Model(**options)
+    if args.modelDir is not None:
+        model.load_model(args.modelDir, -1)
+    if options.get('frozen_prefix') and not args.freeze:
+        raise ValueError('the frozen_prefix variants need --freeze')
+    if args.freeze:
+        freeze_layers(model)
+        model.reset_optimizer()
+    return model
+
+def run_variant(args):
+    seed = args.seed
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    if args.data_root:
+        batches = dataset_batches(args.data_root, args.num_batches, args.batch_size, args.crop, seed)
+    else:
+        batches = synthetic_batches(args.num_batches, args.batch_size, args.crop, seed)
+    model = build_model(args, VARIANTS[args.variant])
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+
+    step_times = []
+    losses = []
+    for step in range(args.steps):
+        data_gpu = batches[step % len(batches)].to(device, non_blocking=True)
+        imgs = data_gpu[:, :6]
+        gt = data_gpu[:, 6:9]
+        sync()
+        time_stamp = time.perf_counter()
+        pred, info = model.update(imgs, gt, args.lr, training=True)
+        sync()
+        step_times.append(time.perf_counter() - time_stamp)
+        losses.append({name: info[name].item() for name in ['loss_l1', 'loss_smooth', 'loss_vgg', 'loss_kpt']})
+
+    timed = step_times[args.warmup:]
+    tail = losses[-max(1, args.steps // 5):]
+    return {
+        'variant': args.variant,
+        'options': {k: str(v) for k, v in VARIANTS[args.variant].items()},
+        'batch_size': args.batch_size,
+        'crop': args.crop,
+        'steps': args.steps,
+        'step_time_ms': float(np.median(timed) * 1000) if timed else None,
+        'samples_per_s': float(args.batch_size / np.median(timed)) if timed else None,
+        'peak_memory_mb': peak_memory_mb(),
+        'final_loss_l1': float(np.mean([l['loss_l1'] for l in tail])),
+        'loss_compute': model.loss_schedule.usage(),
+        'final_loss': float(np.mean([l['loss_l1'] + 0.1 * l['loss_smooth'] + l['loss_vgg'] + l['loss_kpt'] for l in tail])),
+        'losses': losses,
+    }
+
+def is_oom(e):
+    return 'out of memory' in str(e) or "can't allocate memory" in str(e)
+
+def variant_args(args, variant, output, **overrides):
+    cmd = [sys.executable, os.path.abspath(__file__), '--variant', variant, '--output', output]
+    for name in ['steps', 'warmup', 'batch_size', 'crop', 'num_batches', 'lr', 'seed']:
+        cmd += ['--' + name, str(overrides.get(name, getattr(args, name)))]
+    if args.data_root:
+        cmd += ['--data_root', args.data_root]
+    if args.modelDir:
+        cmd += ['--modelDir', args.modelDir]
+    if args.freeze:
+        cmd.append('--freeze')
+    return cmd
+
+def fits(args, variant, batch_size):
+    """Whether two training steps at batch_size run without running out of memory."""
+    output = '{}.{}.probe.tmp'.format(args.output, variant)
+    returncode = subprocess.call(variant_args(args, variant, output, batch_size=batch_size, steps=2, warmup=0, num_batches=1),
+                                 stdout=subprocess.DEVNULL)
+    if os.path.exists(output):
+        os.remove(output)
+    # The kernel OOM killer ends the process with SIGKILL
+    if returncode in (OOM_EXIT, -9):
+        return False
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, 'probe {} at batch {}'.format(variant, batch_size))
+    return True
+
+def largest_fitting(fits, start, limit):
+    """Largest batch size up to limit for which fits(batch_size) holds, by doubling from start and then bisection."""
+    good, bad = 0, None
+    batch_size = start
+    while batch_size <= limit:
+        if not fits(batch_size):
+            bad = batch_size
+            break
+        good = batch_size
+        batch_size *= 2
+    if bad is None:
+        bad = limit + 1
+    while bad - good > 1:
+        mid = (good + bad) // 2
+        if fits(mid):
+            good = mid
+        else:
+            bad = mid
+    return good
+
+def find_max_batch(args, variant):
+    return largest_fitting(lambda batch_size: fits(args, variant, batch_size), args.batch_size, args.max_batch)
+
+def compare(args):
+    """Run every variant in its own process, so peak memory is measured in isolation."""
+    results = []
+    for variant in args.variants.split(','):
+        output = '{}.{}.tmp'.format(args.output, variant)
+        subprocess.check_call(variant_args(args, variant, output))
+        with open(output) as f:
+            result = json.load(f)
+        os.remove(output)
+        if args.find_max_batch:
+            result['max_batch_size'] = find_max_batch(args, variant)
+        results.append(result)
+    print('{:<20} {:>12} {:>12} {:>14} {:>14} {:>12} {:>10}'.format('variant', 'step ms', 'samples/s', 'peak MB', 'final loss', 'final L1', 'max batch'))
+    for r in results:
+        print('{:<20} {:>12.1f} {:>12.2f} {:>14.1f} {:>14.4f} {:>12.4f} {:>10}'.format(
+            r['variant'], r['step_time_ms'], r['samples_per_s'], r['peak_memory_mb'], r['final_loss'], r['final_loss_l1'],
+            r.get('max_batch_size', '-')))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results written to {}'.format(args.output))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Training step benchmark on a fixed short schedule')
+    parser.add_argument('--variants', type=str, default='baseline,amp', help='comma-separated variants to compare: ' + ', '.join(VARIANTS))
+    parser.add_argument('--variant', type=str, default=None, help='run a single variant in this process')
+    parser.add_argument('--steps', type=int, default=100)
+    parser.add_argument('--warmup', type=int, default=5, help='steps excluded from timing')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--crop', type=int, default=256)
+    parser.add_argument('--num_batches', type=int, default=8, help='fixed batches cycled through the schedule')
+    parser.add_argument('--lr', type=float, default=1e-4)
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--data_root', type=str, default=None, help='use SportsSloMo frames instead of synthetic batches')
+    parser.add_argument('--modelDir', type=str, default=None, help='start from a checkpoint')
+    parser.add_argument('--freeze', action='store_true', help='freeze layers as train.py does')
+    parser.add_argument('--find_max_batch', action='store_true', help='also search for the largest batch size each variant fits')
+    parser.add_argument('--max_batch', type=int, default=256, help='upper bound of the batch size search')
+    parser.add_argument('--output', type=str, default='bench_train.json')
+    args = parser.parse_args()
+    if args.variant is not None:
+        try:
+            result = run_variant(args)
+        except RuntimeError as e:
+            if not is_oom(e):
+                raise
+            print('{} ran out of memory at batch {}'.format(args.variant, args.batch_size))
+            sys.exit(OOM_EXIT)
+        with open(args.output, 'w') as f:
+            json.dump(result, f)
+    else:
+        compare(args)
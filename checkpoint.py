@@ -0,0 +1,154 @@
+import os
+import re
+import inspect
+import random
+import threading
+import torch
+import numpy as np
+from torch.utils.data import Dataset
+from torch.utils.data.distributed import DistributedSampler
+
+
+def snapshot(obj):
+    """Deep copy of nested dicts/lists/tuples with every tensor cloned to CPU."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+def rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if torch.cuda.is_available() and 'cuda' in state:
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class CheckpointManager:
+    """Step-interval training checkpoints written by a background thread.
+
+    save() snapshots the state to CPU memory before returning, so training
+    can carry on while the snapshot is written. Files are written to a
+    temporary name and renamed, so a crash never leaves a truncated
+    checkpoint, and only the newest `keep` checkpoints are retained. At most
+    one write is in flight; a save while the previous one is still being
+    written waits for it.
+    """
+    pattern = re.compile(r'^ckpt_(\d+)\.pt$')
+
+    def __init__(self, directory, keep=3):
+        self.directory = directory
+        self.keep = keep
+        self.thread = None
+        self.error = None
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, step):
+        return os.path.join(self.directory, 'ckpt_{:08d}.pt'.format(step))
+
+    def checkpoints(self):
+        """(step, path) of every complete checkpoint, oldest first."""
+        found = []
+        for name in os.listdir(self.directory):
+            match = self.pattern.match(name)
+            if match:
+                found.append((int(match.group(1)), os.path.join(self.directory, name)))
+        return sorted(found)
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1][1] if checkpoints else None
+
+    def save(self, step, state):
+        state = snapshot(state)
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=(step, state), daemon=True)
+        self.thread.start()
+
+    def _write(self, step, state):
+        try:
+            path = self.path(step)
+            torch.save(state, path + '.tmp')
+            os.replace(path + '.tmp', path)
+            for _, old in self.checkpoints()[:-self.keep] if self.keep > 0 else []:
+                os.remove(old)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('writing a checkpoint failed') from error
+
+    def load(self, path):
+        # Checkpoints hold RNG states and optimizer state, not only tensors. torch 2.6 defaults
+        # to weights_only=True and would reject them; torch before 1.13 has no such argument
+        if 'weights_only' in inspect.signature(torch.load).parameters:
+            return torch.load(path, map_location='cpu', weights_only=False)
+        return torch.load(path, map_location='cpu')
+
+
+class ResumableSampler(DistributedSampler):
+    """DistributedSampler that can start an epoch part-way through.
+
+    With a single replica and shuffle=False it yields 0..n-1 in order, like
+    a DataLoader without a sampler.
+    """
+    def __init__(self, dataset, num_replicas=1, rank=0, shuffle=True, seed=0):
+        super(ResumableSampler, self).__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed)
+        self.start = 0
+
+    def set_position(self, epoch, start=0):
+        """Iterate epoch from its start-th sample of this replica."""
+        self.set_epoch(epoch)
+        self.start = start
+
+    def __iter__(self):
+        return iter(list(super(ResumableSampler, self).__iter__())[self.start:])
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+
+class SeededDataset(Dataset):
+    """Seeds python, numpy and torch from (seed, epoch, index) before every sample.
+
+    Random crops and augmentations then depend only on which sample is
+    drawn in which epoch, not on worker assignment or on how many samples
+    came before, so a resumed run sees the same data.
+    """
+    def __init__(self, dataset, seed):
+        self.dataset = dataset
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        # A curriculum passes (index, crop_h, crop_w)
+        key = index[0] if isinstance(index, tuple) else index
+        seed = int(np.random.SeedSequence([self.seed, self.epoch, key]).generate_state(1)[0])
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        return self.dataset[index]
@@ -0,0 +1,62 @@
+import torch
+from torch.utils.data import Sampler
+
+
+def parse_curriculum(spec, batch_size, crop):
+    """Parse 'step:crop[:batch],...' into [(start_step, crop, batch), ...] sorted by step.
+
+    A stage without a batch size keeps the pixels per batch of the full
+    crop at batch_size, e.g. 256 crops get (640 / 256) ** 2 times the batch.
+    """
+    stages = []
+    for entry in spec.split(','):
+        fields = [int(v) for v in entry.split(':')]
+        if len(fields) == 2:
+            fields.append(max(1, int(round(batch_size * (crop / fields[1]) ** 2))))
+        start, size, batch = fields
+        if size % 32 != 0:
+            raise ValueError('curriculum crop {} is not a multiple of 32'.format(size))
+        stages.append((start, size, batch))
+    stages.sort()
+    if stages[0][0] != 0:
+        raise ValueError('the first curriculum stage must start at step 0')
+    return stages
+
+def stage_at(stages, step):
+    stage = stages[0]
+    for s in stages:
+        if s[0] <= step:
+            stage = s
+    return stage
+
+
+class CurriculumBatchSampler(Sampler):
+    """Batches of (index, crop_h, crop_w) whose crop and size follow the stage of each step.
+
+    Indices come from sampler in its order, so a ResumableSampler keeps
+    handling epochs and resume positions. The step count advances with every
+    batch yielded, starting from start_step; the last incomplete batch of an
+    epoch is dropped.
+    """
+    def __init__(self, sampler, stages, start_step=0):
+        self.sampler = sampler
+        self.stages = stages
+        self.step = start_step
+
+    def __iter__(self):
+        indices = iter(self.sampler)
+        while True:
+            _, crop, batch_size = stage_at(self.stages, self.step)
+            batch = []
+            for index in indices:
+                batch.append((index, crop, crop))
+                if len(batch) == batch_size:
+                    break
+            if len(batch) < batch_size:
+                return
+            self.step += 1
+            yield batch
+
+    def __len__(self):
+        # Exact when no stage boundary falls in the epoch, an estimate otherwise
+        return len(self.sampler) // stage_at(self.stages, self.step)[2]
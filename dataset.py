@@ -115,17 +115,22 @@ import torch
 import numpy as np
 import random
 from glob import glob
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, IterableDataset, get_worker_info
+from heatmap_cache import HeatmapCache, flip_heatmaps, rot90_heatmaps
+from shards import ShardStore
+from checkpoint import SeededDataset, rng_state, set_rng_state
 
 cv2.setNumThreads(0)
 
 
 class SportsSloMoDataset(Dataset):
-    def __init__(self, dataset_name, data_root, batch_size=32, has_aug=True):
+    def __init__(self, dataset_name, data_root, batch_size=32, has_aug=True, heatmap_root=None):
         self.batch_size = batch_size
         self.dataset_name = dataset_name
         self.data_root = data_root
         self.has_aug = has_aug
+        # With cached ground-truth heatmaps, crops snap to the grid they were extracted for
+        self.heatmaps = HeatmapCache(heatmap_root) if heatmap_root else None
         self.crop_h = 640
         self.crop_w = 640
         self.image_root = self.data_root
@@ -155,10 +160,13 @@ class SportsSloMoDataset(Dataset):
             self.meta_data = self.testlist
 
 
-    def aug(self, img0, gt, img1, h, w):
+    def aug(self, img0, gt, img1, h, w, origin=None):
         ih, iw, _ = img0.shape
-        x = np.random.randint(0, ih - h + 1)
-        y = np.random.randint(0, iw - w + 1)
+        if origin is not None:
+            x, y = origin
+        else:
+            x = np.random.randint(0, ih - h + 1)
+            y = np.random.randint(0, iw - w + 1)
         img0 = img0[x:x+h, y:y+w, :]
         img1 = img1[x:x+h, y:y+w, :]
         gt = gt[x:x+h, y:y+w, :]
@@ -187,13 +195,28 @@ class SportsSloMoDataset(Dataset):
         gt = cv2.imread(imgpath_target)
         img1 = cv2.imread(imgpath_8)
 
-        return img0, gt, img1, t_interp
+        return img0, gt, img1, t_interp, self.meta_data[base_idx + target_idx]
 
     def __getitem__(self, index):
-        img0, gt, img1, t_interp = self.getimg(index)
-        img0, gt, img1 = self.aug(img0, gt, img1, self.crop_h, self.crop_w)
+        # A crop curriculum passes (index, crop_h, crop_w) instead of an index
+        crop_h, crop_w = self.crop_h, self.crop_w
+        if isinstance(index, tuple):
+            index, crop_h, crop_w = index
+        img0, gt, img1, t_interp, gt_path = self.getimg(index)
+        return self.transform(img0, gt, img1, t_interp, gt_path, crop_h, crop_w)
+
+    def transform(self, img0, gt, img1, t_interp, gt_path, crop_h, crop_w):
+        """Crop and augment one decoded triplet into the training sample."""
+        heatmap = None
+        if self.heatmaps is not None:
+            origin = self.heatmaps.random_crop(gt_path.split('/')[0], crop_h, crop_w)
+            heatmap = self.heatmaps.read(gt_path, *origin)
+            img0, gt, img1 = self.aug(img0, gt, img1, crop_h, crop_w, origin)
+        else:
+            img0, gt, img1 = self.aug(img0, gt, img1, crop_h, crop_w)
         if self.dataset_name == 'train':
             if self.has_aug:
+                # Swapping colour channels leaves the cached heatmap as it is
                 if random.uniform(0, 1) < 0.5:
                     img0 = img0[:, :, ::-1]
                     img1 = img1[:, :, ::-1]
@@ -202,21 +225,152 @@ class SportsSloMoDataset(Dataset):
                     img0 = img0[::-1]
                     img1 = img1[::-1]
                     gt = gt[::-1]
+                    if heatmap is not None:
+                        heatmap = flip_heatmaps(heatmap, 1)
                 if random.uniform(0, 1) < 0.5:
                     img0 = img0[:, ::-1]
                     img1 = img1[:, ::-1]
                     gt = gt[:, ::-1]
+                    if heatmap is not None:
+                        heatmap = flip_heatmaps(heatmap, 2)
                 if random.uniform(0, 1) < 0.5:
                     rot_option = np.random.randint(1, 4)
                     img0 = np.rot90(img0, rot_option)
                     img1 = np.rot90(img1, rot_option)
                     gt = np.rot90(gt, rot_option)
+                    if heatmap is not None:
+                        heatmap = rot90_heatmaps(heatmap, rot_option, crop_h, crop_w)
             
         img0 = torch.from_numpy(img0.copy()).permute(2, 0, 1)
         img1 = torch.from_numpy(img1.copy()).permute(2, 0, 1)
         gt = torch.from_numpy(gt.copy()).permute(2, 0, 1)
+        if heatmap is not None:
+            return torch.cat((img0, img1, gt), 0), t_interp, torch.from_numpy(heatmap)
         return torch.cat((img0, img1, gt), 0), t_interp
 
+def load_val_subset(data_root, num_windows, seed, device):
+    """A fixed set of validation samples, decoded once and kept on the device as uint8."""
+    dataset = SeededDataset(SportsSloMoDataset('validation', data_root=data_root), seed)
+    indices = np.linspace(0, len(dataset) - 1, min(num_windows, len(dataset))).astype(int)
+    # Seeding the crops reseeds this process, leave the caller's RNG as it was
+    state = rng_state()
+    samples = [dataset[int(i)] for i in indices]
+    set_rng_state(state)
+    frames = torch.stack([s[0] for s in samples]).to(device)
+    timesteps = torch.stack([s[1] for s in samples]).float().to(device)
+    return frames, timesteps
+
+class ShardedSportsSloMoDataset(IterableDataset):
+    """Training windows streamed from the sequential shards written by make_shards.py.
+
+    Each epoch the shards are shuffled with (seed, epoch), dealt to the ranks
+    and then to the DataLoader workers of each rank, and every worker reads
+    its shards front to back through a shuffle buffer. Every rank yields the
+    same number of full batches, so DDP ranks stay in step; the windows that
+    do not fit, at most about one shard per rank, rotate with the shuffle.
+    Augmentation is seeded from (seed, epoch, window), as in SeededDataset,
+    and set_position() skips already-trained batches without decoding them,
+    so a resumed run sees the same data.
+    """
+    def __init__(self, shard_root, batch_size, num_workers=0, num_replicas=1, rank=0,
+                 shuffle_buffer=256, seed=0, has_aug=True, heatmap_root=None):
+        self.store = ShardStore(shard_root)
+        self.shards = self.store.shards()
+        self.batch_size = batch_size
+        self.num_workers = max(num_workers, 1)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.dataset_name = 'train'
+        self.has_aug = has_aug
+        self.heatmaps = HeatmapCache(heatmap_root) if heatmap_root else None
+        self.crop_h = 640
+        self.crop_w = 640
+        self.interp_factor = 8
+        self.epoch = 0
+        self.start = 0
+        shards_per_rank = len(self.shards) // num_replicas
+        if shards_per_rank == 0:
+            raise ValueError('{} shards cannot be split over {} ranks'.format(len(self.shards), num_replicas))
+        # Whatever the shuffle, a rank gets at least the shards_per_rank smallest shards, and each
+        # of its workers may lose a partial batch
+        sizes = sorted(len(index['windows']) for _, index in self.shards)
+        self.num_batches = max(sum(sizes[:shards_per_rank]) - self.num_workers * (batch_size - 1), 0) // batch_size
+        self.num_samples = self.num_batches * batch_size
+
+    transform = SportsSloMoDataset.transform
+    aug = SportsSloMoDataset.aug
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_position(self, epoch, start=0):
+        """Iterate epoch from its start-th sample of this rank."""
+        self.epoch = epoch
+        self.start = start
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+    def plan(self):
+        """Shards, batch count and skipped batches of every worker of this rank for the epoch."""
+        order = np.random.default_rng([self.seed, self.epoch]).permutation(len(self.shards))
+        mine = [self.shards[k] for k in order[self.rank::self.num_replicas]]
+        shards = [mine[w::self.num_workers] for w in range(self.num_workers)]
+        batches = [sum(len(index['windows']) for _, index in s) // self.batch_size for s in shards]
+        while sum(batches) > self.num_batches:
+            batches[int(np.argmax(batches))] -= 1
+        # The DataLoader takes batches from the workers in turn, skipping exhausted ones
+        skipped = [0] * self.num_workers
+        remaining = list(batches)
+        to_skip = min(self.start // self.batch_size, sum(batches))
+        while to_skip > 0:
+            for w in range(self.num_workers):
+                if remaining[w] > 0 and to_skip > 0:
+                    remaining[w] -= 1
+                    skipped[w] += 1
+                    to_skip -= 1
+        return shards, batches, skipped
+
+    def windows(self, shards, rng):
+        """(window, encoded frames) of the shards in reading order, through the shuffle buffer."""
+        buffer = []
+        for shard, index in shards:
+            for item in self.store.read(shard, index['windows']):
+                buffer.append(item)
+                if len(buffer) >= self.shuffle_buffer:
+                    k = rng.integers(len(buffer))
+                    buffer[k], buffer[-1] = buffer[-1], buffer[k]
+                    yield buffer.pop()
+        for k in rng.permutation(len(buffer)):
+            yield buffer[k]
+
+    def __iter__(self):
+        info = get_worker_info()
+        worker, num_workers = (info.id, info.num_workers) if info is not None else (0, 1)
+        if num_workers != self.num_workers:
+            raise ValueError('dataset was built for {} workers, the DataLoader has {}'.format(self.num_workers, num_workers))
+        shards, batches, skipped = self.plan()
+        rng = np.random.default_rng([self.seed, self.epoch, self.rank, worker])
+        count = 0
+        for window, frames in self.windows(shards[worker], rng):
+            if count == batches[worker] * self.batch_size:
+                return
+            count += 1
+            if count > skipped[worker] * self.batch_size:
+                yield self.sample(window, frames)
+
+    def sample(self, window, frames):
+        seed = int(np.random.SeedSequence([self.seed, self.epoch, window['id']]).generate_state(1)[0])
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        target_idx = np.random.randint(1, 8)
+        img0, gt, img1 = (cv2.imdecode(np.frombuffer(frames[k], np.uint8), cv2.IMREAD_COLOR) for k in (0, target_idx, 8))
+        t_interp = torch.Tensor([target_idx]).view(1, 1, 1) / self.interp_factor
+        return self.transform(img0, gt, img1, t_interp, window['paths'][target_idx], self.crop_h, self.crop_w)
+
 if  __name__ == "__main__":
     pass
 
@@ -0,0 +1,77 @@
+import math
+import cv2
+import torch
+import numpy as np
+from skimage.color import rgb2yuv
+from skimage.metrics import structural_similarity as ssim
+
+# LPIPS pulls in a pretrained AlexNet, so it is only built by the processes that need it
+loss_fn_alex = None
+
+
+def load_frame(path):
+    """Load and preprocess a frame."""
+    frame = cv2.imread(path)
+    if frame is None:
+        raise ValueError(f"Failed to load frame: {path}")
+    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    return frame
+
+def calculate_psnr(pred_frame, gt_frame):
+    """Calculate PSNR between predicted and ground truth frames."""
+    pred_yuv = rgb2yuv(pred_frame / 255.)[:, :, 0] * 255
+    gt_yuv = rgb2yuv(gt_frame / 255.)[:, :, 0] * 255
+    diff_yuv = 128.0 + gt_yuv - pred_yuv
+    mse = np.mean((diff_yuv - 128.0) ** 2)
+    PIXEL_MAX = 255.0
+    return 20 * math.log10(PIXEL_MAX / math.sqrt(mse))
+
+def calculate_ssim(img1, img2):
+    """Calculate SSIM (Structural Similarity Index) between two loaded images."""
+    if isinstance(img1, torch.Tensor):
+        img1 = img1.cpu().numpy().transpose(1, 2, 0)
+    if isinstance(img2, torch.Tensor):
+        img2 = img2.cpu().numpy().transpose(1, 2, 0)
+    img1 = img1.astype(float) / 255 if img1.max() > 1 else img1
+    img2 = img2.astype(float) / 255 if img2.max() > 1 else img2
+    return ssim(img1, img2, data_range=1.0, channel_axis=2, multichannel=True)
+
+def calculate_lpips(img1, img2):
+    """Calculate LPIPS between two loaded images."""
+    global loss_fn_alex
+    if loss_fn_alex is None:
+        import lpips
+        loss_fn_alex = lpips.LPIPS(net='alex', verbose=False)
+    if not isinstance(img1, torch.Tensor):
+        img1 = torch.from_numpy(img1).permute(2, 0, 1).float()
+    if not isinstance(img2, torch.Tensor):
+        img2 = torch.from_numpy(img2).permute(2, 0, 1).float()
+    img1 = img1 * 2 - 1
+    img2 = img2 * 2 - 1
+    if img1.dim() == 3:
+        img1 = img1.unsqueeze(0)
+    if img2.dim() == 3:
+        img2 = img2.unsqueeze(0)
+    with torch.no_grad():
+        lpips_value = loss_fn_alex(img1, img2)
+    return lpips_value.item()
+
+def calculate_ie(pred, gt):
+    """Calculate Interpolation Error (mean absolute error in [0, 255])."""
+    if isinstance(pred, torch.Tensor):
+        pred = pred.cpu().numpy()
+    if isinstance(gt, torch.Tensor):
+        gt = gt.cpu().numpy()
+    if pred.max() <= 1.0:
+        pred = pred * 255.0
+    if gt.max() <= 1.0:
+        gt = gt * 255.0
+    diff = np.abs(pred.astype(np.float32) - gt.astype(np.float32))
+    return np.mean(diff)
+
+METRIC_FNS = {
+    'psnr': calculate_psnr,
+    'lpips': calculate_lpips,
+    'ssim': calculate_ssim,
+    'ie': calculate_ie,
+}
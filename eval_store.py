@@ -0,0 +1,189 @@
+import os
+import sqlite3
+import hashlib
+import argparse
+import cv2
+import numpy as np
+
+METRICS = ['psnr', 'lpips', 'ssim', 'ie']
+# How the intermediate frames were predicted: SportsSloMo_multi_*x.py recurses at t=0.5,
+# SportsSloMo_eval.py predicts every t=j/factor directly
+SCHEMES = ['recursive', 'direct']
+
+
+def checkpoint_hash(model_dir):
+    """Content hash of the flownet checkpoint in model_dir."""
+    h = hashlib.sha256()
+    with open(os.path.join(model_dir, 'flownet.pkl'), 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def parse_clips(spec):
+    """Parse a clip selection such as '7235-7300,7400' into a list of clip numbers."""
+    clips = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            clips.extend(range(int(start), int(end) + 1))
+        else:
+            clips.append(int(part))
+    return clips
+
+
+class EvalStore:
+    """Evaluation records keyed by (checkpoint hash, interpolation factor, clip, window, timestep).
+
+    Metric values and the predicted frames they were computed from are stored
+    separately, so a rerun with a different metric set rescores cached
+    predictions instead of running the network again. Predictions are kept
+    as PNG so the cached uint8 frame is exactly the one that was scored.
+
+    Each store handle reads and writes one prediction scheme, so frames
+    predicted recursively and directly never share a record even though
+    their keys are the same.
+    """
+    def __init__(self, path, scheme='recursive'):
+        if scheme not in SCHEMES:
+            raise ValueError(f"Unknown prediction scheme {scheme!r}, expected one of {SCHEMES}")
+        self.path = path
+        self.scheme = scheme
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS predictions ('
+            'ckpt TEXT, factor INTEGER, scheme TEXT, clip INTEGER, window INTEGER, timestep INTEGER, frame BLOB, '
+            'PRIMARY KEY (ckpt, factor, scheme, clip, window, timestep))')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS metrics ('
+            'ckpt TEXT, factor INTEGER, scheme TEXT, clip INTEGER, window INTEGER, timestep INTEGER, metric TEXT, value REAL, '
+            'PRIMARY KEY (ckpt, factor, scheme, clip, window, timestep, metric))')
+        self.conn.commit()
+        for table in ['predictions', 'metrics']:
+            columns = [row[1] for row in self.conn.execute(f'PRAGMA table_info({table})')]
+            if 'scheme' not in columns:
+                raise ValueError(f"{path} predates prediction schemes and may mix recursive and direct "
+                                 "predictions; use a new store")
+
+    def _row(self, key):
+        # Key tuples leave out the scheme, it is fixed per handle
+        ckpt, factor, clip, window, timestep = key
+        return (ckpt, factor, self.scheme, clip, window, timestep)
+
+    def get_metrics(self, key):
+        rows = self.conn.execute(
+            'SELECT metric, value FROM metrics WHERE ckpt=? AND factor=? AND scheme=? AND clip=? AND window=? AND timestep=?',
+            self._row(key)).fetchall()
+        return dict(rows)
+
+    def put_metrics(self, key, values):
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [self._row(key) + (name, float(value)) for name, value in values.items()])
+
+    def clip_metrics(self, ckpt, factor, clip):
+        """All stored metric values of one clip, as {(window, timestep): {metric: value}}."""
+        records = {}
+        rows = self.conn.execute(
+            'SELECT window, timestep, metric, value FROM metrics WHERE ckpt=? AND factor=? AND scheme=? AND clip=?',
+            (ckpt, factor, self.scheme, clip))
+        for window, timestep, name, value in rows:
+            records.setdefault((window, timestep), {})[name] = value
+        return records
+
+    def get_prediction(self, key):
+        row = self.conn.execute(
+            'SELECT frame FROM predictions WHERE ckpt=? AND factor=? AND scheme=? AND clip=? AND window=? AND timestep=?',
+            self._row(key)).fetchone()
+        if row is None:
+            return None
+        frame = cv2.imdecode(np.frombuffer(row[0], np.uint8), cv2.IMREAD_UNCHANGED)
+        return frame[:, :, ::-1]
+
+    def put_prediction(self, key, frame):
+        # Frames are RGB uint8; PNG stores BGR
+        ok, buf = cv2.imencode('.png', np.ascontiguousarray(frame[:, :, ::-1]))
+        if not ok:
+            raise ValueError(f"Failed to encode prediction {key}")
+        self.conn.execute('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?, ?)',
+                          self._row(key) + (sqlite3.Binary(buf.tobytes()),))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def checkpoints(self):
+        return self.conn.execute(
+            'SELECT ckpt, factor, COUNT(DISTINCT clip), COUNT(*) FROM metrics WHERE scheme=? GROUP BY ckpt, factor',
+            (self.scheme,)).fetchall()
+
+    def resolve(self, prefix):
+        """Expand a checkpoint hash prefix to the full stored hash."""
+        rows = self.conn.execute('SELECT DISTINCT ckpt FROM metrics WHERE ckpt LIKE ? AND scheme=?',
+                                 (prefix + '%', self.scheme)).fetchall()
+        if len(rows) != 1:
+            raise ValueError(f"Checkpoint prefix {prefix!r} matches {len(rows)} stored checkpoints")
+        return rows[0][0]
+
+    def summary(self, ckpt, factor, clips=None, metrics=METRICS):
+        """Aggregate stored records the same way the benchmark scripts do.
+
+        Values are averaged per clip first and then across clips. Returns a
+        dict mapping each metric to (overall mean, number of clips).
+        """
+        result = {}
+        for name in metrics:
+            rows = self.conn.execute(
+                'SELECT clip, AVG(value) FROM metrics WHERE ckpt=? AND factor=? AND scheme=? AND metric=? GROUP BY clip',
+                (ckpt, factor, self.scheme, name)).fetchall()
+            if clips is not None:
+                selected = set(clips)
+                rows = [r for r in rows if r[0] in selected]
+            if rows:
+                result[name] = (float(np.mean([r[1] for r in rows])), len(rows))
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarise stored evaluation results')
+    parser.add_argument('--db', type=str, required=True, help='evaluation store written by the benchmark scripts')
+    parser.add_argument('--modelDir', type=str, default=None, help='checkpoint directory to summarise')
+    parser.add_argument('--ckpt', type=str, default=None, help='checkpoint hash (or unique prefix) to summarise')
+    parser.add_argument('--factor', type=int, default=None, help='interpolation factor')
+    parser.add_argument('--clips', type=str, default=None, help="clip subset, e.g. '7235-7300,7400'")
+    parser.add_argument('--metrics', type=str, default=','.join(METRICS))
+    parser.add_argument('--scheme', type=str, default='recursive', choices=SCHEMES,
+                        help='recursive for SportsSloMo_multi_*x.py results, direct for SportsSloMo_eval.py')
+    args = parser.parse_args()
+
+    store = EvalStore(args.db, args.scheme)
+    if args.modelDir is not None:
+        ckpt = checkpoint_hash(args.modelDir)
+    elif args.ckpt is not None:
+        ckpt = store.resolve(args.ckpt)
+    else:
+        for ckpt, factor, n_clips, n_records in store.checkpoints():
+            print(f"{ckpt[:16]}  {factor}x {args.scheme}  clips: {n_clips}  records: {n_records}")
+        return
+
+    factors = [args.factor] if args.factor is not None else sorted({f for c, f, _, _ in store.checkpoints() if c == ckpt})
+    clips = parse_clips(args.clips) if args.clips else None
+    for factor in factors:
+        summary = store.summary(ckpt, factor, clips, args.metrics.split(','))
+        print(f"Checkpoint {ckpt[:16]} at {factor}x ({args.scheme})")
+        if not summary:
+            print("No stored results")
+        for name, (value, n_clips) in summary.items():
+            print(f"Overall Average {name.upper()}: {value:.4f} ({n_clips} clips)")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
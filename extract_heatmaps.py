@@ -0,0 +1,74 @@
+import os
+import cv2
+import time
+import argparse
+import torch
+import numpy as np
+from collections import OrderedDict
+from heatmap_cache import HeatmapCache, crop_grid
+from model.heatmap_loss import HeatmapInfer
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def target_frames(split_file):
+    """Frames that can be the ground truth of a training sample, grouped by clip.
+
+    The split lists 9-frame windows; the middle 7 frames of each are targets.
+    """
+    with open(split_file, 'r') as f:
+        lines = f.read().splitlines()
+    clips = OrderedDict()
+    for k, line in enumerate(lines):
+        if k % 9 in (0, 8):
+            continue
+        clip, frame = line.split('/')
+        frames = clips.setdefault(clip, [])
+        if frame not in frames:
+            frames.append(frame)
+    return clips
+
+def extract_clip(infer, cache, args, clip, frames):
+    first = cv2.imread(os.path.join(args.data_root, clip, frames[0]))
+    ih, iw, _ = first.shape
+    ys = crop_grid(ih, args.crop_h, args.stride)
+    xs = crop_grid(iw, args.crop_w, args.stride)
+    with cache.writer(clip, frames, args.crop_h, args.crop_w, ys, xs) as writer:
+        for k, frame in enumerate(frames):
+            img = cv2.imread(os.path.join(args.data_root, clip, frame))
+            crops = np.stack([img[y:y+args.crop_h, x:x+args.crop_w] for y in ys for x in xs])
+            crops = torch.from_numpy(crops).permute(0, 3, 1, 2)
+            heatmaps = []
+            for b in range(0, len(crops), args.batch_size):
+                batch = crops[b:b+args.batch_size].to(device, non_blocking=True).float() / 255.
+                with torch.no_grad():
+                    heatmaps.append(infer.heatmaps(batch).float().cpu())
+            writer.add(k, torch.cat(heatmaps).numpy())
+    return len(ys) * len(xs)
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute ground-truth ViTPose heatmaps for the human-aware loss')
+    parser.add_argument('--data_root', type=str, default='/scratch/rrm9598/hpml/acv/SportsSloMo/SportsSloMo_frames/')
+    parser.add_argument('--output', type=str, required=True, help='heatmap cache directory, passed to train.py --heatmap_root')
+    parser.add_argument('--split', type=str, default='./splits/vfi_train.txt')
+    parser.add_argument('--crop_h', type=int, default=640, help='training crop height')
+    parser.add_argument('--crop_w', type=int, default=640, help='training crop width')
+    parser.add_argument('--stride', type=int, default=160, help='spacing of the crop grid in pixels')
+    parser.add_argument('--batch_size', type=int, default=16, help='crops per ViTPose forward')
+    parser.add_argument('--shard', type=str, default='0/1', help='i/n: process every n-th clip starting at i')
+    args = parser.parse_args()
+
+    shard, num_shards = (int(v) for v in args.shard.split('/'))
+    clips = list(target_frames(args.split).items())[shard::num_shards]
+    cache = HeatmapCache(args.output)
+    infer = HeatmapInfer().eval()
+    for n, (clip, frames) in enumerate(clips):
+        # Clip files only appear once complete, so an interrupted run resumes here
+        if cache.has_clip(clip):
+            continue
+        time_stamp = time.time()
+        num_crops = extract_clip(infer, cache, args, clip, frames)
+        print('{}/{} {}: {} frames x {} crops in {:.1f}s'.format(n + 1, len(clips), clip, len(frames), num_crops, time.time() - time_stamp))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import time
+import argparse
+import torch
+from torch.utils.data import DataLoader, Dataset
+from torch.utils.data.dataloader import default_collate
+from smpl_cache import SMPLCache
+from trainft import TripletDataset, generate_smpl_params
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+class IndexedDataset(Dataset):
+    """Pairs every TripletDataset item with its index, so results stay tied to dataset.samples."""
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        return idx, self.dataset[idx]
+
+def collate_readable(batch):
+    """(loaded indices, failed indices, collated items); TripletDataset returns None on a load error."""
+    kept = [(idx, item) for idx, item in batch if item is not None]
+    failed = [idx for idx, item in batch if item is None]
+    if not kept:
+        return [], failed, None
+    return [idx for idx, _ in kept], failed, default_collate([item for _, item in kept])
+
+def main():
+    parser = argparse.ArgumentParser(description='Run SMPLer-X once on every ground-truth frame for trainft.py --smpl_cache')
+    parser.add_argument('--root_dir', type=str, default='./ValidationTriplets')
+    parser.add_argument('--start_clip', type=int, default=6235)
+    parser.add_argument('--end_clip', type=int, default=6285)
+    parser.add_argument('--output', type=str, required=True, help='HDF5 file, e.g. smpl_gt.h5')
+    parser.add_argument('--batch_size', type=int, default=4, help='frames per SMPLer-X forward')
+    parser.add_argument('--num_workers', type=int, default=4)
+    args = parser.parse_args()
+
+    dataset = TripletDataset(args.root_dir, start_clip=args.start_clip, end_clip=args.end_clip)
+    loader = DataLoader(IndexedDataset(dataset), batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers,
+                        collate_fn=collate_readable)
+    time_stamp = time.time()
+    done = 0
+    skipped = []
+    # Written to a temporary file and renamed, so a partial cache is never picked up
+    with SMPLCache(args.output).writer() as writer:
+        for indices, failed, batch in loader:
+            done += len(indices) + len(failed)
+            skipped.extend(dataset.samples[i] for i in failed)
+            if batch is None:
+                continue
+            data, gt = batch
+            writer.add([dataset.samples[i] for i in indices], generate_smpl_params(gt.to(device)))
+            print('{}/{} triplets, {:.1f}s'.format(done, len(dataset), time.time() - time_stamp))
+    # Unreadable triplets are left out of the cache, trainft.py fails to load them as well
+    if skipped:
+        print('skipped {} unreadable triplets: {}'.format(len(skipped), ', '.join(skipped)))
+
+if __name__ == "__main__":
+    main()
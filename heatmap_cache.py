@@ -0,0 +1,135 @@
+import os
+import cv2
+import h5py
+import random
+import numpy as np
+
+# COCO keypoints swapped by a mirror image: eyes, ears, shoulders, elbows, wrists, hips, knees, ankles
+FLIP_PAIRS = [(1, 2), (3, 4), (5, 6), (7, 8), (9, 10), (11, 12), (13, 14), (15, 16)]
+
+
+def crop_grid(size, crop, stride):
+    """Crop offsets along one axis, every stride pixels and always including the last one."""
+    offsets = list(range(0, size - crop + 1, stride))
+    if offsets[-1] != size - crop:
+        offsets.append(size - crop)
+    return offsets
+
+def quantize(heatmaps):
+    """uint8 heatmaps with a per-joint affine range, over the last two axes."""
+    low = heatmaps.min(axis=(-2, -1))
+    scale = np.maximum(heatmaps.max(axis=(-2, -1)) - low, 1e-8)
+    q = np.rint((heatmaps - low[..., None, None]) / scale[..., None, None] * 255)
+    return q.astype(np.uint8), low.astype(np.float32), scale.astype(np.float32)
+
+def dequantize(q, low, scale):
+    return q.astype(np.float32) / 255 * scale[..., None, None] + low[..., None, None]
+
+def flip_heatmaps(heatmaps, axis):
+    """Heatmaps of a mirrored image: flip the map and swap left and right joints."""
+    heatmaps = np.flip(heatmaps, axis).copy()
+    for a, b in FLIP_PAIRS:
+        heatmaps[[a, b]] = heatmaps[[b, a]]
+    return heatmaps
+
+def rot90_heatmaps(heatmaps, k, crop_h, crop_w):
+    """Heatmaps of an np.rot90(img, k) crop.
+
+    The pose network sees every crop resized to its fixed input size, so the
+    map is resampled to the crop's aspect ratio, rotated and resampled back.
+    """
+    j, h, w = heatmaps.shape
+    ah = h
+    aw = int(round(h * crop_w / crop_h))
+    hwc = cv2.resize(heatmaps.transpose(1, 2, 0), (aw, ah), interpolation=cv2.INTER_LINEAR).reshape(ah, aw, j)
+    hwc = np.ascontiguousarray(np.rot90(hwc, k))
+    return cv2.resize(hwc, (w, h), interpolation=cv2.INTER_LINEAR).reshape(h, w, j).transpose(2, 0, 1)
+
+
+class HeatmapCache:
+    """Ground-truth pose heatmaps for a grid of crops of every target frame, one HDF5 file per clip.
+
+    Heatmaps are stored as uint8 with a per-joint offset and scale, chunked
+    per frame and crop. The crop grid is stored with each clip, so a dataset
+    can only draw crops whose heatmaps are known.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.files = {}
+
+    def path(self, clip):
+        return os.path.join(self.root, f'{clip}.h5')
+
+    def has_clip(self, clip):
+        return os.path.exists(self.path(clip))
+
+    def writer(self, clip, frames, crop_h, crop_w, ys, xs):
+        os.makedirs(self.root, exist_ok=True)
+        return HeatmapWriter(self.path(clip), frames, crop_h, crop_w, ys, xs)
+
+    def _open(self, clip):
+        # Opened lazily so every DataLoader worker gets its own handle
+        if clip not in self.files:
+            f = h5py.File(self.path(clip), 'r')
+            index = {name.decode(): k for k, name in enumerate(f['frames'][:])}
+            self.files[clip] = (f, index)
+        return self.files[clip]
+
+    def grid(self, clip):
+        f, _ = self._open(clip)
+        return int(f.attrs['crop_h']), int(f.attrs['crop_w']), list(f.attrs['ys']), list(f.attrs['xs'])
+
+    def random_crop(self, clip, crop_h, crop_w):
+        """A random crop origin (y, x) on the clip's grid."""
+        h, w, ys, xs = self.grid(clip)
+        if (h, w) != (crop_h, crop_w):
+            raise ValueError(f'heatmaps of {clip} were extracted for {h}x{w} crops, not {crop_h}x{crop_w}')
+        return int(random.choice(ys)), int(random.choice(xs))
+
+    def read(self, frame_path, y, x):
+        """Dequantized float32 heatmaps (joints, h, w) of one frame 'clip_XXXX/frame_XXXX.png' at crop origin (y, x)."""
+        clip, frame = frame_path.split('/')
+        f, index = self._open(clip)
+        ys = list(f.attrs['ys'])
+        xs = list(f.attrs['xs'])
+        k = index[frame]
+        g = ys.index(y) * len(xs) + xs.index(x)
+        return dequantize(f['heatmaps'][k, g], f['low'][k, g], f['scale'][k, g])
+
+
+class HeatmapWriter:
+    def __init__(self, path, frames, crop_h, crop_w, ys, xs):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.frames = frames
+        self.attrs = {'crop_h': crop_h, 'crop_w': crop_w, 'ys': np.array(ys, np.int32), 'xs': np.array(xs, np.int32)}
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.file is not None:
+            self.file.close()
+        if exc_type is None and self.file is not None:
+            os.replace(self.tmp_path, self.path)
+        elif os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        return False
+
+    def add(self, k, heatmaps):
+        """Store the float heatmaps (crops, joints, h, w) of the k-th frame."""
+        g, j, h, w = heatmaps.shape
+        if self.file is None:
+            n = len(self.frames)
+            self.file = h5py.File(self.tmp_path, 'w')
+            self.file.create_dataset('frames', data=np.array([name.encode() for name in self.frames]))
+            self.file.create_dataset('heatmaps', shape=(n, g, j, h, w), dtype=np.uint8,
+                                     chunks=(1, 1, j, h, w), compression='gzip', compression_opts=4, shuffle=True)
+            self.file.create_dataset('low', shape=(n, g, j), dtype=np.float32)
+            self.file.create_dataset('scale', shape=(n, g, j), dtype=np.float32)
+            self.file.attrs.update(self.attrs)
+        q, low, scale = quantize(heatmaps)
+        self.file['heatmaps'][k] = q
+        self.file['low'][k] = low
+        self.file['scale'][k] = scale
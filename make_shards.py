@@ -0,0 +1,42 @@
+import os
+import time
+import random
+import argparse
+from shards import ShardStore, read_windows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack training windows into sequential shard files for train.py --shard_root')
+    parser.add_argument('--data_root', type=str, default='/scratch/rrm9598/hpml/acv/SportsSloMo/SportsSloMo_frames/')
+    parser.add_argument('--output', type=str, required=True, help='shard directory')
+    parser.add_argument('--split', type=str, default='./splits/vfi_train.txt')
+    parser.add_argument('--windows_per_shard', type=int, default=128, help='9-frame windows per shard file')
+    parser.add_argument('--seed', type=int, default=0, help='windows are shuffled across shards with this seed')
+    parser.add_argument('--shard', type=str, default='0/1', help='i/n: write every n-th shard starting at i')
+    args = parser.parse_args()
+
+    part, num_parts = (int(v) for v in args.shard.split('/'))
+    windows = list(enumerate(read_windows(args.split)))
+    # Neighbouring windows of a clip are near-duplicates, so each shard mixes clips
+    random.Random(args.seed).shuffle(windows)
+    groups = [windows[k:k+args.windows_per_shard] for k in range(0, len(windows), args.windows_per_shard)]
+    store = ShardStore(args.output)
+    for shard in range(part, len(groups), num_parts):
+        # Shards only get an index once complete, so an interrupted run resumes here
+        if store.has_shard(shard):
+            continue
+        time_stamp = time.time()
+        num_bytes = 0
+        with store.writer(shard) as writer:
+            for window_id, paths in groups[shard]:
+                frames = []
+                for path in paths:
+                    with open(os.path.join(args.data_root, path), 'rb') as f:
+                        frames.append(f.read())
+                writer.add(window_id, paths, frames)
+                num_bytes += sum(len(d) for d in frames)
+        print('shard {}/{}: {} windows, {:.1f} MB in {:.1f}s'.format(
+            shard + 1, len(groups), len(groups[shard]), num_bytes / 2 ** 20, time.time() - time_stamp))
+
+if __name__ == "__main__":
+    main()
@@ -30,8 +30,9 @@ from ViTPose_pytorch.configs.ViTPose_large_coco_256x192 import data_cfg
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 class HeatmapInfer(nn.Module):
-    def __init__(self):
+    def __init__(self, batched=True):
         super(HeatmapInfer, self).__init__()
+        self.batched = batched
         self.CKPT_PATH = "/scratch/rrm9598/hpml/acv/SportsSloMo/ViTPose_pytorch/checkpoints/vitpose-l-multi-coco.pth" #Might need adjustment to your global path
         self.vit_pose = ViTPose(model_cfg)
         self.vit_pose.load_state_dict(torch.load(self.CKPT_PATH)['state_dict'])
@@ -55,16 +56,25 @@ class HeatmapInfer(nn.Module):
         for param in self.parameters():
             param.requires_grad = False
     
-    def forward(self, img, gt):
-        predict_imgs = F.interpolate(img, size=(self.img_size[1], self.img_size[0]), mode='bilinear', align_corners=False)
-        assert(predict_imgs.shape[-3] == 3)
-        predict_imgs = predict_imgs.flip(-3)
-        gt_imgs = F.interpolate(gt, size=(self.img_size[1], self.img_size[0]), mode='bilinear', align_corners=False)
-        assert(gt_imgs.shape[-3] == 3)
-        gt_imgs = gt_imgs.flip(-3)
-        cur_heatmaps = self.vit_pose(predict_imgs)
-        gt_heatmaps = self.vit_pose(gt_imgs)
-        return cur_heatmaps, gt_heatmaps
+    def heatmaps(self, imgs):
+        # BGR frames in [0, 1] of any size
+        imgs = F.interpolate(imgs, size=(self.img_size[1], self.img_size[0]), mode='bilinear', align_corners=False)
+        assert(imgs.shape[-3] == 3)
+        imgs = imgs.flip(-3)
+        return self.vit_pose(imgs)
+
+    def forward(self, img, gt, gt_heatmaps=None):
+        # gt_heatmaps can come from extract_heatmaps.py, which skips the ground-truth pass
+        if gt_heatmaps is not None:
+            return self.heatmaps(img), gt_heatmaps
+        if not self.batched:
+            with torch.no_grad():
+                gt_heatmaps = self.heatmaps(gt)
+            return self.heatmaps(img), gt_heatmaps
+        # Prediction and ground truth in one ViTPose pass, only the prediction needs gradients
+        heatmaps = self.heatmaps(torch.cat((img, gt.detach()), 0))
+        cur_heatmaps, gt_heatmaps = heatmaps.split(img.shape[0], 0)
+        return cur_heatmaps, gt_heatmaps.detach()
             
 
 
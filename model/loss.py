@@ -2,6 +2,7 @@ import torch
 import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import torchvision.models as models
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -18,30 +19,37 @@ class EPE(nn.Module):
 
 
 class Ternary(nn.Module):
-    def __init__(self):
+    """Census loss: soft Hamming distance between the 7x7 census transforms of two images.
+
+    Each of the 49 neighbour differences is a shifted slice of the zero-padded
+    grayscale image, the same values the identity-kernel convolution used to
+    produce. Offsets are processed chunk_size at a time and, when a gradient
+    is needed, each chunk is recomputed in the backward pass, so memory grows
+    with chunk_size instead of with all 49 channels.
+    """
+    def __init__(self, patch_size=7, chunk_size=7):
         super(Ternary, self).__init__()
-        patch_size = 7
-        out_channels = patch_size * patch_size
-        self.w = np.eye(out_channels).reshape(
-            (patch_size, patch_size, 1, out_channels))
-        self.w = np.transpose(self.w, (3, 2, 0, 1))
-        self.w = torch.tensor(self.w).float().to(device)
-
-    def transform(self, img):
-        patches = F.conv2d(img, self.w, padding=3, bias=None)
-        transf = patches - img
-        transf_norm = transf / torch.sqrt(0.81 + transf**2)
-        return transf_norm
+        self.patch_size = patch_size
+        self.chunk_size = chunk_size
+        offsets = [(i, j) for i in range(patch_size) for j in range(patch_size)]
+        self.chunks = [offsets[k:k+chunk_size] for k in range(0, len(offsets), chunk_size)]
 
     def rgb2gray(self, rgb):
         r, g, b = rgb[:, 0:1, :, :], rgb[:, 1:2, :, :], rgb[:, 2:3, :, :]
         gray = 0.2989 * r + 0.5870 * g + 0.1140 * b
         return gray
 
-    def hamming(self, t1, t2):
-        dist = (t1 - t2) ** 2
-        dist_norm = torch.mean(dist / (0.1 + dist), 1, True)
-        return dist_norm
+    def transform(self, padded, offsets, h, w):
+        """Normalised differences between the centre pixel and each neighbour in offsets."""
+        pad = self.patch_size // 2
+        center = padded[:, :, pad:pad+h, pad:pad+w]
+        patches = torch.cat([padded[:, :, i:i+h, j:j+w] for i, j in offsets], 1)
+        transf = patches - center
+        return transf / torch.sqrt(0.81 + transf**2)
+
+    def hamming_sum(self, padded0, padded1, offsets, h, w):
+        dist = (self.transform(padded0, offsets, h, w) - self.transform(padded1, offsets, h, w)) ** 2
+        return (dist / (0.1 + dist)).sum(1, True)
 
     def valid_mask(self, t, padding):
         n, _, h, w = t.size()
@@ -50,9 +58,18 @@ class Ternary(nn.Module):
         return mask
 
     def forward(self, img0, img1):
-        img0 = self.transform(self.rgb2gray(img0))
-        img1 = self.transform(self.rgb2gray(img1))
-        return self.hamming(img0, img1) * self.valid_mask(img0, 1)
+        h, w = img0.shape[2:]
+        pad = self.patch_size // 2
+        padded0 = F.pad(self.rgb2gray(img0), [pad] * 4)
+        padded1 = F.pad(self.rgb2gray(img1), [pad] * 4)
+        recompute = torch.is_grad_enabled() and (img0.requires_grad or img1.requires_grad)
+        total = 0
+        for offsets in self.chunks:
+            if recompute:
+                total = total + checkpoint(self.hamming_sum, padded0, padded1, offsets, h, w, use_reentrant=False)
+            else:
+                total = total + self.hamming_sum(padded0, padded1, offsets, h, w)
+        return total / self.patch_size ** 2 * self.valid_mask(img0, 1)
 
 
 class SOBEL(nn.Module):
@@ -96,28 +113,52 @@ class MeanShift(nn.Conv2d):
         self.requires_grad = False
             
 class VGGPerceptualLoss(torch.nn.Module):
-    def __init__(self, rank=0):
+    """Weighted L1 distance between VGG19 features of a prediction and its target.
+
+    VGG19 is cut after relu5_1, the deepest layer compared, and the target
+    runs under no_grad. With fold_normalize, the ImageNet scaling is folded
+    into the first conv and only the mean subtraction remains, which keeps
+    zero padding exact.
+    """
+    # Layers after which features are compared: relu1_1, relu2_1, relu3_1, relu4_1, relu5_1
+    indices = [2, 7, 12, 21, 30]
+    weights = [1.0/2.6, 1.0/4.8, 1.0/3.7, 1.0/5.6, 10/1.5]
+
+    def __init__(self, rank=0, fold_normalize=True):
         super(VGGPerceptualLoss, self).__init__()
-        blocks = []
         pretrained = True
-        self.vgg_pretrained_features = models.vgg19(pretrained=pretrained).features
-        self.normalize = MeanShift([0.485, 0.456, 0.406], [0.229, 0.224, 0.225], norm=True).cuda()
+        mean = [0.485, 0.456, 0.406]
+        std = [0.229, 0.224, 0.225]
+        features = models.vgg19(pretrained=pretrained).features[:self.indices[-1]]
+        self.normalize = MeanShift(mean, std, norm=True)
+        self.stages = nn.ModuleList([features[a:b] for a, b in zip([0] + self.indices[:-1], self.indices)])
         for param in self.parameters():
             param.requires_grad = False
+        if fold_normalize:
+            self.fold_normalize()
+
+    def fold_normalize(self):
+        # MeanShift computes x / std - mean / std; the first conv absorbs the 1 / std
+        conv = self.stages[0][0]
+        scale = self.normalize.weight.data.diagonal().view(1, -1, 1, 1)
+        conv.weight.data.mul_(scale)
+        self.register_buffer('mean', -self.normalize.bias.data.view(1, -1, 1, 1) / scale)
+        self.normalize = None
+
+    def features(self, x):
+        x = self.normalize(x) if self.normalize is not None else x - self.mean
+        feats = []
+        for stage in self.stages:
+            x = stage(x)
+            feats.append(x)
+        return feats
 
     def forward(self, X, Y, indices=None):
-        X = self.normalize(X)
-        Y = self.normalize(Y)
-        indices = [2, 7, 12, 21, 30]
-        weights = [1.0/2.6, 1.0/4.8, 1.0/3.7, 1.0/5.6, 10/1.5]
-        k = 0
+        with torch.no_grad():
+            target = self.features(Y)
         loss = 0
-        for i in range(indices[-1]):
-            X = self.vgg_pretrained_features[i](X)
-            Y = self.vgg_pretrained_features[i](Y)
-            if (i+1) in indices:
-                loss += weights[k] * (X - Y.detach()).abs().mean() * 0.1
-                k += 1
+        for weight, x, y in zip(self.weights, self.features(X), target):
+            loss += weight * (x - y).abs().mean() * 0.1
         return loss
 
 if __name__ == '__main__':
@@ -0,0 +1,79 @@
+import math
+import torch
+
+# Loss terms Model.update runs through the schedule
+TERMS = ['vgg', 'kpt']
+
+
+def parse_schedule(spec, known=TERMS):
+    """Parse 'vgg=every:2,kpt=subset:0.25' into {'vgg': ('every', 2), 'kpt': ('subset', 0.25)}."""
+    terms = {}
+    if not spec:
+        return terms
+    for entry in spec.split(','):
+        name, _, rule = entry.partition('=')
+        if name not in known:
+            raise ValueError('unknown loss term {!r} in schedule, expected one of {}'.format(name, ', '.join(known)))
+        mode, _, value = rule.partition(':')
+        if mode == 'every':
+            if int(value) < 1:
+                raise ValueError('every:N of {} needs N >= 1'.format(name))
+            terms[name] = (mode, int(value))
+        elif mode == 'subset':
+            if not 0 < float(value) <= 1:
+                raise ValueError('subset fraction of {} must be in (0, 1]'.format(name))
+            terms[name] = (mode, float(value))
+        elif mode == 'always':
+            terms[name] = (mode, None)
+        else:
+            raise ValueError('unknown schedule {!r} for {}, expected every:N, subset:F or always'.format(rule, name))
+    return terms
+
+class LossSchedule:
+    """Decides, per training step, which samples an expensive loss term is computed on.
+
+    every:N computes the term on every N-th step and scales it by N, so its
+    total contribution over N steps is unchanged. subset:F computes it on a
+    uniformly random fraction F of the batch; the mean over a random
+    sub-batch is already an unbiased estimate of the batch mean. Terms
+    without a rule are always computed on the full batch, as is every term
+    outside training. Only training calls advance the schedule, and the
+    number of samples each term ran on is counted so the saved compute can
+    be logged.
+    """
+    def __init__(self, spec=None):
+        self.terms = parse_schedule(spec)
+        self.steps = {}
+        self.samples = {}
+
+    def select(self, name, batch_size, training=True):
+        """None to skip the term, otherwise (index, weight) with index None for the full batch."""
+        if not training:
+            return None, 1.
+        mode, value = self.terms.get(name, ('always', None))
+        step = self.steps.get(name, 0)
+        self.steps[name] = step + 1
+        if mode == 'every':
+            selection = (None, float(value)) if step % value == 0 else None
+            computed = batch_size if selection is not None else 0
+        elif mode == 'subset':
+            n = max(1, int(math.ceil(value * batch_size)))
+            selection = (torch.randperm(batch_size)[:n], 1.)
+            computed = n
+        else:
+            selection = (None, 1.)
+            computed = batch_size
+        counts = self.samples.setdefault(name, [0, 0])
+        counts[0] += computed
+        counts[1] += batch_size
+        return selection
+
+    def usage(self):
+        """Fraction of the seen samples each term was computed on since the last reset."""
+        return {name: computed / seen for name, (computed, seen) in self.samples.items() if seen}
+
+    def reset_usage(self):
+        self.samples = {}
+
+    def format_usage(self):
+        return ' '.join('{}:{:.0%}'.format(name, fraction) for name, fraction in sorted(self.usage().items()))
@@ -24,119 +24,138 @@ def create_window_3d(window_size, channel=1):
     return window
 
 
-def ssim(img1, img2, window_size=11, window=None, size_average=True, full=False, val_range=None):
+# Separable kernels, by (window_size, channel, dtype, device)
+_windows = {}
+# Mixing matrices of the colour axis in ssim_matlab, by (window_size, depth, dtype, device)
+_depth_windows = {}
+
+def separable_window(window_size, channel, dtype, device):
+    """Vertical and horizontal 1D Gaussians whose product is create_window(window_size, channel)."""
+    key = (window_size, channel, dtype, torch.device(device))
+    if key not in _windows:
+        g = gaussian(window_size, 1.5).to(device, dtype)
+        _windows[key] = (g.view(1, 1, -1, 1).repeat(channel, 1, 1, 1), g.view(1, 1, 1, -1).repeat(channel, 1, 1, 1))
+    return _windows[key]
+
+def depth_window(window_size, depth, dtype, device):
+    """1x1 conv weight applying the Gaussian along the channel axis with replicate padding.
+
+    The channel axis of ssim_matlab's volume is only a few entries deep, so
+    its replicate-padded filter is a small matrix mixing the channels.
+    """
+    key = (window_size, depth, dtype, torch.device(device))
+    if key not in _depth_windows:
+        g = gaussian(window_size, 1.5)
+        mix = torch.zeros(depth, depth)
+        for d in range(depth):
+            for t in range(window_size):
+                mix[d, min(max(d + t - window_size // 2, 0), depth - 1)] += g[t]
+        _depth_windows[key] = mix.view(depth, depth, 1, 1).to(device, dtype)
+    return _depth_windows[key]
+
+def gaussian_filter(img, window, pad):
+    """Replicate-padded local mean of every channel of img, window being separable_window's pair or a dense 2D window."""
+    img = F.pad(img, (pad, pad, pad, pad), mode='replicate')
+    channel = img.shape[1]
+    if isinstance(window, tuple):
+        return F.conv2d(F.conv2d(img, window[0], groups=channel), window[1], groups=channel)
+    return F.conv2d(img, window, groups=channel)
+
+def _value_range(img1, val_range):
     # Value range can be different from 255. Other common ranges are 1 (sigmoid) and 2 (tanh).
-    if val_range is None:
-        if torch.max(img1) > 128:
-            max_val = 255
-        else:
-            max_val = 1
-
-        if torch.min(img1) < -0.5:
-            min_val = -1
-        else:
-            min_val = 0
-        L = max_val - min_val
+    if val_range is not None:
+        return val_range
+    if torch.max(img1) > 128:
+        max_val = 255
     else:
-        L = val_range
+        max_val = 1
 
-    padd = 0
-    (_, channel, height, width) = img1.size()
-    if window is None:
-        real_size = min(window_size, height, width)
-        window = create_window(real_size, channel=channel).to(img1.device)
-    
-    # mu1 = F.conv2d(img1, window, padding=padd, groups=channel)
-    # mu2 = F.conv2d(img2, window, padding=padd, groups=channel)
-    mu1 = F.conv2d(F.pad(img1, (5, 5, 5, 5), mode='replicate'), window, padding=padd, groups=channel)
-    mu2 = F.conv2d(F.pad(img2, (5, 5, 5, 5), mode='replicate'), window, padding=padd, groups=channel)
+    if torch.min(img1) < -0.5:
+        min_val = -1
+    else:
+        min_val = 0
+    return max_val - min_val
+
+def _ssim(img1, img2, local_mean, L, size_average, full):
+    """SSIM from the local means computed by local_mean; per image unless size_average.
+
+    The five maps whose local means are needed are stacked along the
+    channels and filtered in one call; local_mean gets 5 * channels.
+    """
+    stacked = torch.cat([img1, img2, img1 * img1, img2 * img2, img1 * img2], 1)
+    mu1, mu2, mean11, mean22, mean12 = local_mean(stacked).chunk(5, 1)
 
     mu1_sq = mu1.pow(2)
     mu2_sq = mu2.pow(2)
     mu1_mu2 = mu1 * mu2
 
-    sigma1_sq = F.conv2d(F.pad(img1 * img1, (5, 5, 5, 5), 'replicate'), window, padding=padd, groups=channel) - mu1_sq
-    sigma2_sq = F.conv2d(F.pad(img2 * img2, (5, 5, 5, 5), 'replicate'), window, padding=padd, groups=channel) - mu2_sq
-    sigma12 = F.conv2d(F.pad(img1 * img2, (5, 5, 5, 5), 'replicate'), window, padding=padd, groups=channel) - mu1_mu2
+    sigma1_sq = mean11 - mu1_sq
+    sigma2_sq = mean22 - mu2_sq
+    sigma12 = mean12 - mu1_mu2
 
     C1 = (0.01 * L) ** 2
     C2 = (0.03 * L) ** 2
 
     v1 = 2.0 * sigma12 + C2
     v2 = sigma1_sq + sigma2_sq + C2
-    cs = torch.mean(v1 / v2)  # contrast sensitivity
+    cs = v1 / v2  # contrast sensitivity
 
     ssim_map = ((2 * mu1_mu2 + C1) * v1) / ((mu1_sq + mu2_sq + C1) * v2)
 
     if size_average:
-        ret = ssim_map.mean()
+        ret, cs = ssim_map.mean(), cs.mean()
     else:
-        ret = ssim_map.mean(1).mean(1).mean(1)
+        ret, cs = ssim_map.flatten(1).mean(1), cs.flatten(1).mean(1)
 
     if full:
         return ret, cs
     return ret
 
 
-def ssim_matlab(img1, img2, window_size=11, window=None, size_average=True, full=False, val_range=None):
-    # Value range can be different from 255. Other common ranges are 1 (sigmoid) and 2 (tanh).
-    if val_range is None:
-        if torch.max(img1) > 128:
-            max_val = 255
-        else:
-            max_val = 1
-
-        if torch.min(img1) < -0.5:
-            min_val = -1
-        else:
-            min_val = 0
-        L = max_val - min_val
-    else:
-        L = val_range
-
-    padd = 0
-    (_, _, height, width) = img1.size()
+def ssim(img1, img2, window_size=11, window=None, size_average=True, full=False, val_range=None):
+    """SSIM with a Gaussian window, filtered as two 1D passes unless a dense window is given."""
+    L = _value_range(img1, val_range)
+    (_, channel, height, width) = img1.size()
     if window is None:
         real_size = min(window_size, height, width)
-        window = create_window_3d(real_size, channel=1).to(img1.device)
-        # Channel is set to 1 since we consider color images as volumetric images
-
-    img1 = img1.unsqueeze(1)
-    img2 = img2.unsqueeze(1)
-
-    mu1 = F.conv3d(F.pad(img1, (5, 5, 5, 5, 5, 5), mode='replicate'), window, padding=padd, groups=1)
-    mu2 = F.conv3d(F.pad(img2, (5, 5, 5, 5, 5, 5), mode='replicate'), window, padding=padd, groups=1)
-
-    mu1_sq = mu1.pow(2)
-    mu2_sq = mu2.pow(2)
-    mu1_mu2 = mu1 * mu2
-
-    sigma1_sq = F.conv3d(F.pad(img1 * img1, (5, 5, 5, 5, 5, 5), 'replicate'), window, padding=padd, groups=1) - mu1_sq
-    sigma2_sq = F.conv3d(F.pad(img2 * img2, (5, 5, 5, 5, 5, 5), 'replicate'), window, padding=padd, groups=1) - mu2_sq
-    sigma12 = F.conv3d(F.pad(img1 * img2, (5, 5, 5, 5, 5, 5), 'replicate'), window, padding=padd, groups=1) - mu1_mu2
+        window = separable_window(real_size, 5 * channel, img1.dtype, img1.device)
+        pad = real_size // 2
+    else:
+        pad = window.shape[-1] // 2
+        window = window.repeat(5, 1, 1, 1)
+    return _ssim(img1, img2, lambda x: gaussian_filter(x, window, pad), L, size_average, full)
 
-    C1 = (0.01 * L) ** 2
-    C2 = (0.03 * L) ** 2
 
-    v1 = 2.0 * sigma12 + C2
-    v2 = sigma1_sq + sigma2_sq + C2
-    cs = torch.mean(v1 / v2)  # contrast sensitivity
+def ssim_matlab(img1, img2, window_size=11, window=None, size_average=True, full=False, val_range=None):
+    """SSIM treating a colour image as a volume, with a 3D Gaussian over channels, rows and columns.
 
-    ssim_map = ((2 * mu1_mu2 + C1) * v1) / ((mu1_sq + mu2_sq + C1) * v2)
+    The 3D window is separable: a channel-mixing 1x1 convolution followed by
+    two 1D spatial passes give the replicate-padded conv3d result. A dense
+    window from create_window_3d still uses conv3d.
+    """
+    L = _value_range(img1, val_range)
+    (_, channel, height, width) = img1.size()
+    if window is not None:
+        pad = window.shape[-1] // 2
 
-    if size_average:
-        ret = ssim_map.mean()
+        def local_mean(x):
+            # Channel is 1 since we consider color images as volumetric images
+            volume = F.pad(x.view(-1, 1, channel, height, width), (pad,) * 6, mode='replicate')
+            return F.conv3d(volume, window, groups=1).view(x.shape)
     else:
-        ret = ssim_map.mean(1).mean(1).mean(1)
+        real_size = min(window_size, height, width)
+        spatial = separable_window(real_size, 5 * channel, img1.dtype, img1.device)
+        mix = depth_window(real_size, channel, img1.dtype, img1.device)
 
-    if full:
-        return ret, cs
-    return ret
+        def local_mean(x):
+            # Each of the five stacked maps is its own volume along the channels
+            mixed = F.conv2d(x.view(-1, channel, height, width), mix).view(x.shape)
+            return gaussian_filter(mixed, spatial, real_size // 2)
+    return _ssim(img1, img2, local_mean, L, size_average, full)
 
 
 def msssim(img1, img2, window_size=11, size_average=True, val_range=None, normalize=False):
-    device = img1.device
-    weights = torch.FloatTensor([0.0448, 0.2856, 0.3001, 0.2363, 0.1333]).to(device)
+    weights = torch.tensor([0.0448, 0.2856, 0.3001, 0.2363, 0.1333], dtype=img1.dtype, device=img1.device)
     levels = weights.size()[0]
     mssim = []
     mcs = []
@@ -156,14 +175,17 @@ def msssim(img1, img2, window_size=11, size_average=True, val_range=None, normal
         mssim = (mssim + 1) / 2
         mcs = (mcs + 1) / 2
 
+    if not size_average:
+        # One column per image
+        weights = weights.view(-1, 1)
     pow1 = mcs ** weights
     pow2 = mssim ** weights
     # From Matlab implementation https://ece.uwaterloo.ca/~z70wang/research/iwssim/
-    output = torch.prod(pow1[:-1] * pow2[-1])
+    output = torch.prod(pow1[:-1] * pow2[-1], 0)
     return output
 
 
-# Classes to re-use window
+# Windows are cached per size, channels, dtype and device by ssim itself
 class SSIM(torch.nn.Module):
     def __init__(self, window_size=11, size_average=True, val_range=None):
         super(SSIM, self).__init__()
@@ -171,21 +193,8 @@ class SSIM(torch.nn.Module):
         self.size_average = size_average
         self.val_range = val_range
 
-        # Assume 3 channel for SSIM
-        self.channel = 3
-        self.window = create_window(window_size, channel=self.channel)
-
     def forward(self, img1, img2):
-        (_, channel, _, _) = img1.size()
-
-        if channel == self.channel and self.window.dtype == img1.dtype:
-            window = self.window
-        else:
-            window = create_window(self.window_size, channel).to(img1.device).type(img1.dtype)
-            self.window = window
-            self.channel = channel
-
-        _ssim = ssim(img1, img2, window=window, window_size=self.window_size, size_average=self.size_average)
+        _ssim = ssim(img1, img2, window_size=self.window_size, size_average=self.size_average, val_range=self.val_range)
         dssim = (1 - _ssim) / 2
         return dssim
 
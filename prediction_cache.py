@@ -0,0 +1,72 @@
+import os
+import h5py
+import numpy as np
+
+
+class PredictionCache:
+    """Predicted frames for one checkpoint and interpolation factor, one HDF5 file per clip.
+
+    Frames are stored as uint8 with per-frame gzip chunks, so the cache is
+    lossless and a clip can be read back frame by frame. A clip file only
+    appears under its final name once every window has been written, which
+    makes an interrupted prediction run resumable per clip.
+    """
+    def __init__(self, root, ckpt, factor):
+        self.root = os.path.join(root, f'{ckpt[:16]}_{factor}x')
+        self.factor = factor
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, clip):
+        return os.path.join(self.root, f'clip_{clip:04d}.h5')
+
+    def has_clip(self, clip):
+        return os.path.exists(self.path(clip))
+
+    def clips(self):
+        return sorted(int(name[5:-3]) for name in os.listdir(self.root) if name.startswith('clip_') and name.endswith('.h5'))
+
+    def writer(self, clip):
+        return ClipWriter(self.path(clip))
+
+    def read_clip(self, clip):
+        """Yield (window, timestep, frame) for every stored prediction of a clip."""
+        with h5py.File(self.path(clip), 'r') as f:
+            index = f['index'][:]
+            frames = f['frames']
+            for k, (window, timestep) in enumerate(index):
+                yield int(window), int(timestep), frames[k]
+
+
+class ClipWriter:
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.file = None
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.file is not None:
+            self.file.close()
+        if exc_type is None and self.file is not None:
+            os.replace(self.tmp_path, self.path)
+        elif os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        return False
+
+    def add(self, window, timestep, frame):
+        if self.file is None:
+            h, w, c = frame.shape
+            self.file = h5py.File(self.tmp_path, 'w')
+            self.file.create_dataset('frames', shape=(0, h, w, c), maxshape=(None, h, w, c), dtype=np.uint8,
+                                     chunks=(1, h, w, c), compression='gzip', compression_opts=4, shuffle=True)
+            self.file.create_dataset('index', shape=(0, 2), maxshape=(None, 2), dtype=np.int32)
+        frames = self.file['frames']
+        index = self.file['index']
+        frames.resize(self.count + 1, axis=0)
+        index.resize(self.count + 1, axis=0)
+        frames[self.count] = frame
+        index[self.count] = (window, timestep)
+        self.count += 1
@@ -0,0 +1,213 @@
+import os
+import time
+import torch
+import numpy as np
+import train_log.IFNet_HDv3 as ifnet_module
+from torch.nn.parallel import DistributedDataParallel as DDP
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def sync():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+class _BackwardStamp(torch.autograd.Function):
+    """Identity whose backward calls a callback, marking when a gradient arrives."""
+    @staticmethod
+    def forward(ctx, x, callback):
+        ctx.callback = callback
+        return x.view_as(x)
+
+    @staticmethod
+    def backward(ctx, grad):
+        ctx.callback()
+        return grad, None
+
+class _Frame:
+    def __init__(self, name, start, mem):
+        self.name = name
+        self.start = start
+        self.mem = mem
+        self.peak = mem
+        self.record = None
+
+class ModuleProfiler:
+    """Forward/backward timing and memory hooks on named submodules.
+
+    Nothing is attached until attach() is called, so a training run that
+    never builds a profiler pays no cost. Every hook synchronises the device
+    to attribute time correctly, which slows the profiled steps down.
+    Memory is the peak allocation above the allocation at module entry and
+    is only tracked on CUDA. Optionally a torch.profiler Chrome trace is
+    recorded for the steps in trace_steps = (first, last).
+    """
+    def __init__(self, modules, profile_warp=True, trace_dir=None, trace_steps=None):
+        self.modules = modules
+        self.profile_warp = profile_warp
+        self.trace_dir = trace_dir
+        self.trace_steps = trace_steps
+        self.handles = []
+        self.stack = []
+        self.backward_start = {}
+        self.current = {}
+        self.totals = {}
+        self.steps = 0
+        self.trace = None
+        self.original_warp = None
+
+    @classmethod
+    def for_model(cls, model, detail=False, **kwargs):
+        """Profile the IFNet stages and the loss modules of a train_log.RIFE_HDv3.Model."""
+        flownet = model.flownet.module if isinstance(model.flownet, DDP) else model.flownet
+        modules = {'ifnet.encode': flownet.encode}
+        for i in range(4):
+            block = getattr(flownet, 'block{}'.format(i))
+            modules['ifnet.block{}'.format(i)] = block
+            if detail:
+                modules['ifnet.block{}.conv0'.format(i)] = block.conv0
+                modules['ifnet.block{}.convblock'.format(i)] = block.convblock
+                modules['ifnet.block{}.lastconv'.format(i)] = block.lastconv
+        modules['loss.vgg'] = model.vgg
+        modules['loss.heatmap_infer'] = model.HeatmapInfer
+        modules['loss.heatmap_mse'] = model.heatmaploss
+        modules['loss.sobel'] = model.sobel
+        return cls(modules, **kwargs)
+
+    def _add(self, name, key, value):
+        stats = self.current.setdefault(name, {'fwd_ms': 0., 'bwd_ms': 0., 'calls': 0, 'peak_mb': 0.})
+        if key == 'peak_mb':
+            stats[key] = max(stats[key], value)
+        else:
+            stats[key] += value
+
+    def _enter(self, name):
+        sync()
+        mem = 0
+        if device.type == 'cuda':
+            peak = torch.cuda.max_memory_allocated()
+            for frame in self.stack:
+                frame.peak = max(frame.peak, peak)
+            torch.cuda.reset_peak_memory_stats()
+            mem = torch.cuda.memory_allocated()
+        frame = _Frame(name, time.perf_counter(), mem)
+        if self.trace is not None:
+            frame.record = torch.autograd.profiler.record_function(name)
+            frame.record.__enter__()
+        self.stack.append(frame)
+
+    def _exit(self):
+        sync()
+        frame = self.stack.pop()
+        if frame.record is not None:
+            frame.record.__exit__(None, None, None)
+        self._add(frame.name, 'fwd_ms', (time.perf_counter() - frame.start) * 1000.)
+        self._add(frame.name, 'calls', 1)
+        if device.type == 'cuda':
+            peak = max(frame.peak, torch.cuda.max_memory_allocated())
+            self._add(frame.name, 'peak_mb', (peak - frame.mem) / 2 ** 20)
+            for parent in self.stack:
+                parent.peak = max(parent.peak, peak)
+
+    def _backward_begin(self, name):
+        sync()
+        self.backward_start.setdefault(name, []).append(time.perf_counter())
+
+    def _backward_end(self, name):
+        sync()
+        starts = self.backward_start.get(name)
+        if starts:
+            self._add(name, 'bwd_ms', (time.perf_counter() - starts.pop()) * 1000.)
+
+    def _stamp_outputs(self, name, out):
+        # The first gradient to reach any output starts the module's backward
+        tensors = out if isinstance(out, (tuple, list)) else [out]
+        tensors = [t for t in tensors if torch.is_tensor(t) and t.requires_grad]
+        fired = []
+        def begin(grad):
+            if not fired:
+                fired.append(True)
+                self._backward_begin(name)
+        for t in tensors:
+            t.register_hook(begin)
+
+    def _timed_warp(self, tenInput, tenFlow):
+        if torch.is_grad_enabled() and tenFlow.requires_grad:
+            tenFlow = _BackwardStamp.apply(tenFlow, lambda: self._backward_end('warp'))
+        self._enter('warp')
+        out = self.original_warp(tenInput, tenFlow)
+        self._exit()
+        if out.requires_grad:
+            out.register_hook(lambda grad: self._backward_begin('warp'))
+        return out
+
+    def _forward_hook(self, name):
+        def hook(module, inp, out):
+            self._exit()
+            if torch.is_grad_enabled():
+                self._stamp_outputs(name, out)
+        return hook
+
+    def attach(self):
+        for name, module in self.modules.items():
+            self.handles.append(module.register_forward_pre_hook(lambda m, inp, name=name: self._enter(name)))
+            self.handles.append(module.register_forward_hook(self._forward_hook(name)))
+            self.handles.append(module.register_full_backward_hook(
+                lambda m, grad_input, grad_output, name=name: self._backward_end(name)))
+        if self.profile_warp:
+            self.original_warp = ifnet_module.warp
+            ifnet_module.warp = self._timed_warp
+        self._update_trace()
+        return self
+
+    def detach(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        if self.original_warp is not None:
+            ifnet_module.warp = self.original_warp
+            self.original_warp = None
+        if self.trace is not None:
+            self.trace.__exit__(None, None, None)
+            self.trace = None
+
+    def step(self):
+        """Close the current step; returns its per-module statistics."""
+        stats = self.current
+        self.current = {}
+        for name, values in stats.items():
+            total = self.totals.setdefault(name, [])
+            total.append(values)
+        self.steps += 1
+        self._update_trace()
+        return stats
+
+    def _update_trace(self):
+        if self.trace_steps is not None:
+            first, last = self.trace_steps
+            if self.steps == first:
+                self.trace = torch.profiler.profile(
+                    activities=[torch.profiler.ProfilerActivity.CPU] +
+                               ([torch.profiler.ProfilerActivity.CUDA] if device.type == 'cuda' else []),
+                    record_shapes=True, profile_memory=True)
+                self.trace.__enter__()
+            elif self.steps == last + 1 and self.trace is not None:
+                self.trace.__exit__(None, None, None)
+                os.makedirs(self.trace_dir, exist_ok=True)
+                path = os.path.join(self.trace_dir, 'trace_steps_{}_{}.json'.format(first, last))
+                self.trace.export_chrome_trace(path)
+                self.trace = None
+                print('profiler trace written to {}'.format(path))
+
+    def summary(self):
+        """Mean per-step statistics over every closed step."""
+        summary = {}
+        for name, steps in self.totals.items():
+            summary[name] = {key: float(np.mean([s[key] for s in steps])) for key in ['fwd_ms', 'bwd_ms', 'calls', 'peak_mb']}
+        return summary
+
+    def format_summary(self):
+        lines = ['{:<28} {:>10} {:>10} {:>6} {:>10}'.format('module', 'fwd ms', 'bwd ms', 'calls', 'peak MB')]
+        for name, s in sorted(self.summary().items(), key=lambda item: -(item[1]['fwd_ms'] + item[1]['bwd_ms'])):
+            lines.append('{:<28} {:>10.2f} {:>10.2f} {:>6.1f} {:>10.1f}'.format(name, s['fwd_ms'], s['bwd_ms'], s['calls'], s['peak_mb']))
+        return '\n'.join(lines)
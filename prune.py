@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import argparse
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+from benchmark_inference import bench_config, RESOLUTIONS
+from benchmark_students import psnr
+from checkpoint import SeededDataset
+from dataset import SportsSloMoDataset, load_val_subset
+from train_log.RIFE_HDv3 import Model
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+BLOCKS = ['block0', 'block1', 'block2', 'block3']
+
+
+def channel_norms(weight, dim):
+    """L2 norm of a conv weight per channel along dim."""
+    return weight.transpose(0, dim).flatten(1).norm(dim=1)
+
+def channel_scores(state, block, depth):
+    """Importance of every channel of a block's residual stream.
+
+    A channel is written by the last conv of conv0 and, scaled by beta, by
+    every ResConv, and read by every ResConv and by lastconv. Its score is
+    how strongly it is written times how strongly it is read, so a channel
+    whose betas are near zero or whose weights are small scores low.
+    """
+    written = channel_norms(state[block + '.conv0.1.0.weight'], 0)
+    # ConvTranspose2d weights are (in, out, kh, kw)
+    read = channel_norms(state[block + '.lastconv.0.weight'], 0)
+    for l in range(depth):
+        weight = state['{}.convblock.{}.conv.weight'.format(block, l)]
+        beta = state['{}.convblock.{}.beta'.format(block, l)].flatten()
+        written = written + beta.abs() * channel_norms(weight, 0)
+        read = read + channel_norms(weight, 1)
+    return written * read
+
+def prune_state(state, block, depth, keep):
+    """Copy of state with only the residual-stream channels keep of block."""
+    state = dict(state)
+    for name in ['.conv0.1.0.weight', '.conv0.1.0.bias', '.lastconv.0.weight']:
+        state[block + name] = state[block + name][keep]
+    for l in range(depth):
+        prefix = '{}.convblock.{}.'.format(block, l)
+        state[prefix + 'conv.weight'] = state[prefix + 'conv.weight'][keep][:, keep]
+        state[prefix + 'conv.bias'] = state[prefix + 'conv.bias'][keep]
+        state[prefix + 'beta'] = state[prefix + 'beta'][:, keep]
+    return state
+
+def prune(model, sparsity, blocks, multiple):
+    """A Model whose chosen blocks keep the (1 - sparsity) highest-scoring channels, rounded to multiple."""
+    net = model.flownet
+    config = net.config()
+    state = {k: v.detach().clone() for k, v in net.state_dict().items()}
+    for i, block in enumerate(BLOCKS):
+        if block not in blocks:
+            continue
+        c = config['widths'][i]
+        n = min(c, max(multiple, int(round(c * (1 - sparsity) / multiple)) * multiple))
+        keep = channel_scores(state, block, config['depths'][i]).argsort(descending=True)[:n].sort().values
+        state = prune_state(state, block, config['depths'][i], keep)
+        config['widths'][i] = n
+    pruned = Model(config=config)
+    pruned.flownet.load_state_dict(state)
+    return pruned
+
+def count_flops(net, x):
+    """Multiply-accumulates of the convolutions in one forward of net on x, counted with hooks."""
+    macs = [0]
+
+    def hook(module, inputs, output):
+        if isinstance(module, nn.ConvTranspose2d):
+            macs[0] += inputs[0].numel() * module.weight[0].numel()
+        else:
+            macs[0] += output.numel() * module.weight[0].numel()
+    handles = [m.register_forward_hook(hook) for m in net.modules() if isinstance(m, (nn.Conv2d, nn.ConvTranspose2d))]
+    with torch.no_grad():
+        net(x)
+    for h in handles:
+        h.remove()
+    return macs[0]
+
+def finetune(model, teacher_dir, args):
+    """A few distillation steps towards the unpruned model to recover the pruned channels' contribution."""
+    dataset = SeededDataset(SportsSloMoDataset('train', data_root=args.data_root), args.seed)
+    loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers, drop_last=True)
+    model.set_teacher(teacher_dir)
+    model.reset_optimizer()
+    step = 0
+    while step < args.finetune_steps:
+        for data in loader:
+            data_gpu = data[0].to(device, non_blocking=True) / 255.
+            _, info = model.update(data_gpu[:, :6], data_gpu[:, 6:9], args.lr, training=True)
+            step += 1
+            if step % 50 == 0 or step == args.finetune_steps:
+                print('  finetune step {} loss_l1:{:.4e} loss_distill:{:.4e}'.format(step, info['loss_l1'], info['loss_distill']))
+            if step >= args.finetune_steps:
+                break
+    model.teacher = None
+
+def main():
+    parser = argparse.ArgumentParser(description='Prune ResConv channels of IFNet by beta magnitude and weight norm')
+    parser.add_argument('--modelDir', type=str, default='train_log', help='checkpoint to prune')
+    parser.add_argument('--sparsity', type=str, default='0,0.25,0.5,0.75', help='comma-separated fractions of channels to remove')
+    parser.add_argument('--blocks', type=str, default=','.join(BLOCKS), help='blocks to prune')
+    parser.add_argument('--multiple', type=int, default=8, help='round kept channels to a multiple of this')
+    parser.add_argument('--output', type=str, default=None, help='save each pruned checkpoint to <output>/sparsity_<percent>')
+    parser.add_argument('--finetune_steps', type=int, default=0, help='distillation steps from the unpruned model after pruning')
+    parser.add_argument('--lr', type=float, default=3e-5)
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--data_root', type=str, default='/scratch/rrm9598/hpml/acv/SportsSloMo/SportsSloMo_frames/')
+    parser.add_argument('--val_windows', type=int, default=64, help='validation windows for PSNR (0 skips it)')
+    parser.add_argument('--val_batch_size', type=int, default=8)
+    parser.add_argument('--resolution', type=str, default='720p', help='resolution for FLOPs and latency')
+    parser.add_argument('--threads', type=int, default=None, help='torch CPU threads for the latency')
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--report', type=str, default=None, help='optionally write the table as JSON')
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+
+    model = Model()
+    model.load_model(args.modelDir, -1)
+    blocks = args.blocks.split(',')
+    val = load_val_subset(args.data_root, args.val_windows, args.seed, device) if args.val_windows else None
+    h, w = RESOLUTIONS[args.resolution]
+    x = torch.rand(1, 6, (h + 31) // 32 * 32, (w + 31) // 32 * 32, device=device)
+
+    rows = []
+    print('{:>8} {:<20} {:>9} {:>9} {:>10} {:>8}'.format('sparsity', 'widths', 'params M', 'GMACs', '{} ms'.format(args.resolution), 'psnr'))
+    for sparsity in [float(s) for s in args.sparsity.split(',')]:
+        time_stamp = time.time()
+        pruned = prune(model, sparsity, blocks, args.multiple)
+        if args.finetune_steps and sparsity > 0:
+            finetune(pruned, args.modelDir, args)
+        pruned.eval()
+        net = pruned.flownet
+        config = net.config()
+        row = {
+            'sparsity': sparsity,
+            'widths': config['widths'],
+            # Only the blocks and the encoder run at inference
+            'params': sum(p.numel() for n, p in net.named_parameters() if not n.startswith(('teacher.', 'caltime.'))),
+            'macs': count_flops(net, x),
+            'ms': bench_config(net, args.resolution, 1, 1.0, args.warmup, args.repeats)['end_to_end']['median_ms'],
+            'psnr': psnr(pruned, *val, args.val_batch_size) if val is not None else None,
+        }
+        rows.append(row)
+        print('{:>8.0%} {:<20} {:>9.2f} {:>9.1f} {:>10.1f} {:>8}   ({:.0f}s)'.format(
+            sparsity, ','.join(map(str, config['widths'])), row['params'] / 1e6, row['macs'] / 1e9, row['ms'],
+            '{:.3f}'.format(row['psnr']) if row['psnr'] is not None else '-', time.time() - time_stamp))
+        if args.output:
+            path = os.path.join(args.output, 'sparsity_{:02d}'.format(int(round(sparsity * 100))))
+            os.makedirs(path, exist_ok=True)
+            pruned.save_model(path)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+if __name__ == "__main__":
+    main()
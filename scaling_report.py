@@ -0,0 +1,38 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+import tempfile
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure train.py throughput for several process counts',
+                                     epilog='Unrecognised arguments are passed on to train.py')
+    parser.add_argument('--procs', type=str, default='1,2,4', help='comma-separated process counts')
+    parser.add_argument('--max_steps', type=int, default=50, help='steps per run')
+    parser.add_argument('--output', type=str, default=None, help='optionally write the table as JSON')
+    args, train_args = parser.parse_known_args()
+
+    results = []
+    for nproc in [int(n) for n in args.procs.split(',')]:
+        with tempfile.TemporaryDirectory() as tmp:
+            report = os.path.join(tmp, 'report.json')
+            cmd = [sys.executable, '-m', 'torch.distributed.run', '--standalone', '--nproc_per_node', str(nproc),
+                   'train.py', '--max_steps', str(args.max_steps), '--report', report] + train_args
+            print(' '.join(cmd))
+            subprocess.check_call(cmd)
+            with open(report) as f:
+                results.append(json.load(f))
+
+    base = results[0]['samples_per_s'] / results[0]['world_size']
+    print('{:>6} {:>8} {:>12} {:>10} {:>12}'.format('procs', 'backend', 'samples/s', 'speedup', 'efficiency'))
+    for r in results:
+        speedup = r['samples_per_s'] / base
+        print('{:>6} {:>8} {:>12.2f} {:>10.2f} {:>11.0%}'.format(r['world_size'], r['backend'], r['samples_per_s'], speedup, speedup / r['world_size']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import os
+import re
+import json
+
+
+def read_windows(split_file):
+    """9-frame training windows of a split, as lists of 'clip_XXXX/frame_XXXX.png' paths."""
+    with open(split_file, 'r') as f:
+        lines = f.read().splitlines()
+    return [lines[k:k+9] for k in range(0, len(lines) - 8, 9)]
+
+
+class ShardStore:
+    """Training windows packed into large files that are read front to back.
+
+    Each shard is one contiguous binary holding the encoded frames of its
+    windows back to back, and a JSON index with every window's id (its
+    position in the split), frame paths and byte offsets. The index is
+    written last, so a shard without one is incomplete and ignored.
+    """
+    pattern = re.compile(r'^shard_(\d+)\.json$')
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, shard):
+        return os.path.join(self.root, 'shard_{:05d}.bin'.format(shard))
+
+    def index_path(self, shard):
+        return os.path.join(self.root, 'shard_{:05d}.json'.format(shard))
+
+    def has_shard(self, shard):
+        return os.path.exists(self.index_path(shard))
+
+    def shards(self):
+        """(shard, index) of every complete shard, by shard number."""
+        found = []
+        for name in sorted(os.listdir(self.root)):
+            match = self.pattern.match(name)
+            if match:
+                with open(os.path.join(self.root, name)) as f:
+                    found.append((int(match.group(1)), json.load(f)))
+        return found
+
+    def writer(self, shard):
+        os.makedirs(self.root, exist_ok=True)
+        return ShardWriter(self.path(shard), self.index_path(shard))
+
+    def read(self, shard, windows):
+        """Yield (window, [encoded frame bytes]) for the given index entries, in file order."""
+        with open(self.path(shard), 'rb', buffering=1 << 24) as f:
+            position = 0
+            for window in sorted(windows, key=lambda w: w['offsets'][0]):
+                start = window['offsets'][0]
+                if start != position:
+                    f.seek(start)
+                frames = [f.read(size) for size in window['sizes']]
+                position = start + sum(window['sizes'])
+                yield window, frames
+
+
+class ShardWriter:
+    def __init__(self, path, index_path):
+        self.path = path
+        self.index_path = index_path
+        self.tmp_path = path + '.tmp'
+        self.file = None
+        self.windows = []
+        self.offset = 0
+
+    def __enter__(self):
+        self.file = open(self.tmp_path, 'wb')
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.file.close()
+        if exc_type is None:
+            os.replace(self.tmp_path, self.path)
+            with open(self.index_path + '.tmp', 'w') as f:
+                json.dump({'windows': self.windows}, f)
+            os.replace(self.index_path + '.tmp', self.index_path)
+        elif os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        return False
+
+    def add(self, window_id, paths, frames):
+        """Append one window: its split position, frame paths and encoded frames."""
+        offsets = []
+        for data in frames:
+            offsets.append(self.offset)
+            self.file.write(data)
+            self.offset += len(data)
+        self.windows.append({'id': window_id, 'paths': paths, 'offsets': offsets, 'sizes': [len(d) for d in frames]})
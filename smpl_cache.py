@@ -0,0 +1,82 @@
+import os
+import h5py
+import torch
+import numpy as np
+
+# Outputs of trainft.generate_smpl_params that are cached
+FIELDS = ['pose', 'shape', 'joints3d', 'camera']
+
+
+class SMPLCache:
+    """Ground-truth SMPLer-X parameters of every triplet, in one HDF5 file indexed by triplet name.
+
+    Each field is one float32 dataset with a row per triplet, so a sample's
+    parameters are a single indexed read.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.index = None
+
+    def _open(self):
+        # Opened lazily so every DataLoader worker gets its own handle
+        if self.file is None:
+            self.file = h5py.File(self.path, 'r')
+            self.index = {name.decode(): k for k, name in enumerate(self.file['samples'][:])}
+        return self.file
+
+    def names(self):
+        self._open()
+        return list(self.index)
+
+    def __contains__(self, name):
+        self._open()
+        return name in self.index
+
+    def read(self, name):
+        """{field: float32 tensor} of the triplet name, without a batch dimension."""
+        f = self._open()
+        k = self.index[name]
+        return {field: torch.from_numpy(f[field][k]) for field in FIELDS}
+
+    def writer(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        return SMPLWriter(self.path)
+
+
+class SMPLWriter:
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.names = []
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.file is not None:
+            if exc_type is None:
+                self.file.create_dataset('samples', data=np.array([name.encode() for name in self.names]))
+            self.file.close()
+        if exc_type is None and self.file is not None:
+            os.replace(self.tmp_path, self.path)
+        elif os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        return False
+
+    def add(self, names, params):
+        """Append the batched parameters {field: tensor (batch, ...)} of the triplets names."""
+        if self.file is None:
+            self.file = h5py.File(self.tmp_path, 'w')
+            for field in FIELDS:
+                shape = tuple(params[field].shape[1:])
+                self.file.create_dataset(field, shape=(0,) + shape, maxshape=(None,) + shape, dtype=np.float32, chunks=(1,) + shape)
+        start = len(self.names)
+        for field in FIELDS:
+            value = params[field].detach().float().cpu().numpy()
+            if len(value) != len(names):
+                raise ValueError('{} {} rows for {} triplets'.format(len(value), field, len(names)))
+            self.file[field].resize(start + len(value), axis=0)
+            self.file[field][start:] = value
+        self.names.extend(names)
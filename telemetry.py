@@ -0,0 +1,145 @@
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+import torch
+import numpy as np
+
+_STOP = object()
+
+
+class Telemetry:
+    """Per-step training metrics written to JSONL and optionally TensorBoard.
+
+    log() only puts the record on a queue. A background thread converts
+    values to floats, writes them and flushes every flush_interval seconds,
+    so the training loop never waits on a file, and tensors passed in are
+    only read back on the background thread. The file is truncated unless
+    append is set, so a fresh run never mixes with records of an earlier one.
+    """
+    def __init__(self, path, tensorboard_dir=None, flush_interval=5.0, append=False):
+        self.path = path
+        self.append = append
+        self.tensorboard_dir = tensorboard_dir
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def log(self, step, kind='train', **values):
+        values = {k: v.detach() if torch.is_tensor(v) else v for k, v in values.items()}
+        self.queue.put((kind, step, time.time(), values))
+
+    def close(self):
+        self.queue.put(_STOP)
+        self.thread.join()
+
+    def _run(self):
+        writer = None
+        if self.tensorboard_dir is not None:
+            from torch.utils.tensorboard import SummaryWriter
+            writer = SummaryWriter(self.tensorboard_dir)
+        last_flush = time.time()
+        with open(self.path, 'a' if self.append else 'w') as f:
+            while True:
+                try:
+                    item = self.queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    item = None
+                if item is _STOP:
+                    break
+                if item is not None:
+                    kind, step, wall_time, values = item
+                    values = {k: float(v) if torch.is_tensor(v) else v for k, v in values.items()}
+                    f.write(json.dumps(dict(kind=kind, step=step, time=wall_time, **values)) + '\n')
+                    if writer is not None:
+                        for k, v in values.items():
+                            if isinstance(v, (int, float)):
+                                writer.add_scalar('{}/{}'.format(kind, k), v, step, walltime=wall_time)
+                if time.time() - last_flush >= self.flush_interval:
+                    f.flush()
+                    if writer is not None:
+                        writer.flush()
+                    last_flush = time.time()
+        if writer is not None:
+            writer.close()
+
+def load(path, kind='train'):
+    records = []
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get('kind') == kind:
+                records.append(record)
+    return records
+
+def summarize(records, threshold):
+    """Per-epoch time split between waiting on the loader and computing."""
+    epochs = {}
+    for r in records:
+        epochs.setdefault(r['epoch'], []).append(r)
+    rows = []
+    for epoch, steps in sorted(epochs.items()):
+        wait = np.array([s['loader_wait'] for s in steps])
+        compute = np.array([s['step_time'] for s in steps])
+        total = wait.sum() + compute.sum()
+        rows.append({
+            'epoch': epoch,
+            'steps': len(steps),
+            'loader_fraction': float(wait.sum() / total) if total > 0 else 0.,
+            'compute_fraction': float(compute.sum() / total) if total > 0 else 0.,
+            'loader_bound_steps': float(np.mean(wait > threshold * compute)),
+            'samples_per_s': float(np.median([s['samples_per_s'] for s in steps])),
+            'peak_memory_mb': float(max(s.get('peak_memory_mb', 0.) for s in steps)),
+        })
+    return rows
+
+def time_to_target(path, target):
+    """Wall time, steps and samples from the first training step until validation first reaches target PSNR."""
+    train = load(path)
+    if not train:
+        return None
+    start = train[0]['time'] - train[0]['step_time'] - train[0]['loader_wait']
+    for record in load(path, 'val'):
+        if record['psnr'] >= target:
+            done = [r for r in train if r['step'] < record['step']]
+            samples = done[-1].get('samples_seen', 0) if done else 0
+            return {'seconds': record['time'] - start, 'step': record['step'], 'samples': samples, 'psnr': record['psnr']}
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarise training telemetry written by train.py')
+    parser.add_argument('path', type=str, nargs='+', help='telemetry JSONL file, or several runs with --target_psnr')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='a step is loader-bound when its loader wait exceeds this fraction of its compute time')
+    parser.add_argument('--target_psnr', type=float, default=None,
+                        help='instead compare how long each run took to first reach this validation PSNR')
+    args = parser.parse_args()
+    if args.target_psnr is not None:
+        print('{:<40} {:>10} {:>8} {:>10} {:>8}'.format('run', 'seconds', 'steps', 'samples', 'psnr'))
+        for path in args.path:
+            r = time_to_target(path, args.target_psnr)
+            if r is None:
+                print('{:<40} {:>10}'.format(path, 'not reached'))
+            else:
+                print('{:<40} {:>10.1f} {:>8} {:>10} {:>8.3f}'.format(path, r['seconds'], r['step'], r['samples'], r['psnr']))
+        return 0
+    if len(args.path) > 1:
+        parser.error('summarise one run at a time, several paths need --target_psnr')
+    path = args.path[0]
+    rows = summarize(load(path), args.threshold)
+    if not rows:
+        print('no training steps in {}'.format(path))
+        return 1
+    print('{:>6} {:>7} {:>9} {:>9} {:>13} {:>11} {:>10}  {}'.format(
+        'epoch', 'steps', 'loader', 'compute', 'loader steps', 'samples/s', 'peak MB', 'bound by'))
+    for r in rows:
+        print('{:>6} {:>7} {:>9.1%} {:>9.1%} {:>13.1%} {:>11.2f} {:>10.1f}  {}'.format(
+            r['epoch'], r['steps'], r['loader_fraction'], r['compute_fraction'], r['loader_bound_steps'],
+            r['samples_per_s'], r['peak_memory_mb'], 'loader' if r['loader_fraction'] > args.threshold else 'compute'))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
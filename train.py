@@ -2,27 +2,34 @@ import os
 import cv2
 import math
 import time
+import json
+import resource
 import torch
-# import torch.distributed as dist
+import torch.distributed as dist
 import numpy as np
 import random
 import argparse
 
 # from model.RIFE import Model
 from train_log.RIFE_HDv3 import Model
+from train_log.IFNet_HDv3 import parse_sizes
 from dataset import *
+from profiler import ModuleProfiler
+from telemetry import Telemetry
+from checkpoint import CheckpointManager, ResumableSampler, SeededDataset, rng_state, set_rng_state
+from curriculum import CurriculumBatchSampler, parse_curriculum
 from torch.utils.data import DataLoader, Dataset
 # from torch.utils.tensorboard import SummaryWriter
 # from torch.utils.data.distributed import DistributedSampler
 
-device = torch.device("cuda")
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 log_path = 'train_log'
 
 # Freeze early blocks and entry layers, fine-tune the rest
 def freeze_layers(model):
     for name, param in model.flownet.named_parameters():
-        if "block0" in name or "block1" in name or "block_tea" in name:
+        if "block0" in name or "block1" in name or "teacher" in name or "caltime" in name:
             param.requires_grad = False
         elif "conv0" in name:
             param.requires_grad = False
@@ -32,13 +39,41 @@ def freeze_layers(model):
     # for name, param in model.flownet.named_parameters():
     #     print(f"{name}: {'Frozen' if not param.requires_grad else 'Trainable'}")
 
-def get_learning_rate(step):
-    if step < 2000:
-        mul = step / 2000.
-        return 3e-4 * mul
+# IFNet.teacher and caltime are never used by forward; DDP and AdamW must not see them
+def freeze_unused(model):
+    for name, param in model.flownet.named_parameters():
+        if name.startswith('teacher.') or name.startswith('caltime.'):
+            param.requires_grad = False
+
+def get_learning_rate(samples, batch_size):
+    # Warmup and cosine decay run over samples seen rather than steps, so a curriculum
+    # whose batch size changes keeps the schedule; at a fixed batch size this is the step schedule
+    warmup = 2000 * args.batch_size
+    if samples < warmup:
+        mul = samples / warmup
+        lr = 3e-4 * mul
     else:
-        mul = np.cos((step - 2000) / (args.epoch * args.step_per_epoch - 2000.) * math.pi) * 0.5 + 0.5
-        return (3e-4 - 3e-6) * mul + 3e-6
+        mul = np.cos((samples - warmup) / (args.epoch * args.samples_per_epoch - warmup) * math.pi) * 0.5 + 0.5
+        lr = (3e-4 - 3e-6) * mul + 3e-6
+    if args.lr_batch_scaling == 'linear':
+        lr *= batch_size / args.batch_size
+    elif args.lr_batch_scaling == 'sqrt':
+        lr *= math.sqrt(batch_size / args.batch_size)
+    return lr
+
+def reduce_mean(value):
+    # Average a scalar over all ranks
+    if args.world_size == 1:
+        return float(value)
+    value = torch.tensor(float(value), device=device)
+    dist.all_reduce(value)
+    return value.item() / args.world_size
+
+def peak_memory_mb():
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated() / 2 ** 20
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
 
 def flow2rgb(flow_map_np):
     h, w, _ = flow_map_np.shape
@@ -57,37 +92,105 @@ def flow2rgb(flow_map_np):
 #     else:
 #         writer = None
 #         writer_val = None
-def train(model):
+def save_checkpoint(checkpoints, model, step, epoch, batch, sample, samples_seen, nr_eval):
+    # Every rank's RNG state is kept, so a resumed run with the same world size continues identically
+    states = [None] * args.world_size
+    if args.world_size > 1:
+        dist.all_gather_object(states, rng_state())
+    else:
+        states[0] = rng_state()
+    if args.rank == 0:
+        checkpoints.save(step, {'model': model.training_state(), 'step': step, 'epoch': epoch, 'batch': batch,
+                                'sample': sample, 'samples_seen': samples_seen, 'nr_eval': nr_eval,
+                                'rng': states, 'world_size': args.world_size})
+
+def train(model, local_rank, resume=None):
     writer = None
     writer_val = None
     step = 0
     nr_eval = 0
+    start_epoch = 1
+    start_batch = 0
+    start_sample = 0
+    samples_seen = 0
+    if resume is not None:
+        step, nr_eval, start_epoch, start_batch = resume['step'], resume['nr_eval'], resume['epoch'], resume['batch']
+        # Checkpoints from before the curriculum only counted batches of args.batch_size
+        start_sample = resume.get('sample', start_batch * args.batch_size)
+        samples_seen = resume.get('samples_seen', step * args.batch_size)
     # dataset = VimeoDataset('train')
-    dataset = SportsSloMoDataset('train', data_root='/scratch/rrm9598/hpml/acv/SportsSloMo/SportsSloMo_frames/')
-    # sampler = DistributedSampler(dataset)
-    # train_data = DataLoader(dataset, batch_size=args.batch_size, num_workers=8, pin_memory=True, drop_last=True, sampler=sampler)
-    train_data = DataLoader(dataset, batch_size=args.batch_size, num_workers=8, pin_memory=True, drop_last=True, sampler=None)
-    args.step_per_epoch = train_data.__len__()
+    if args.shard_root:
+        # The shard stream splits and positions itself, so it also stands in for the sampler
+        dataset = sampler = ShardedSportsSloMoDataset(args.shard_root, args.batch_size, num_workers=args.num_workers,
+                                                      num_replicas=args.world_size, rank=args.rank,
+                                                      shuffle_buffer=args.shuffle_buffer, seed=args.seed,
+                                                      heatmap_root=args.heatmap_root)
+        train_data = DataLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers, pin_memory=True, drop_last=True)
+    else:
+        dataset = SeededDataset(SportsSloMoDataset('train', data_root=args.data_root, heatmap_root=args.heatmap_root), args.seed)
+        # Shuffled across replicas like DistributedSampler; a single process keeps the dataset order
+        sampler = ResumableSampler(dataset, num_replicas=args.world_size, rank=args.rank, shuffle=args.world_size > 1, seed=args.seed)
+        if args.curriculum:
+            batch_sampler = CurriculumBatchSampler(sampler, parse_curriculum(args.curriculum, args.batch_size, dataset.dataset.crop_h), start_step=step)
+            train_data = DataLoader(dataset, batch_sampler=batch_sampler, num_workers=args.num_workers, pin_memory=True)
+        else:
+            train_data = DataLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers, pin_memory=True, drop_last=True, sampler=sampler)
+    args.samples_per_epoch = sampler.num_samples
+    args.step_per_epoch = sampler.num_samples // args.batch_size
+    checkpoints = CheckpointManager(args.checkpoint_dir, keep=args.keep_checkpoints) if args.rank == 0 else None
     # dataset_val = VimeoDataset('validation')
-    dataset_val = SportsSloMoDataset('validation', data_root='/scratch/rrm9598/hpml/acv/SportsSloMo/SportsSloMo_frames/')
-
-    val_data = DataLoader(dataset_val, batch_size=16, pin_memory=True, num_workers=8)
-    print('training...')
+    # Only rank 0 validates, the other ranks wait at their next all-reduce
+    val_subset = load_val_subset(args.data_root, args.val_windows, args.seed, device) if args.rank == 0 and args.val_windows else None
+    profiler = None
+    if args.profile:
+        trace_steps = tuple(int(s) for s in args.trace_steps.split(':')) if args.trace_steps else None
+        profiler = ModuleProfiler.for_model(model, detail=args.profile_detail, trace_dir=args.trace_dir, trace_steps=trace_steps).attach()
+    telemetry = None
+    if args.telemetry and args.rank == 0:
+        # A resumed run continues the records of the run it resumes
+        telemetry = Telemetry(args.telemetry, tensorboard_dir=args.tensorboard_dir, append=resume is not None)
+    if args.rank == 0:
+        print('training...')
     time_stamp = time.time()
-    for epoch in range(1, args.epoch + 1):
-        # sampler.set_epoch(epoch)
-        for i, data in enumerate(train_data):
+    throughput_start = None
+    for epoch in range(start_epoch, args.epoch + 1):
+        sampler.set_position(epoch, start_sample)
+        sample = start_sample
+        dataset.set_epoch(epoch)
+        batches = iter(train_data)
+        if resume is not None:
+            # Restored after the loader has drawn its worker seeds, as at the saved step
+            set_rng_state(resume['rng'][args.rank if resume['world_size'] == args.world_size else 0])
+            resume = None
+        for i, data in enumerate(batches, start_batch):
             data_time_interval = time.time() - time_stamp
             time_stamp = time.time()
-            data_gpu, timestep = data
+            data_gpu, timestep = data[:2]
             data_gpu = data_gpu.to(device, non_blocking=True) / 255.
             timestep = timestep.to(device, non_blocking=True)
+            gt_heatmaps = data[2].to(device, non_blocking=True) if args.heatmap_root else None
             imgs = data_gpu[:, :6]
             gt = data_gpu[:, 6:9]
+            batch_size = data_gpu.shape[0]
             # learning_rate = get_learning_rate(step) * args.world_size / 4
-            learning_rate = get_learning_rate(step)
-            pred, info = model.update(imgs, gt, learning_rate, training=True) # pass timestep if you are training RIFEm
+            learning_rate = get_learning_rate(samples_seen, batch_size)
+            if device.type == 'cuda':
+                torch.cuda.reset_peak_memory_stats()
+            pred, info = model.update(imgs, gt, learning_rate, training=True, gt_heatmaps=gt_heatmaps) # pass timestep if you are training RIFEm
+            if device.type == 'cuda':
+                # Wait for the step here, so its kernels are not counted as loader wait in the next step
+                torch.cuda.synchronize()
             train_time_interval = time.time() - time_stamp
+            if telemetry is not None:
+                telemetry.log(step, epoch=epoch, step_time=train_time_interval, loader_wait=data_time_interval,
+                              samples_per_s=batch_size * args.world_size / (train_time_interval + data_time_interval),
+                              samples_seen=(samples_seen + batch_size) * args.world_size, batch_size=batch_size, crop=data_gpu.shape[-1],
+                              learning_rate=learning_rate, peak_memory_mb=peak_memory_mb(),
+                              **{name: info[name] for name in ['loss_l1', 'loss_smooth', 'loss_vgg', 'loss_kpt', 'loss_distill']})
+            if profiler is not None:
+                profiler.step()
+                if profiler.steps % args.profile_interval == 0 and args.rank == 0:
+                    print(profiler.format_summary())
             time_stamp = time.time()
             # if step % 200 == 1 and local_rank == 0:
                 # writer.add_scalar('learning_rate', learning_rate, step)
@@ -107,81 +210,209 @@ def train(model):
                     # writer.add_image(str(i) + '/flow', np.concatenate((flow2rgb(flow0[i]), flow2rgb(flow1[i])), 1), step, dataformats='HWC')
                     # writer.add_image(str(i) + '/mask', mask[i], step, dataformats='HWC')
                 # writer.flush()
-            # if local_rank == 0:
-            print('epoch:{} {}/{} time:{:.2f}+{:.2f} loss_l1:{:.4e}'.format(epoch, i, args.step_per_epoch, data_time_interval, train_time_interval, info['loss_l1']))
+            loss_l1 = reduce_mean(info['loss_l1'].detach())
+            if args.rank == 0:
+                print('epoch:{} {}/{} time:{:.2f}+{:.2f} loss_l1:{:.4e}'.format(epoch, i, args.step_per_epoch, data_time_interval, train_time_interval, loss_l1))
             step += 1
+            sample += batch_size
+            samples_seen += batch_size
+            if step == args.throughput_warmup:
+                throughput_start = time.time()
+                throughput_samples = samples_seen
+            if args.checkpoint_interval and step % args.checkpoint_interval == 0:
+                save_checkpoint(checkpoints, model, step, epoch, i + 1, sample, samples_seen, nr_eval)
+            if val_subset is not None and args.val_interval and step % args.val_interval == 0:
+                evaluate(model, val_subset, step, telemetry)
+                time_stamp = time.time()
+            if args.max_steps and step >= args.max_steps:
+                break
+        start_batch = 0
+        start_sample = 0
+        if args.loss_schedule:
+            if args.rank == 0:
+                print('epoch:{} loss compute per term: {}'.format(epoch, model.loss_schedule.format_usage()))
+            model.loss_schedule.reset_usage()
+        if args.max_steps and step >= args.max_steps:
+            break
         nr_eval += 1
-        if nr_eval % 5 == 0:
+        if nr_eval % 5 == 0 and val_subset is not None and not args.val_interval:
             # evaluate(model, val_data, step, local_rank, writer_val)
-            evaluate(model, val_data, step)
-        # model.save_model(log_path, local_rank)    
-        model.save_model(log_path)    
-        # dist.barrier()
+            evaluate(model, val_subset, step, telemetry)
+        model.save_model(args.model_dir, args.rank)
+        if args.world_size > 1:
+            dist.barrier()
+    if throughput_start is not None and step > args.throughput_warmup:
+        elapsed = time.time() - throughput_start
+        samples = (samples_seen - throughput_samples) * args.world_size
+        if args.rank == 0:
+            print('throughput: {:.2f} samples/s over {} processes'.format(samples / elapsed, args.world_size))
+            if args.report:
+                with open(args.report, 'w') as f:
+                    json.dump({'world_size': args.world_size, 'backend': args.backend, 'batch_size': args.batch_size,
+                               'steps': step - args.throughput_warmup, 'seconds': elapsed, 'samples_per_s': samples / elapsed}, f)
+    if telemetry is not None:
+        telemetry.close()
+    if checkpoints is not None:
+        checkpoints.wait()
 
 # def evaluate(model, val_data, nr_eval, local_rank, writer_val):
-def evaluate(model, val_data, nr_eval):
-    loss_l1_list = []
-    loss_distill_list = []
-    loss_tea_list = []
-    psnr_list = []
-    psnr_list_teacher = []
+def evaluate(model, val_subset, step, telemetry=None):
+    """PSNR of Model.inference on the cached validation subset, computed on the device."""
+    frames, timesteps = val_subset
+    psnr = []
+    model.eval()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
     time_stamp = time.time()
-    for i, data in enumerate(val_data):
-        data_gpu, timestep = data
-        data_gpu = data_gpu.to(device, non_blocking=True) / 255.        
-        imgs = data_gpu[:, :6]
-        gt = data_gpu[:, 6:9]
-        with torch.no_grad():
-            pred, info = model.update(imgs, gt, training=False)
-            merged_img = info['merged_tea']
-        loss_l1_list.append(info['loss_l1'].cpu().numpy())
-        loss_tea_list.append(info['loss_tea'].cpu().numpy())
-        loss_distill_list.append(info['loss_distill'].cpu().numpy())
-        for j in range(gt.shape[0]):
-            psnr = -10 * math.log10(torch.mean((gt[j] - pred[j]) * (gt[j] - pred[j])).cpu().data)
-            psnr_list.append(psnr)
-            psnr = -10 * math.log10(torch.mean((merged_img[j] - gt[j]) * (merged_img[j] - gt[j])).cpu().data)
-            psnr_list_teacher.append(psnr)
-        gt = (gt.permute(0, 2, 3, 1).cpu().numpy() * 255).astype('uint8')
-        pred = (pred.permute(0, 2, 3, 1).cpu().numpy() * 255).astype('uint8')
-        merged_img = (merged_img.permute(0, 2, 3, 1).cpu().numpy() * 255).astype('uint8')
-        flow0 = info['flow'].permute(0, 2, 3, 1).cpu().numpy()
-        flow1 = info['flow_tea'].permute(0, 2, 3, 1).cpu().numpy()
-        # if i == 0 and local_rank == 0:
-        #     for j in range(10):
-        #         imgs = np.concatenate((merged_img[j], pred[j], gt[j]), 1)[:, :, ::-1]
-        #         writer_val.add_image(str(j) + '/img', imgs.copy(), nr_eval, dataformats='HWC')
-        #         writer_val.add_image(str(j) + '/flow', flow2rgb(flow0[j][:, :, ::-1]), nr_eval, dataformats='HWC')
-    
+    with torch.no_grad():
+        for b in range(0, frames.shape[0], args.val_batch_size):
+            data_gpu = frames[b:b + args.val_batch_size].float() / 255.
+            img0 = data_gpu[:, :3]
+            img1 = data_gpu[:, 3:6]
+            gt = data_gpu[:, 6:9]
+            pred = model.inference(img0, img1, timesteps[b:b + args.val_batch_size])
+            mse = ((pred - gt) ** 2).mean((1, 2, 3))
+            psnr.append(-10 * torch.log10(mse))
+    psnr = torch.cat(psnr).mean().item()
     eval_time_interval = time.time() - time_stamp
+    model.train()
+    samples_per_s = frames.shape[0] / eval_time_interval
+    print('step:{} val psnr:{:.3f} time:{:.2f}s ({:.2f} samples/s)'.format(step, psnr, eval_time_interval, samples_per_s))
+    if telemetry is not None:
+        telemetry.log(step, kind='val', psnr=psnr, eval_time=eval_time_interval, samples_per_s=samples_per_s)
+    return psnr
 
-    # if local_rank != 0:
-    #     return
-    # writer_val.add_scalar('psnr', np.array(psnr_list).mean(), nr_eval)
-    # writer_val.add_scalar('psnr_teacher', np.array(psnr_list_teacher).mean(), nr_eval)
-        
 if __name__ == "__main__":    
     parser = argparse.ArgumentParser()
     # parser.add_argument('--epoch', default=300, type=int)
     parser.add_argument('--epoch', default=1, type=int)
-    parser.add_argument('--batch_size', default=16, type=int, help='minibatch size')
-    # parser.add_argument('--local_rank', default=0, type=int, help='local rank')
-    # parser.add_argument('--world_size', default=4, type=int, help='world size')
+    parser.add_argument('--batch_size', default=None, type=int, help='minibatch size, from --tuned_config or 16')
+    parser.add_argument('--amp', action='store_true', help='mixed-precision forward with gradient scaling')
+    parser.add_argument('--amp_dtype', default=None, type=str, choices=['float16', 'bfloat16'], help='defaults to float16 on GPU, bfloat16 on CPU')
+    parser.add_argument('--loss_schedule', default=None, type=str, help="when the vgg and kpt terms run, e.g. 'vgg=every:2,kpt=subset:0.25'")
+    parser.add_argument('--checkpointing', default=None, type=str, help="recompute IFBlock activations in backward, e.g. 'all' or '0:conv0,1,2'")
+    parser.add_argument('--frozen_prefix', default=0, type=int, help='run this many leading (frozen) IFBlocks without autograd')
+    parser.add_argument('--prefix_dtype', default=None, type=str, choices=['float16', 'bfloat16'], help='reduced precision for the frozen prefix')
+    parser.add_argument('--model_dir', default=log_path, type=str, help='where flownet.pkl is loaded from and saved to')
+    parser.add_argument('--teacher_dir', default=None, type=str, help='distill the flownet from the checkpoint in this directory')
+    parser.add_argument('--distill_weight', default=1., type=float, help='weight of the flow, mask and frame distillation loss')
+    parser.add_argument('--widths', default=None, type=str, help="IFBlock widths of a new student, e.g. '128,96,48,24'")
+    parser.add_argument('--depths', default=None, type=str, help="ResConv count per IFBlock of a new student, e.g. '4,4,4,4'")
+    parser.add_argument('--curriculum', default=None, type=str,
+                        help="crop-size stages 'step:crop[:batch],...', e.g. '0:256,20000:384,60000:640'; "
+                             "a stage without a batch keeps the pixels per batch of 640 crops at --batch_size")
+    parser.add_argument('--lr_batch_scaling', default='none', type=str, choices=['none', 'sqrt', 'linear'],
+                        help='scale the learning rate with the stage batch size relative to --batch_size')
+    parser.add_argument('--profile', action='store_true', help='attach per-module timing and memory hooks')
+    parser.add_argument('--profile_detail', action='store_true', help='also profile conv0/convblock/lastconv of each IFBlock')
+    parser.add_argument('--profile_interval', default=100, type=int, help='steps between profiler summaries')
+    parser.add_argument('--trace_steps', default=None, type=str, help='record a Chrome trace for steps first:last')
+    parser.add_argument('--trace_dir', default='train_log/trace', type=str)
+    parser.add_argument('--data_root', default='/scratch/rrm9598/hpml/acv/SportsSloMo/SportsSloMo_frames/', type=str)
+    parser.add_argument('--shard_root', default=None, type=str, help='stream training windows from make_shards.py shards instead of --data_root')
+    parser.add_argument('--shuffle_buffer', default=256, type=int, help='windows held by each loader worker to shuffle shard reads')
+    parser.add_argument('--heatmap_root', default=None, type=str, help='ground-truth heatmaps from extract_heatmaps.py')
+    parser.add_argument('--telemetry', default='train_log/telemetry.jsonl', type=str, help="per-step metrics JSONL, overwritten unless resuming, '' disables it")
+    parser.add_argument('--tensorboard_dir', default=None, type=str, help='also write the metrics to TensorBoard')
+    parser.add_argument('--val_windows', default=64, type=int, help='size of the fixed validation subset (0 disables validation)')
+    parser.add_argument('--val_interval', default=0, type=int, help='steps between validations, 0 validates every 5 epochs')
+    parser.add_argument('--val_batch_size', default=8, type=int)
+    parser.add_argument('--checkpoint_dir', default='train_log/checkpoints', type=str)
+    parser.add_argument('--checkpoint_interval', default=1000, type=int, help='steps between resumable checkpoints (0 disables them)')
+    parser.add_argument('--keep_checkpoints', default=3, type=int, help='number of newest checkpoints kept')
+    parser.add_argument('--resume', nargs='?', const='latest', default=None, type=str, help='resume from a checkpoint file, or the latest in --checkpoint_dir')
+    parser.add_argument('--seed', default=1234, type=int)
+    parser.add_argument('--deterministic', action='store_true', help='deterministic cuDNN kernels, for bit-exact resumes on GPU')
+    parser.add_argument('--num_workers', default=None, type=int, help='DataLoader workers per process, from --tuned_config or 8')
+    parser.add_argument('--tuned_config', default='train_log/tuned.json', type=str,
+                        help="batch size and worker count written by tune_loader.py, used unless given explicitly ('' ignores it)")
+    parser.add_argument('--backend', default=None, type=str, help='process group backend, nccl with GPUs and gloo otherwise')
+    parser.add_argument('--max_steps', default=0, type=int, help='stop after this many steps (0 trains every epoch)')
+    parser.add_argument('--throughput_warmup', default=5, type=int, help='steps excluded from the throughput figure')
+    parser.add_argument('--report', default=None, type=str, help='write the throughput figure to this JSON file')
     args = parser.parse_args()
-    # torch.distributed.init_process_group(backend="nccl", world_size=args.world_size)
-    # torch.cuda.set_device(args.local_rank)
-    seed = 1234
+    if args.teacher_dir is not None and os.path.abspath(args.teacher_dir) == os.path.abspath(args.model_dir):
+        parser.error('--model_dir must differ from --teacher_dir, the student would overwrite its teacher')
+    if args.shard_root and args.curriculum:
+        parser.error('--curriculum needs map-style data and cannot be combined with --shard_root')
+    if args.heatmap_root and args.curriculum:
+        parser.error('--curriculum changes the crop size and cannot be combined with --heatmap_root, whose heatmaps are cached for 640 crops')
+    # Launched by torchrun, which sets the rank environment variables
+    args.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    args.rank = int(os.environ.get('RANK', 0))
+    args.world_size = int(os.environ.get('WORLD_SIZE', 1))
+    tuned = {}
+    if args.tuned_config and os.path.exists(args.tuned_config):
+        with open(args.tuned_config) as f:
+            tuned = json.load(f)
+    for name, default in [('batch_size', 16), ('num_workers', 8)]:
+        if getattr(args, name) is None:
+            setattr(args, name, tuned.get(name, default))
+            if name in tuned and args.rank == 0:
+                print('{} {} from {}'.format(name, tuned[name], args.tuned_config))
+    if args.backend is None:
+        args.backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    if args.world_size > 1:
+        if torch.cuda.is_available():
+            torch.cuda.set_device(args.local_rank)
+        else:
+            # torchrun limits every process to one thread; share the cores instead
+            torch.set_num_threads(max(1, os.cpu_count() // int(os.environ.get('LOCAL_WORLD_SIZE', args.world_size))))
+        dist.init_process_group(backend=args.backend, world_size=args.world_size, rank=args.rank)
+    seed = args.seed
     random.seed(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
-    torch.backends.cudnn.benchmark = True
+    torch.backends.cudnn.benchmark = not args.deterministic
+    torch.backends.cudnn.deterministic = args.deterministic
     # model = Model(args.local_rank)
-    model = Model()
-    print('loading pretrained model...')
-    model.load_model('train_log', -1)
-    print('freezing model layers...')
-    freeze_layers(model)
-    # train(model, args.local_rank)
-    train(model)
+    dtypes = {'float16': torch.float16, 'bfloat16': torch.bfloat16}
+    config = {}
+    if args.widths:
+        config['widths'] = list(parse_sizes(args.widths))
+    if args.depths:
+        config['depths'] = list(parse_sizes(args.depths))
+    model = Model(amp=args.amp, amp_dtype=dtypes.get(args.amp_dtype), checkpointing=args.checkpointing,
+                  frozen_prefix=args.frozen_prefix, prefix_dtype=dtypes.get(args.prefix_dtype), loss_schedule=args.loss_schedule,
+                  config=config)
+    # A distilled student starts from scratch unless --model_dir already holds one
+    if args.teacher_dir is None or os.path.exists(os.path.join(args.model_dir, 'flownet.pkl')):
+        if args.rank == 0:
+            print('loading pretrained model...')
+        model.load_model(args.model_dir, -1)
+        for key, value in config.items():
+            if model.flownet.config()[key] != value:
+                raise ValueError('--{} {} does not match the model in {}'.format(key, ','.join(map(str, value)), args.model_dir))
+    elif args.rank == 0:
+        os.makedirs(args.model_dir, exist_ok=True)
+    if args.teacher_dir is not None:
+        if args.rank == 0:
+            print('distilling {} into {} {}...'.format(args.teacher_dir, args.model_dir, model.flownet.config()))
+        model.set_teacher(args.teacher_dir, args.distill_weight)
+    else:
+        # Fine-tuning freezes the early blocks, a distilled student trains every layer
+        if args.rank == 0:
+            print('freezing model layers...')
+        freeze_layers(model)
+    freeze_unused(model)
+    for name, param in model.flownet.named_parameters():
+        if param.requires_grad and any(name.startswith('block{}.'.format(i)) for i in range(args.frozen_prefix)):
+            raise ValueError('--frozen_prefix {} requires {} to be frozen'.format(args.frozen_prefix, name))
+    model.reset_optimizer()
+    resume = None
+    if args.resume:
+        checkpoints = CheckpointManager(args.checkpoint_dir)
+        path = checkpoints.latest() if args.resume == 'latest' else args.resume
+        if path is None:
+            raise FileNotFoundError('no checkpoint to resume from in {}'.format(args.checkpoint_dir))
+        if args.rank == 0:
+            print('resuming from {}...'.format(path))
+        resume = checkpoints.load(path)
+        model.load_training_state(resume['model'])
+    if args.world_size > 1:
+        model.distribute(args.local_rank)
+    train(model, args.local_rank, resume)
+    if args.world_size > 1:
+        dist.destroy_process_group()
         
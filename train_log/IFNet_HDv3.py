@@ -1,6 +1,10 @@
+import os
+import json
+import contextlib
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from model.warplayer import warp
 # from train_log.refine import *
 
@@ -54,48 +58,96 @@ class ResConv(nn.Module):
         return self.relu(self.conv(x) * self.beta + x)
 
 class IFBlock(nn.Module):
-    def __init__(self, in_planes, c=64):
+    def __init__(self, in_planes, c=64, depth=8, mid=None):
         super(IFBlock, self).__init__()
+        mid = c//2 if mid is None else mid
         self.conv0 = nn.Sequential(
-            conv(in_planes, c//2, 3, 2, 1),
-            conv(c//2, c, 3, 2, 1),
+            conv(in_planes, mid, 3, 2, 1),
+            conv(mid, c, 3, 2, 1),
             )
-        self.convblock = nn.Sequential(
-            ResConv(c),
-            ResConv(c),
-            ResConv(c),
-            ResConv(c),
-            ResConv(c),
-            ResConv(c),
-            ResConv(c),
-            ResConv(c),
-        )
+        self.convblock = nn.Sequential(*[ResConv(c) for _ in range(depth)])
         self.lastconv = nn.Sequential(
             nn.ConvTranspose2d(c, 4*13, 4, 2, 1),
             nn.PixelShuffle(2)
         )
+        # Parts whose activations are recomputed in backward: 'convblock' and optionally 'conv0'
+        self.recompute = ()
+
+    def features(self, x):
+        return self.convblock(self.conv0(x))
 
     def forward(self, x, flow=None, scale=1):
         x = F.interpolate(x, scale_factor= 1. / scale, mode="bilinear", align_corners=False)
         if flow is not None:
             flow = F.interpolate(flow, scale_factor= 1. / scale, mode="bilinear", align_corners=False) * 1. / scale
             x = torch.cat((x, flow), 1)
-        feat = self.conv0(x)
-        feat = self.convblock(feat)
+        if self.recompute and self.training and torch.is_grad_enabled():
+            if 'conv0' in self.recompute:
+                feat = checkpoint(self.features, x, use_reentrant=False)
+            else:
+                feat = checkpoint(self.convblock, self.conv0(x), use_reentrant=False)
+        else:
+            feat = self.features(x)
         tmp = self.lastconv(feat)
         tmp = F.interpolate(tmp, scale_factor=scale, mode="bilinear", align_corners=False)
         flow = tmp[:, :4] * scale
         mask = tmp[:, 4:5]
         feat = tmp[:, 5:]
         return flow, mask, feat
-        
+
+def parse_checkpointing(spec):
+    """Parse '0:conv0,1,2' into {0: ('convblock', 'conv0'), 1: ('convblock',), 2: ('convblock',)}.
+
+    'all' checkpoints the convblock of every block, 'all:conv0' also its conv0.
+    """
+    recompute = {}
+    if not spec:
+        return recompute
+    for entry in spec.split(','):
+        index, _, part = entry.partition(':')
+        if part not in ('', 'conv0'):
+            raise ValueError('unknown checkpointing part {!r}, expected conv0'.format(part))
+        parts = ('convblock', 'conv0') if part else ('convblock',)
+        for i in (range(4) if index == 'all' else [int(index)]):
+            recompute[i] = parts
+    return recompute
+
+# Width c and ResConv count of block0..block3 in the released model
+WIDTHS = (256, 192, 96, 48)
+DEPTHS = (8, 8, 8, 8)
+
+def read_config(model_dir):
+    """IFNet keyword arguments stored next to model_dir/flownet.pkl, {} for the default architecture."""
+    path = os.path.join(model_dir, 'flownet.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def full_config(config):
+    """IFNet keyword arguments with the defaults filled in, comparable with IFNet.config()."""
+    widths = list(config.get('widths', WIDTHS))
+    return {'widths': widths, 'depths': list(config.get('depths', DEPTHS)),
+            'mids': list(config.get('mids') or [c // 2 for c in widths])}
+
+def parse_sizes(spec):
+    """'128,96,48,24' into a tuple of four ints, one per block."""
+    sizes = tuple(int(v) for v in spec.split(','))
+    if len(sizes) != 4:
+        raise ValueError('expected one value per IFBlock, got {!r}'.format(spec))
+    return sizes
+
 class IFNet(nn.Module):
-    def __init__(self):
+    def __init__(self, widths=WIDTHS, depths=DEPTHS, mids=None):
         super(IFNet, self).__init__()
-        self.block0 = IFBlock(7+16, c=256)
-        self.block1 = IFBlock(8+4+16+8, c=192)
-        self.block2 = IFBlock(8+4+16+8, c=96)
-        self.block3 = IFBlock(8+4+16+8, c=48)
+        self.widths = tuple(widths)
+        self.depths = tuple(depths)
+        # Hidden width of each conv0, half the block width unless pruning kept it apart
+        self.mids = tuple(mids) if mids is not None else tuple(c // 2 for c in self.widths)
+        self.block0 = IFBlock(7+16, c=self.widths[0], depth=self.depths[0], mid=self.mids[0])
+        self.block1 = IFBlock(8+4+16+8, c=self.widths[1], depth=self.depths[1], mid=self.mids[1])
+        self.block2 = IFBlock(8+4+16+8, c=self.widths[2], depth=self.depths[2], mid=self.mids[2])
+        self.block3 = IFBlock(8+4+16+8, c=self.widths[3], depth=self.depths[3], mid=self.mids[3])
         self.encode = Head()
 
         # not used during inference
@@ -112,6 +164,39 @@ class IFNet(nn.Module):
             nn.Conv2d(64, 1, 3, 1, 1),
             nn.Sigmoid()
         )
+        # Leading blocks run without autograd while training, see set_frozen_prefix
+        self.frozen_prefix = 0
+        self.prefix_dtype = None
+
+    def config(self):
+        """Keyword arguments that rebuild this architecture, saved as flownet.json."""
+        return {'widths': list(self.widths), 'depths': list(self.depths), 'mids': list(self.mids)}
+
+    def set_frozen_prefix(self, n, dtype=None):
+        """Run block0..block{n-1} under no_grad while training, in dtype if given.
+
+        Only valid when those blocks are frozen. The encoder then receives no
+        gradient through them, only through the later blocks.
+        """
+        self.frozen_prefix = n
+        self.prefix_dtype = dtype
+
+    def in_prefix(self, i):
+        return self.training and i < self.frozen_prefix
+
+    def prefix_context(self, i):
+        stack = contextlib.ExitStack()
+        if self.in_prefix(i):
+            stack.enter_context(torch.no_grad())
+            if self.prefix_dtype is not None:
+                stack.enter_context(torch.autocast(device_type=device.type, dtype=self.prefix_dtype))
+        return stack
+
+    def set_checkpointing(self, spec):
+        """Trade compute for memory by recomputing IFBlock activations in backward, see parse_checkpointing."""
+        recompute = parse_checkpointing(spec) if isinstance(spec, str) or spec is None else spec
+        for i, block in enumerate([self.block0, self.block1, self.block2, self.block3]):
+            block.recompute = recompute.get(i, ())
 
     def forward(self, x, timestep=0.5, scale_list=[8, 4, 2, 1], training=False, fastmode=True, ensemble=False):
         if training == False:
@@ -141,24 +226,27 @@ class IFNet(nn.Module):
         loss_cons = 0
         block = [self.block0, self.block1, self.block2, self.block3]
         for i in range(4):
-            if flow is None:
-                flow, mask, feat = block[i](torch.cat((img0[:, :3], img1[:, :3], f0, f1, timestep), 1), None, scale=scale_list[i])
-                if ensemble:
-                    print("warning: ensemble is not supported since RIFEv4.21")
-            else:
-                wf0 = warp(f0, flow[:, :2])
-                wf1 = warp(f1, flow[:, 2:4])
-                fd, m0, feat = block[i](torch.cat((warped_img0[:, :3], warped_img1[:, :3], wf0, wf1, timestep, mask, feat), 1), flow, scale=scale_list[i])
-                if ensemble:
-                    print("warning: ensemble is not supported since RIFEv4.21")
+            with self.prefix_context(i):
+                if flow is None:
+                    flow, mask, feat = block[i](torch.cat((img0[:, :3], img1[:, :3], f0, f1, timestep), 1), None, scale=scale_list[i])
+                    if ensemble:
+                        print("warning: ensemble is not supported since RIFEv4.21")
                 else:
-                    mask = m0
-                flow = flow + fd
-            mask_list.append(mask)
-            flow_list.append(flow)
-            warped_img0 = warp(img0, flow[:, :2])
-            warped_img1 = warp(img1, flow[:, 2:4])
-            merged.append((warped_img0, warped_img1))
+                    wf0 = warp(f0, flow[:, :2])
+                    wf1 = warp(f1, flow[:, 2:4])
+                    fd, m0, feat = block[i](torch.cat((warped_img0[:, :3], warped_img1[:, :3], wf0, wf1, timestep, mask, feat), 1), flow, scale=scale_list[i])
+                    if ensemble:
+                        print("warning: ensemble is not supported since RIFEv4.21")
+                    else:
+                        mask = m0
+                    flow = flow + fd
+                if self.in_prefix(i) and self.prefix_dtype is not None:
+                    flow, mask, feat = flow.float(), mask.float(), feat.float()
+                mask_list.append(mask)
+                flow_list.append(flow)
+                warped_img0 = warp(img0, flow[:, :2])
+                warped_img1 = warp(img1, flow[:, 2:4])
+                merged.append((warped_img0, warped_img1))
         mask = torch.sigmoid(mask)
         merged[3] = (warped_img0 * mask + warped_img1 * (1 - mask))
         if not fastmode:
@@ -1,3 +1,5 @@
+import os
+import json
 import torch
 import torch.nn as nn
 import numpy as np
@@ -11,6 +13,7 @@ import torch.nn.functional as F
 from model.loss import *
 # from model.laplacian import *
 from model.heatmap_loss import HeatmapInfer
+from model.loss_schedule import LossSchedule
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -20,37 +23,36 @@ class JointsMSELoss(nn.Module):
     Args:
         use_target_weight (bool): Option to use weighted MSE loss.
             Different joint types may have different target weights.
-        loss_weight (float): Weight of the loss. Default: 1.0.
     """
 
     def __init__(self, use_target_weight=False):
         super().__init__()
-        self.criterion = nn.MSELoss(reduce=False)
         self.use_target_weight = use_target_weight
 
-    def forward(self, output, target):
-        """Forward function."""
+    def forward(self, output, target, target_weight=None):
+        """Per-pixel loss (batch, height * width), averaged over joints."""
         batch_size = output.size(0)
         num_joints = output.size(1)
-
-        heatmaps_pred = output.reshape(
-            (batch_size, num_joints, -1)).split(1, 1)
-        heatmaps_gt = target.reshape((batch_size, num_joints, -1)).split(1, 1)
-
-        loss = 0.
-
-        for idx in range(num_joints):
-            heatmap_pred = heatmaps_pred[idx].squeeze(1)
-            heatmap_gt = heatmaps_gt[idx].squeeze(1)
-            loss += self.criterion(heatmap_pred, heatmap_gt)
-
-        return loss / num_joints
+        diff = (output - target).reshape(batch_size, num_joints, -1)
+        if self.use_target_weight and target_weight is not None:
+            # Weighting both heatmaps as in mmpose scales the squared error by weight ** 2
+            diff = diff * target_weight.reshape(batch_size, num_joints, 1)
+        return diff.pow(2).mean(1)
     
 class Model:
-    def __init__(self, local_rank=-1):
-        self.flownet = IFNet()
-        self.device()
+    def __init__(self, local_rank=-1, amp=False, amp_dtype=None, checkpointing=None, frozen_prefix=0, prefix_dtype=None, loss_schedule=None, config=None):
+        self.checkpointing = checkpointing
+        self.frozen_prefix = frozen_prefix
+        self.prefix_dtype = prefix_dtype
+        self.build(config or {})
         self.optimG = AdamW(self.flownet.parameters(), lr=1e-6, weight_decay=1e-4)
+        # Mixed precision: bfloat16 on CPU, float16 on GPU unless amp_dtype says otherwise.
+        # Only float16 needs loss scaling, bfloat16 has the exponent range of float32.
+        self.amp = amp
+        if amp_dtype is None:
+            amp_dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+        self.amp_dtype = amp_dtype
+        self.scaler = torch.cuda.amp.GradScaler(enabled=amp and amp_dtype == torch.float16)
         self.epe = EPE()
         self.version = 4.8
         # self.laploss = LapLoss()
@@ -58,9 +60,42 @@ class Model:
         self.sobel = SOBEL()
         self.HeatmapInfer = HeatmapInfer()
         self.heatmaploss = JointsMSELoss()
+        # Which steps and samples the 'vgg' and 'kpt' terms are computed on
+        self.loss_schedule = LossSchedule(loss_schedule)
+        # Frozen IFNet whose flows, masks and frames the flownet is distilled towards, see set_teacher
+        self.teacher = None
+        self.distill_weight = 1.
         
         if local_rank != -1:
+            self.distribute(local_rank)
+
+    def build(self, config):
+        """(Re)create the flownet with the IFNet keyword arguments in config, see IFNet.config."""
+        self.flownet = IFNet(**config)
+        self.flownet.set_checkpointing(self.checkpointing)
+        self.flownet.set_frozen_prefix(self.frozen_prefix, self.prefix_dtype)
+        self.device()
+
+    def set_teacher(self, path, weight=1.):
+        """Distill from the checkpoint in path: match its flows, mask and merged frame while training."""
+        teacher = IFNet(**read_config(path))
+        state = torch.load('{}/flownet.pkl'.format(path), map_location='cpu')
+        teacher.load_state_dict({k[len("module."):] if k.startswith("module.") else k: v for k, v in state.items()}, False)
+        for param in teacher.parameters():
+            param.requires_grad = False
+        self.teacher = teacher.eval().to(device)
+        self.distill_weight = weight
+
+    def distribute(self, local_rank):
+        # Wrap after loading weights and freezing layers, DDP only reduces parameters that need gradients
+        if device.type == 'cuda':
             self.flownet = DDP(self.flownet, device_ids=[local_rank], output_device=local_rank)
+        else:
+            self.flownet = DDP(self.flownet)
+
+    def reset_optimizer(self):
+        # Rebuild AdamW over the parameters that still require gradients, call after freezing layers
+        self.optimG = AdamW([p for p in self.flownet.parameters() if p.requires_grad], lr=1e-6, weight_decay=1e-4)
 
     def train(self):
         self.flownet.train()
@@ -73,31 +108,82 @@ class Model:
 
     def load_model(self, path, rank=0):
         def convert(param):
-            if rank == -1:
-                return {
-                    k.replace("module.", ""): v
-                    for k, v in param.items()
-                    if "module." in k
-                }
-            else:
-                return param
+            # Checkpoints saved from a DDP-wrapped flownet prefix every key with "module."
+            return {
+                k[len("module."):] if k.startswith("module.") else k: v
+                for k, v in param.items()
+            }
+        flownet = self.flownet.module if isinstance(self.flownet, DDP) else self.flownet
+        # A slimmed IFNet is saved with its widths and depths, rebuild to match before loading
+        config = full_config(read_config(path))
+        if config != flownet.config():
+            self.build(config)
+            self.reset_optimizer()
+            flownet = self.flownet
         if rank <= 0:
             if torch.cuda.is_available():
-                self.flownet.load_state_dict(convert(torch.load('{}/flownet.pkl'.format(path))), False)
+                flownet.load_state_dict(convert(torch.load('{}/flownet.pkl'.format(path))), False)
             else:
-                self.flownet.load_state_dict(convert(torch.load('{}/flownet.pkl'.format(path), map_location ='cpu')), False)
+                flownet.load_state_dict(convert(torch.load('{}/flownet.pkl'.format(path), map_location ='cpu')), False)
         
     def save_model(self, path, rank=0):
         if rank == 0:
-            torch.save(self.flownet.state_dict(),'{}/flownet.pkl'.format(path))
+            flownet = self.flownet.module if isinstance(self.flownet, DDP) else self.flownet
+            # Write next to the target and rename, so an interrupted save never leaves a truncated file
+            torch.save(flownet.state_dict(), '{}/flownet.pkl.tmp'.format(path))
+            os.replace('{}/flownet.pkl.tmp'.format(path), '{}/flownet.pkl'.format(path))
+            with open('{}/flownet.json.tmp'.format(path), 'w') as f:
+                json.dump(flownet.config(), f)
+            os.replace('{}/flownet.json.tmp'.format(path), '{}/flownet.json'.format(path))
+
+    def training_state(self):
+        """Everything besides the data pipeline that a resumed run needs, referencing live tensors."""
+        flownet = self.flownet.module if isinstance(self.flownet, DDP) else self.flownet
+        return {
+            'flownet': flownet.state_dict(),
+            'optimG': self.optimG.state_dict(),
+            'scaler': self.scaler.state_dict(),
+            'loss_schedule': dict(self.loss_schedule.steps),
+        }
+
+    def load_training_state(self, state):
+        flownet = self.flownet.module if isinstance(self.flownet, DDP) else self.flownet
+        flownet.load_state_dict(state['flownet'])
+        self.optimG.load_state_dict(state['optimG'])
+        if state['scaler']:
+            self.scaler.load_state_dict(state['scaler'])
+        self.loss_schedule.steps = dict(state['loss_schedule'])
 
     def inference(self, img0, img1, timestep=0.5, scale=1.0):
         imgs = torch.cat((img0, img1), 1)
         scale_list = [8/scale, 4/scale, 2/scale, 1/scale]
-        flow, mask, merged = self.flownet(imgs, timestep, scale_list)
+        # Bypass DDP, so a single rank can run inference without collectives
+        flownet = self.flownet.module if isinstance(self.flownet, DDP) else self.flownet
+        flow, mask, merged = flownet(imgs, timestep, scale_list)
         return merged[3]
     
-    def update(self, imgs, gt, learning_rate=0, mul=1, training=True, flow_gt=None):
+    def scheduled(self, name, training, *tensors):
+        """(weight, tensors) restricted to the samples the loss schedule picks for a term, None to skip it."""
+        selection = self.loss_schedule.select(name, tensors[0].shape[0], training)
+        if selection is None:
+            return None
+        index, weight = selection
+        if index is not None:
+            index = index.to(tensors[0].device)
+            tensors = [t if t is None else t[index] for t in tensors]
+        return weight, tensors
+
+    def distill_loss(self, flow, mask, merged, flow_tea, mask_tea, merged_tea):
+        """Distance to the teacher's flow at every scale, its final blend mask and its merged frame."""
+        loss_flow = 0
+        for student, teacher in zip(flow, flow_tea):
+            # End-point error, scaled like the distillation term of the original RIFE training
+            loss_flow += ((student.float() - teacher.float()) ** 2).sum(1).add(1e-6).sqrt().mean() * 0.01
+        loss_mask = (torch.sigmoid(mask.float()) - torch.sigmoid(mask_tea.float())).abs().mean()
+        loss_merged = (merged.float() - merged_tea.float()).abs().mean()
+        return loss_flow + loss_mask + loss_merged
+
+    def update(self, imgs, gt, learning_rate=0, mul=1, training=True, flow_gt=None, gt_heatmaps=None):
         for param_group in self.optimG.param_groups:
             param_group['lr'] = learning_rate
         img0 = imgs[:, :3]
@@ -107,21 +193,37 @@ class Model:
         else:
             self.eval()
         scale = [8, 4, 2, 1]
-        # flow, mask, merged = self.flownet(torch.cat((imgs, gt), 1), scale=scale, training=training)
-        flow, mask, merged = self.flownet(torch.cat((imgs, gt), 1), training=training)
-        loss_l1 = (merged[3] - gt).abs().mean()
-        loss_smooth = self.sobel(flow[3], flow[3]*0).mean()
-        predicted_kpt, gt_kpt = self.HeatmapInfer(merged[3], gt)
-        loss_kpt = 0.1 * self.heatmaploss(predicted_kpt, gt_kpt).mean()
-        # loss_lap = self.laploss(merged[3], gt)
-        loss_vgg = self.vgg(merged[3], gt)
+        with torch.autocast(device_type=device.type, dtype=self.amp_dtype, enabled=self.amp):
+            # flow, mask, merged = self.flownet(torch.cat((imgs, gt), 1), scale=scale, training=training)
+            flow, mask, merged = self.flownet(torch.cat((imgs, gt), 1), training=training)
+            loss_kpt = merged[3].new_zeros((), dtype=torch.float32)
+            picked = self.scheduled('kpt', training, merged[3], gt, gt_heatmaps)
+            if picked is not None:
+                weight, (pred_k, gt_k, heatmaps_k) = picked
+                predicted_kpt, gt_kpt = self.HeatmapInfer(pred_k, gt_k, heatmaps_k)
+                loss_kpt = weight * 0.1 * self.heatmaploss(predicted_kpt.float(), gt_kpt.float()).mean()
+            # loss_lap = self.laploss(merged[3], gt)
+            loss_vgg = merged[3].new_zeros((), dtype=torch.float32)
+            picked = self.scheduled('vgg', training, merged[3], gt)
+            if picked is not None:
+                weight, (pred_v, gt_v) = picked
+                loss_vgg = weight * self.vgg(pred_v, gt_v).float()
+            loss_distill = merged[3].new_zeros((), dtype=torch.float32)
+            if self.teacher is not None and training:
+                with torch.no_grad():
+                    flow_tea, mask_tea, merged_tea = self.teacher(torch.cat((imgs, gt), 1), training=training)
+                loss_distill = self.distill_weight * self.distill_loss(flow, mask, merged[3], flow_tea, mask_tea, merged_tea[3])
+        # The L1 and smoothness terms stay in float32
+        loss_l1 = (merged[3].float() - gt).abs().mean()
+        loss_smooth = self.sobel(flow[3].float(), flow[3].float()*0).mean()
         if training:
             self.optimG.zero_grad()
             # loss_G = loss_l1 + loss_cons + loss_smooth * 0.1
             # loss_G = loss_l1 + loss_smooth * 0.1 + loss_lap + loss_vgg
-            loss_G = loss_l1 + loss_smooth * 0.1 + loss_vgg + loss_kpt
-            loss_G.backward()
-            self.optimG.step()
+            loss_G = loss_l1 + loss_smooth * 0.1 + loss_vgg + loss_kpt + loss_distill
+            self.scaler.scale(loss_G).backward()
+            self.scaler.step(self.optimG)
+            self.scaler.update()
         else:
             flow_teacher = flow[2]
         return merged[3], {
@@ -132,5 +234,6 @@ class Model:
             'loss_vgg': loss_vgg,
             # 'loss_lap' : loss_lap,
             'loss_kpt' : loss_kpt,
+            'loss_distill': loss_distill,
             'loss_smooth': loss_smooth,
             }
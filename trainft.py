@@ -1,5 +1,7 @@
 import os
 import cv2
+import time
+import argparse
 import torch
 import torch.nn as nn
 import torch.optim as optim
@@ -7,7 +9,10 @@ import torch.nn.functional as F
 from torch.utils.data import DataLoader, random_split, Dataset
 from torchvision.transforms import ToTensor
 from train_log.RIFE_HDv3 import Model
+from model.loss import Ternary
+from model.laplacian import LapLoss
 from smpler_x import SMPLerX
+from smpl_cache import SMPLCache
 
 # Load the pre-trained SMPLer-X model
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -17,11 +22,15 @@ smpler_x.to(device)
 
 # Triplet Dataset
 class TripletDataset(Dataset):
-    def __init__(self, root_dir, start_clip=6235, end_clip=6285):
+    def __init__(self, root_dir, start_clip=6235, end_clip=6285, smpl_cache=None, cache_images=False):
         self.root_dir = root_dir
         self.start_clip = start_clip
         self.end_clip = end_clip
         self.samples = self._filter_clips()
+        # Ground-truth SMPL parameters from extract_smpl.py, so only the prediction goes through SMPLer-X
+        self.smpl = SMPLCache(smpl_cache) if smpl_cache else None
+        # Decoded frames kept as uint8 after their first read, per process
+        self.images = {} if cache_images else None
 
     def _filter_clips(self):
         filtered_samples = []
@@ -40,12 +49,17 @@ class TripletDataset(Dataset):
     def __getitem__(self, idx):
         triplet_dir = os.path.join(self.root_dir, self.samples[idx])
         try:
-            img0 = cv2.imread(os.path.join(triplet_dir, "img0.jpg"))
-            img1 = cv2.imread(os.path.join(triplet_dir, "img1.jpg"))
-            gt = cv2.imread(os.path.join(triplet_dir, "gt.jpg"))
-
-            if img0 is None or img1 is None or gt is None:
-                raise FileNotFoundError(f"Missing images in {triplet_dir}")
+            if self.images is not None and idx in self.images:
+                img0, img1, gt = self.images[idx]
+            else:
+                img0 = cv2.imread(os.path.join(triplet_dir, "img0.jpg"))
+                img1 = cv2.imread(os.path.join(triplet_dir, "img1.jpg"))
+                gt = cv2.imread(os.path.join(triplet_dir, "gt.jpg"))
+
+                if img0 is None or img1 is None or gt is None:
+                    raise FileNotFoundError(f"Missing images in {triplet_dir}")
+                if self.images is not None:
+                    self.images[idx] = (img0, img1, gt)
 
             # Convert images to tensors
             img0 = ToTensor()(img0)
@@ -54,6 +68,8 @@ class TripletDataset(Dataset):
 
             # Concatenate img0 and img1 as input
             data = torch.cat((img0, img1), dim=0)
+            if self.smpl is not None:
+                return data, gt, self.smpl.read(self.samples[idx])
             return data, gt
 
         except Exception as e:
@@ -102,88 +118,8 @@ def human_loss(pred_smpl, gt_smpl):
     
     return total_loss
 
-class Ternary(torch.nn.Module):
-    def __init__(self):
-        super(Ternary, self).__init__()
-        patch_size = 7
-        out_channels = patch_size * patch_size
-        # Register as a non-learnable buffer
-        self.register_buffer('w', torch.eye(out_channels).reshape((patch_size, patch_size, 1, out_channels)))
-        self.w = self.w.permute(3, 2, 0, 1)  # Reshape the weights correctly
-    
-    def transform(self, img):
-        # Convolution using non-learnable weights
-        patches = F.conv2d(img, self.w, padding=3, bias=None)
-        transf = patches - img  # Subtraction (out-of-place)
-        transf_norm = transf / torch.sqrt(0.81 + transf**2)  # Normalize (safe, out-of-place)
-        return transf_norm
-    
-    def forward(self, img0, img1):
-        t1 = self.transform(img0)
-        t2 = self.transform(img1)
-        # Calculate distance
-        dist = (t1 - t2) ** 2
-        dist_norm = torch.mean(dist / (0.1 + dist), dim=1, keepdim=True)  # Differentiable
-        return dist_norm
-
 census = Ternary().to(device)
 
-class LapLoss(torch.nn.Module):
-    @staticmethod
-    def gauss_kernel(size=5, channels=3):
-        kernel = torch.tensor([[1., 4., 6., 4., 1],
-                               [4., 16., 24., 16., 4.],
-                               [6., 24., 36., 24., 6.],
-                               [4., 16., 24., 16., 4.],
-                               [1., 4., 6., 4., 1.]])
-        kernel /= 256.
-        kernel = kernel.repeat(channels, 1, 1, 1)
-        kernel = kernel.to(device).requires_grad_(True)
-        return kernel
-
-
-    @staticmethod
-    def laplacian_pyramid(img, kernel, max_levels=3):
-        def downsample(x):
-            return x[:, :, ::2, ::2]
-
-        def upsample(x):
-            cc = torch.cat([x, torch.zeros(x.shape[0], x.shape[1], x.shape[2], x.shape[3]).to(device)], dim=3)
-            cc = cc.view(x.shape[0], x.shape[1], x.shape[2]*2, x.shape[3])
-            cc = cc.permute(0,1,3,2)
-            cc = torch.cat([cc, torch.zeros(x.shape[0], x.shape[1], x.shape[3], x.shape[2]*2).to(device)], dim=3)
-            cc = cc.view(x.shape[0], x.shape[1], x.shape[3]*2, x.shape[2]*2)
-            x_up = cc.permute(0,1,3,2)
-            return conv_gauss(x_up, 4*LapLoss.gauss_kernel(channels=x.shape[1]))
-
-        def conv_gauss(img, kernel):
-            img = torch.nn.functional.pad(img, (2, 2, 2, 2), mode='reflect')
-            out = torch.nn.functional.conv2d(img, kernel, groups=img.shape[1])
-            return out
-
-        current = img
-        pyr = []
-        for level in range(max_levels):
-            filtered = conv_gauss(current, kernel)
-            down = downsample(filtered)
-            up = upsample(down)
-            diff = current-up
-            pyr.append(diff)
-            current = down
-        return pyr
-
-    def __init__(self, max_levels=5, channels=3):
-        super(LapLoss, self).__init__()
-        self.max_levels = max_levels
-        self.gauss_kernel = LapLoss.gauss_kernel(channels=channels)
-
-    def forward(self, input, target):
-        pyr_input  = LapLoss.laplacian_pyramid(
-                img=input, kernel=self.gauss_kernel, max_levels=self.max_levels)
-        pyr_target = LapLoss.laplacian_pyramid(
-                img=target, kernel=self.gauss_kernel, max_levels=self.max_levels)
-        return sum(torch.nn.functional.l1_loss(a, b) for a, b in zip(pyr_input, pyr_target))
-
 laploss = LapLoss().to(device)
 def generate_smpl_params(image):
     """
@@ -199,6 +135,14 @@ def generate_smpl_params(image):
         'camera': smpl_output.camera
     }
 
+def gt_smpl_params(batch, gt):
+    """
+    The batch's cached ground-truth SMPL parameters, or SMPLer-X on gt if the dataset has no cache.
+    """
+    if len(batch) > 2:
+        return {name: value.to(gt.device) for name, value in batch[2].items()}
+    return generate_smpl_params(gt)
+
 def perspective_projection(joints3d, camera):
     """
     Perform perspective projection of 3D joints.
@@ -218,9 +162,10 @@ def train_model(model, train_loader, val_loader, device, epochs=10, learning_rat
     for epoch in range(epochs):
         epoch_loss = 0.0
         print(f"Epoch {epoch + 1}/{epochs}")
+        epoch_start = time.time()
 
-        for batch_idx, (data, gt) in enumerate(train_loader):
-            data, gt = data.to(device), gt.to(device)
+        for batch_idx, batch in enumerate(train_loader):
+            data, gt = batch[0].to(device), batch[1].to(device)
             img0, img1 = data[:, :3], data[:, 3:]
 
             optimizer.zero_grad()
@@ -233,7 +178,7 @@ def train_model(model, train_loader, val_loader, device, epochs=10, learning_rat
 
             # Generate SMPL parameters
             pred_smpl = generate_smpl_params(pred)
-            gt_smpl = generate_smpl_params(gt)
+            gt_smpl = gt_smpl_params(batch, gt)
 
             # Compute human loss
             human_loss_value = human_loss(pred_smpl, gt_smpl)
@@ -256,10 +201,14 @@ def train_model(model, train_loader, val_loader, device, epochs=10, learning_rat
             print(f"Batch {batch_idx + 1}/{len(train_loader)} - Total Loss: {total_loss.item():.4f}")
 
         avg_loss = epoch_loss / len(train_loader)
+        train_time = time.time() - epoch_start
         print(f"Epoch {epoch + 1} completed. Average Loss: {avg_loss:.4f}")
 
         # Validate the model
+        val_start = time.time()
         validate_model(model, val_loader, device)
+        val_time = time.time() - val_start
+        print(f"Epoch {epoch + 1} time: {train_time + val_time:.1f}s (train {train_time:.1f}s, validation {val_time:.1f}s)")
 
     print("Training complete.")
 
@@ -269,8 +218,8 @@ def validate_model(model, val_loader, device):
     criterion = nn.L1Loss()
 
     with torch.no_grad():
-        for batch_idx, (data, gt) in enumerate(val_loader):
-            data, gt = data.to(device), gt.to(device)
+        for batch_idx, batch in enumerate(val_loader):
+            data, gt = batch[0].to(device), batch[1].to(device)
             img0, img1 = data[:, :3], data[:, 3:]
 
             pred = model.inference(img0, img1)
@@ -280,7 +229,7 @@ def validate_model(model, val_loader, device):
 
             # Generate SMPL parameters
             pred_smpl = generate_smpl_params(pred)
-            gt_smpl = generate_smpl_params(gt)
+            gt_smpl = gt_smpl_params(batch, gt)
 
             # Compute human loss
             human_loss_value = human_loss(pred_smpl, gt_smpl)
@@ -298,6 +247,12 @@ def validate_model(model, val_loader, device):
 
 # Main script
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fine-tune RIFE with the human, census and Laplacian losses')
+    parser.add_argument('--root_dir', type=str, default='./ValidationTriplets')
+    parser.add_argument('--smpl_cache', type=str, default=None, help='ground-truth SMPL parameters written by extract_smpl.py')
+    parser.add_argument('--cache_images', action='store_true', help='keep decoded triplets in memory after the first epoch')
+    parser.add_argument('--epochs', type=int, default=1)
+    args = parser.parse_args()
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"Using device: {device}")
 
@@ -307,7 +262,8 @@ if __name__ == "__main__":
     freeze_layers(model)
 
     # Load dataset
-    full_dataset = TripletDataset('./ValidationTriplets', start_clip=6235, end_clip=6285)
+    full_dataset = TripletDataset(args.root_dir, start_clip=6235, end_clip=6285,
+                                  smpl_cache=args.smpl_cache, cache_images=args.cache_images)
 
     # Split dataset
     train_dataset, val_dataset = split_dataset(full_dataset, train_ratio=0.8)
@@ -317,7 +273,7 @@ if __name__ == "__main__":
     val_loader = DataLoader(val_dataset, batch_size=4, shuffle=False)
 
     # Train the model
-    train_model(model, train_loader, val_loader, device, epochs=1, learning_rate=1e-4)
+    train_model(model, train_loader, val_loader, device, epochs=args.epochs, learning_rate=1e-4)
 
     save_path = f"/model1.pth"
     torch.save(model.state_dict(), save_path)
@@ -0,0 +1,97 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+import tempfile
+import numpy as np
+from benchmark_train import is_oom, largest_fitting
+from telemetry import load
+
+TRAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train.py')
+
+
+def train_cmd(train_args, batch_size, num_workers, steps, telemetry=''):
+    """train.py with the given flags for a few steps, writing nothing but the telemetry."""
+    return [sys.executable, TRAIN] + train_args + [
+        '--batch_size', str(batch_size), '--num_workers', str(num_workers), '--max_steps', str(steps),
+        '--telemetry', telemetry, '--val_windows', '0', '--checkpoint_interval', '0', '--tuned_config', '']
+
+def fits(args, train_args, batch_size):
+    """Whether train.py runs two steps at batch_size without running out of memory."""
+    proc = subprocess.run(train_cmd(train_args, batch_size, 0, 2), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    # The kernel OOM killer ends the process with SIGKILL
+    ok = proc.returncode == 0
+    if not ok and not (proc.returncode == -9 or is_oom(proc.stderr)):
+        sys.stderr.write(proc.stderr)
+        raise subprocess.CalledProcessError(proc.returncode, 'train.py at batch {}'.format(batch_size))
+    print('batch {:>4}: {}'.format(batch_size, 'fits' if ok else 'out of memory'))
+    return ok
+
+def loader_fraction(args, train_args, batch_size, num_workers):
+    """Share of step time spent waiting on the loader, after the first args.warmup steps."""
+    with tempfile.TemporaryDirectory() as tmp:
+        telemetry = os.path.join(tmp, 'telemetry.jsonl')
+        subprocess.check_call(train_cmd(train_args, batch_size, num_workers, args.warmup + args.steps, telemetry),
+                              stdout=subprocess.DEVNULL)
+        records = load(telemetry)[args.warmup:]
+    wait = np.array([r['loader_wait'] for r in records])
+    compute = np.array([r['step_time'] for r in records])
+    return float(wait.sum() / (wait.sum() + compute.sum()))
+
+def worker_counts(limit):
+    counts = [0, 1, 2]
+    while counts[-1] * 2 <= limit:
+        counts.append(counts[-1] * 2)
+    if counts[-1] < limit:
+        counts.append(limit)
+    return [c for c in counts if c <= limit]
+
+def main():
+    parser = argparse.ArgumentParser(description='Find the largest batch that fits and the fewest loader workers that keep up',
+                                     epilog='Unrecognised arguments are passed on to train.py')
+    parser.add_argument('--output', type=str, default='train_log/tuned.json', help='config read by train.py --tuned_config')
+    parser.add_argument('--start_batch', type=int, default=1)
+    parser.add_argument('--max_batch', type=int, default=256)
+    parser.add_argument('--headroom', type=float, default=0.9,
+                        help='use this fraction of the largest batch that fits, for fragmentation and longer runs')
+    parser.add_argument('--batch_size', type=int, default=None, help='skip the memory probe and tune workers for this batch')
+    parser.add_argument('--max_workers', type=int, default=os.cpu_count())
+    parser.add_argument('--threshold', type=float, default=0.05, help='largest acceptable share of time waiting on the loader')
+    parser.add_argument('--steps', type=int, default=20, help='timed steps per worker count')
+    parser.add_argument('--warmup', type=int, default=5, help='steps excluded while workers start')
+    args, train_args = parser.parse_known_args()
+
+    result = {'train_args': train_args}
+    if args.batch_size is None:
+        max_batch = largest_fitting(lambda b: fits(args, train_args, b), args.start_batch, args.max_batch)
+        if max_batch == 0:
+            print('batch {} does not fit, nothing to tune'.format(args.start_batch))
+            return 1
+        result['max_batch_size'] = max_batch
+        result['batch_size'] = max(1, int(round(max_batch * args.headroom)))
+        print('largest batch that fits: {}, using {}'.format(max_batch, result['batch_size']))
+    else:
+        result['batch_size'] = args.batch_size
+
+    fractions = {}
+    for num_workers in worker_counts(args.max_workers):
+        fractions[num_workers] = loader_fraction(args, train_args, result['batch_size'], num_workers)
+        print('{:>3} workers: {:.1%} of step time waiting on the loader'.format(num_workers, fractions[num_workers]))
+        if fractions[num_workers] <= args.threshold:
+            break
+    within = [w for w, f in fractions.items() if f <= args.threshold]
+    result['num_workers'] = min(within) if within else min(fractions, key=fractions.get)
+    result['loader_fraction'] = {str(w): f for w, f in fractions.items()}
+    if not within:
+        print('no worker count keeps the loader wait under {:.0%}, using the best one'.format(args.threshold))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print('batch size {} with {} workers written to {}'.format(result['batch_size'], result['num_workers'], args.output))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())